@@ -0,0 +1,66 @@
+import sys
+import random
+from time import perf_counter
+
+import numpy as np
+from transformers import T5Tokenizer, T5ForConditionalGeneration
+
+from src.template_compiler import compiled_tasks
+from src.candidate_scoring import CandidateScorer
+
+
+NAMES = ["Jane", "Omar", "Wei", "Lucia", "Tom", "Priya", "Ken", "Ada"]
+
+
+def user_prompts(rng, user, num_candidates, item_pool=5000, history_length=40):
+    # one user of the sequential yes/no template: own id, name and history, candidates drawn from a shared item pool,
+    # so the prompts of different users only share the template text around the fields
+    task = compiled_tasks['sequential']['24']
+    history = [f"item_{i}" for i in rng.sample(range(1, item_pool + 1), history_length)]
+    values = {'user_id': f"user_{user}", 'user_desc': NAMES[user % len(NAMES)],
+              'item_id_list': "{" + "--".join(history) + "}", 'item_title_list': "{" + "--".join(history) + "}"}
+    candidates = [f"item_{i}" for i in rng.sample(range(1, item_pool + 1), num_candidates)]
+    prompts = [task.source.render(dict(values, target_item_id=candidate)) for candidate in candidates]
+    context = task.source.render(dict(values, target_item_id=""))
+    return prompts, context, candidates
+
+
+def timed(name, fn, users):
+    t1 = perf_counter()
+    scores = [fn(*user) for user in users]
+    print(f"{name}: {(perf_counter() - t1) / len(users) * 1000:.0f} ms per user")
+    return scores
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_candidate_scoring [model name or checkpoint dir]
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "t5-small"
+    tokenizer = T5Tokenizer.from_pretrained(model_name)
+    model = T5ForConditionalGeneration.from_pretrained(model_name).eval()
+    whole_word_embed = hasattr(model.encoder, 'whole_word_embeddings')
+    rng = random.Random(42)
+    users = [user_prompts(rng, user, 50) for user in range(5)]
+
+    print("exact, every full prompt is encoded:")
+    timed("  generate per candidate", lambda prompts, *_: [
+        model.generate(**tokenizer([prompt], return_tensors='pt'), max_length=4) for prompt in prompts
+    ], users)
+    scorer = CandidateScorer(model, tokenizer, cache_size=0, whole_word_embed=whole_word_embed)
+    # the reference: one prompt per forward pass, no padding, nothing shared between candidates
+    reference = timed("  score() one prompt at a time", lambda prompts, *_: [scorer.score([prompt])[0] for prompt in prompts], users)
+    exact = timed("  score(), no cache", lambda prompts, *_: scorer.score(prompts), users)
+    error = max(np.abs(np.asarray(e) - np.asarray(r)).max() for e, r in zip(exact, reference))
+    print(f"    vs one prompt at a time: max |log-prob difference| {error:.2e}")
+    scorer = CandidateScorer(model, tokenizer, cache_size=4096, whole_word_embed=whole_word_embed)
+    timed("  score(), encoder cache", lambda prompts, *_: scorer.score(prompts), users)
+    print(f"    cache hits {scorer.cache.hits}, misses {scorer.cache.misses} (distinct prompts per user)")
+
+    print("approximate, shared context prefix encoded once per user:")
+    scorer = CandidateScorer(model, tokenizer, cache_size=4096, whole_word_embed=whole_word_embed)
+    approximate = timed("  score_candidates()", lambda _, context, candidates: scorer.score_candidates(context, candidates), users)
+    print(f"    cache hits {scorer.cache.hits}, misses {scorer.cache.misses}")
+    top1 = np.mean([np.argmax(r) == np.argmax(a) for r, a in zip(reference, approximate)])
+    error = np.mean([np.abs(np.asarray(r) - np.asarray(a)).mean() for r, a in zip(reference, approximate)])
+    rank = np.mean([np.corrcoef(np.argsort(np.argsort(r)), np.argsort(np.argsort(a)))[0, 1] for r, a in zip(reference, approximate)])
+    print(f"    vs one prompt at a time: top-1 agreement {top1:.2f}, rank correlation {rank:.2f}, "
+          f"mean |log-prob difference| {error:.4f}")
@@ -0,0 +1,51 @@
+import sys
+from time import perf_counter
+
+import numpy as np
+from transformers import T5Tokenizer, T5ForConditionalGeneration
+
+from src.id_maps import IdMaps
+from src.output_writer import iter_prompt_shards
+from src.metrics import target_ranks, ranking_metrics
+from src.constrained_decoding import ItemTrie, ConstrainedItemDecoder
+
+
+def sequential_requests(prompt_dir, limit):
+    # the free text sequential prompts, answer "item_N"
+    requests = []
+    for row in iter_prompt_shards(prompt_dir, 'test'):
+        if row['task_desc'].startswith('sequential_') and row['out_text'].startswith('item_'):
+            requests.append((row['inp_text'], int(row['out_text'].rsplit('_', 1)[1]) - 1))
+            if len(requests) >= limit:
+                break
+    return requests
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_constrained_decoding ./data/prompts ./data/id_maps [model name or checkpoint dir]
+    prompt_dir = sys.argv[1] if len(sys.argv) > 1 else "./data/prompts"
+    id_maps_dir = sys.argv[2] if len(sys.argv) > 2 else "./data/id_maps"
+    model_name = sys.argv[3] if len(sys.argv) > 3 else "t5-small"
+    tokenizer = T5Tokenizer.from_pretrained(model_name)
+    model = T5ForConditionalGeneration.from_pretrained(model_name)
+    whole_word_embed = hasattr(model.encoder, 'whole_word_embeddings')
+
+    t1 = perf_counter()
+    trie = ItemTrie.from_id_maps(IdMaps.load(id_maps_dir), tokenizer)
+    print(f"item trie: depth {trie.depth}, built in {perf_counter() - t1:.2f}s")
+
+    requests = sequential_requests(prompt_dir, 256)
+    decoder = ConstrainedItemDecoder(model, tokenizer, trie, num_beams=20, whole_word_embed=whole_word_embed)
+    for batch_size in [1, 4, 16, 64]:
+        latencies, ranked = [], []
+        t1 = perf_counter()
+        for start in range(0, len(requests), batch_size):
+            batch = requests[start:start + batch_size]
+            t2 = perf_counter()
+            results = decoder.recommend([inp_text for inp_text, _ in batch], k=10)
+            latencies.extend([perf_counter() - t2] * len(batch))
+            ranked.extend([item for item, _ in result] for result in results)
+        elapsed = perf_counter() - t1
+        metrics = ranking_metrics(target_ranks(ranked, [target for _, target in requests]))
+        print(f"batch {batch_size}: p50 latency {np.percentile(latencies, 50) * 1000:.1f} ms, p99 {np.percentile(latencies, 99) * 1000:.1f} ms, "
+              f"{len(requests) / elapsed:.1f} requests/s, " + ", ".join(f"{name} {value:.4f}" for name, value in metrics.items()))
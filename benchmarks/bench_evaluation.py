@@ -0,0 +1,58 @@
+import os
+import json
+import random
+import argparse
+from time import perf_counter
+
+from src.evaluation import Evaluator, RANKING, TEXT
+from src.output_writer import iter_prompt_shards
+
+
+def noisy_prediction(row, rng):
+    # half right, half wrong in a way every metric can see: another rating, a shuffled ranking, dropped words
+    target = row['out_text']
+    if rng.random() < 0.5:
+        return [target] if row['metric'] == RANKING else target
+    if row['metric'] == RANKING:
+        ranked = [f"item_{rng.randint(1, 5000)}" for _ in range(19)]
+        ranked.insert(rng.randint(0, 19), target)
+        return ranked
+    if row['metric'] == TEXT:
+        # a leading "4.0," rating stays, the explanation loses words
+        words = target.split()
+        return " ".join(word for i, word in enumerate(words) if (i == 0 and word.endswith(",")) or rng.random() < 0.7)
+    return str(rng.randint(1, 5)) if target.replace('.', '', 1).isdigit() else ("no" if target == "yes" else "yes")
+
+
+def write_predictions(prompt_dir, path, seed=42):
+    rng = random.Random(seed)
+    count = 0
+    with open(path, "w") as f:
+        for row in iter_prompt_shards(prompt_dir, 'test'):
+            prediction = noisy_prediction(row, rng)
+            key = 'predictions' if isinstance(prediction, list) else 'prediction'
+            f.write(json.dumps({key: prediction}) + "\n")
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score synthetic predictions for the test shards of a prompt dir")
+    parser.add_argument("prompt_dir", nargs="?", default="./data/prompts")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    args = parser.parse_args()
+
+    predictions_path = os.path.join(args.prompt_dir, "bench_predictions.jsonl")
+    count = write_predictions(args.prompt_dir, predictions_path)
+    reports = {}
+    for workers in sorted({1, args.workers}):
+        evaluator = Evaluator(batch_size=args.batch_size, num_workers=workers)
+        t = perf_counter()
+        reports[workers] = evaluator.evaluate_shards(args.prompt_dir, predictions_path)
+        elapsed = perf_counter() - t
+        print(f"workers={workers}: {count} rows in {elapsed:.2f}s, {count / elapsed:.0f} rows/s")
+    assert json.dumps(reports[1], sort_keys=True) == json.dumps(reports[args.workers], sort_keys=True), "reports differ between worker counts"
+    for family, report in reports[args.workers]['families'].items():
+        print(f"{family:<28} " + ", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in report.items() if k != 'metric'))
+    os.remove(predictions_path)
@@ -0,0 +1,87 @@
+import sys
+import tempfile
+import resource
+import multiprocessing
+from time import time
+
+import numpy as np
+
+from src.out_of_core import ExternalSorter, RECORD_DTYPE, SORT_ORDER
+
+
+# interpreter, numpy temporaries of the sort and the record generator, independent of the number of records
+FIXED_OVERHEAD_MB = 16
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _sort(num_records, memory_mb, seed):
+    # same budget split as OutOfCorePreparation: half of memory_mb for the run buffer, a quarter of that for the merge
+    run_records = max(int(memory_mb * 2**20) // (2 * RECORD_DTYPE.itemsize), 1)
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        baseline = _max_rss_mb()
+        t1 = time()
+        sorter = ExternalSorter(tmp_dir, run_records)
+        for start in range(0, num_records, 10_000):
+            n = min(10_000, num_records - start)
+            users = rng.integers(0, num_records // 20, n, dtype=np.uint64).tolist()
+            times = rng.integers(0, 10**6, n).tolist()
+            for i in range(n):
+                sorter.add((users[i], 0, times[i], start + i, -1))
+        spill_peak = _max_rss_mb() - baseline
+        spill_time = time() - t1
+        t1 = time()
+        grouped = sorter.merge(tmp_dir + "/grouped.npy", max(run_records // 4, 1))
+        merge_peak = _max_rss_mb() - baseline
+        merge_time = time() - t1
+        ordered = all(
+            np.all(np.diff(np.asarray(grouped['user'][s:s + 1_000_000]).astype(np.int64)) >= 0)
+            for s in range(0, len(grouped), 1_000_000)
+        )
+        count = len(grouped)
+        del grouped
+    return spill_peak, spill_time, merge_peak, merge_time, ordered and count == num_records
+
+
+def _run_isolated(func, *args):
+    # a fresh process per measurement, the peak above its own baseline is then the sorter's alone
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def check_memory_bound(num_records=3_000_000, memory_mb=16):
+    spill_peak, _, merge_peak, _, ok = _run_isolated(_sort, num_records, memory_mb, 0)
+    assert ok, "merged file is not the sorted input"
+    assert spill_peak < memory_mb + FIXED_OVERHEAD_MB, f"spill peak {spill_peak:.1f} MB over a {memory_mb} MB budget"
+    assert merge_peak < memory_mb + FIXED_OVERHEAD_MB, f"merge peak {merge_peak:.1f} MB over a {memory_mb} MB budget"
+
+
+def check_merge_order():
+    # several runs with equal users, the merge must give the SORT_ORDER of one in memory sort
+    records = np.zeros(10_000, dtype=RECORD_DTYPE)
+    rng = np.random.default_rng(1)
+    records['user'] = rng.integers(0, 50, len(records))
+    records['time'] = rng.integers(0, 20, len(records))
+    records['offset'] = rng.permutation(len(records))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sorter = ExternalSorter(tmp_dir, 777)
+        for record in records.tolist():
+            sorter.add(record)
+        merged = np.array(sorter.merge(tmp_dir + "/grouped.npy", 100))
+    assert np.array_equal(merged, np.sort(records, order=SORT_ORDER))
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_external_sort [number of records]
+    check_merge_order()
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    data_mb = num_records * RECORD_DTYPE.itemsize / 2**20
+    for memory_mb in [16, 64, 256]:
+        spill_peak, spill_time, merge_peak, merge_time, ok = _run_isolated(_sort, num_records, memory_mb, 0)
+        assert ok
+        print(f"records: {num_records} ({data_mb:.0f} MB), memory_mb: {memory_mb}, "
+              f"spill: {spill_time:.1f}s peak +{spill_peak:.1f} MB, merge: {merge_time:.1f}s peak +{merge_peak:.1f} MB")
+    check_memory_bound()
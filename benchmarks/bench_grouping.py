@@ -0,0 +1,45 @@
+import random
+from time import time
+
+from src.pre_data_preparation import PreDataPreparation
+
+
+def legacy_user_item_interactions(review_data):
+    user_item_interaction = {}
+    for data in review_data:
+        user, item, time, rating, user_review, review_feature, review_explanation = data
+        user_item_interaction[user] = user_item_interaction.get(user, []) + [(item, time, rating, user_review, review_feature, review_explanation)]
+    for user, item_time in user_item_interaction.items():
+        user_item_interaction[user] = sorted(user_item_interaction[user], key=lambda x: x[1])
+    return user_item_interaction
+
+
+def synthetic_reviews(num_reviews, num_users, num_items, seed=42):
+    # pareto distributed user activity, so a few heavy users own most of the reviews like in yelp
+    rng = random.Random(seed)
+    weights = [rng.paretovariate(1.2) for _ in range(num_users)]
+    users = rng.choices(range(num_users), weights=weights, k=num_reviews)
+    return [
+        (f"user{u}", f"item{rng.randrange(num_items)}", 20190101000000 + rng.randrange(10**6), 4.0, "", "", "")
+        for u in users
+    ]
+
+
+if __name__ == "__main__":
+    legacy_limit = 200_000
+    prep = PreDataPreparation()
+    for num_reviews in [10_000, 50_000, 200_000, 1_000_000, 5_000_000]:
+        review_data = synthetic_reviews(num_reviews, num_users=max(num_reviews // 20, 10), num_items=max(num_reviews // 50, 10))
+
+        t1 = time()
+        grouped = prep._get_user_item_interactions(review_data)
+        new_time = time() - t1
+
+        if num_reviews <= legacy_limit:
+            t1 = time()
+            legacy_grouped = legacy_user_item_interactions(review_data)
+            legacy_time = time() - t1
+            assert grouped == legacy_grouped
+            print(f"reviews: {num_reviews}, users: {len(grouped)}, new: {new_time:.3f}s, legacy: {legacy_time:.3f}s, speedup: {legacy_time / new_time:.1f}x")
+        else:
+            print(f"reviews: {num_reviews}, users: {len(grouped)}, new: {new_time:.3f}s, legacy: skipped")
@@ -0,0 +1,88 @@
+import os
+import json
+import random
+import string
+import resource
+import tempfile
+import multiprocessing
+from time import time
+
+from src.id_maps import IdMaps
+
+
+def random_yelp_ids(n, seed):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + "-_"
+    return list({"".join(rng.choices(alphabet, k=22)) for _ in range(n)})
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _bench_json(data_maps_file_path, queries):
+    rss_before = _max_rss_mb()
+    t1 = time()
+    with open(data_maps_file_path, "r") as f:
+        data_maps = json.load(f)
+    load_time = time() - t1
+    t1 = time()
+    for raw_id in queries:
+        data_maps['id2item'][data_maps['item2id'][raw_id]]
+    lookup_time = time() - t1
+    return load_time, _max_rss_mb() - rss_before, lookup_time
+
+
+def _bench_id_maps(id_maps_dir, queries):
+    rss_before = _max_rss_mb()
+    t1 = time()
+    id_maps = IdMaps.load(id_maps_dir)
+    load_time = time() - t1
+    t1 = time()
+    for raw_id in queries:
+        id_maps.items.to_raw(id_maps.items.to_index(raw_id))
+    lookup_time = time() - t1
+    t1 = time()
+    [id_maps.items.to_raw(i) for i in id_maps.items.to_index_batch(queries)]
+    print(f"id_maps batched lookups: {time() - t1:.3f}s")
+    return load_time, _max_rss_mb() - rss_before, lookup_time
+
+
+def run_isolated(func, *args):
+    # every measurement runs in a fresh process so peak rss is not shared between the two formats
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def check_long_queries():
+    # an unknown id longer than the stored keys must not match a known id it starts with
+    id_maps = IdMaps.build(["user_a"], ["abcdefghij", "klmnopqrst"])
+    assert id_maps.items.to_index_batch(["abcdefghij", "abcdefghijXYZ", "klmnopqrs", "zz"]).tolist() == [0, -1, -1, -1]
+    assert id_maps.items.to_index("abcdefghijXYZ") is None
+
+
+if __name__ == "__main__":
+    check_long_queries()
+    num_users, num_items, num_queries = 1_000_000, 1_000_000, 100_000
+    user_ids = random_yelp_ids(num_users, seed=1)
+    item_ids = random_yelp_ids(num_items, seed=2)
+    queries = random.Random(3).sample(item_ids, num_queries)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_maps_file_path = os.path.join(tmp_dir, "data_maps.json")
+        id_maps_dir = os.path.join(tmp_dir, "id_maps")
+        data_maps = {
+            'user2id': {u: f"user_{i + 1}" for i, u in enumerate(user_ids)},
+            'id2user': {f"user_{i + 1}": u for i, u in enumerate(user_ids)},
+            'item2id': {u: f"item_{i + 1}" for i, u in enumerate(item_ids)},
+            'id2item': {f"item_{i + 1}": u for i, u in enumerate(item_ids)},
+        }
+        with open(data_maps_file_path, "w") as f:
+            json.dump(data_maps, f, indent=4)
+        IdMaps.from_data_maps(data_maps).save(id_maps_dir)
+        del data_maps
+
+        for name, func, path in [("data_maps.json", _bench_json, data_maps_file_path), ("id_maps", _bench_id_maps, id_maps_dir)]:
+            load_time, rss_mb, lookup_time = run_isolated(func, path, queries)
+            print(f"{name}: load {load_time:.3f}s, peak rss +{rss_mb:.0f} MB, "
+                  f"{num_queries} raw->index->raw lookups {lookup_time:.3f}s ({lookup_time / num_queries * 1e6:.2f} us each)")
@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import argparse
+import traceback
+import subprocess
+import multiprocessing
+from queue import Empty
+
+from benchmarks.synthetic_yelp import generate_yelp
+
+
+SCALES = {
+    'small': {'num_users': 2000, 'num_items': 500, 'num_reviews': 20000},
+    'medium': {'num_users': 20000, 'num_items': 5000, 'num_reviews': 200000},
+    'large': {'num_users': 100000, 'num_items': 20000, 'num_reviews': 1000000},
+}
+
+
+def _dataset(scale, data_root):
+    # generated once per scale and reused by later runs of any branch
+    dir_path = os.path.join(data_root, scale, "original_data")
+    meta_path = os.path.join(dir_path, "synthetic.json")
+    params = dict(SCALES[scale], min_date='2018-01-01 00:00:00', max_date='2019-12-31 23:59:59')
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            if json.load(f)['params'] == params:
+                return dir_path
+    shutil.rmtree(dir_path, ignore_errors=True)
+    counts = generate_yelp(dir_path, **params)
+    with open(meta_path, "w") as f:
+        json.dump({'params': params, 'counts': counts}, f, indent=4)
+    return dir_path
+
+
+def _prepare_scale(scale, data_root, num_workers, profile, trace_memory):
+    from src.pre_data_preparation import PreDataPreparation
+    from src.data_preparation import DataPreparation
+    from src.instrumentation import Instrumentation
+
+    raw_dir = _dataset(scale, data_root)
+    work_dir = os.path.join(data_root, scale, "work")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    instrumentation = Instrumentation(profile=profile, trace_memory=trace_memory, profile_dir=os.path.join(work_dir, "profiles"))
+
+    pre = PreDataPreparation()
+    pre.review_file_path = os.path.join(raw_dir, "review.json")
+    pre.user_file_path = os.path.join(raw_dir, "user_filtered.json")
+    pre.item_file_path = os.path.join(raw_dir, "business.json")
+    pre.review_with_features_file = os.path.join(raw_dir, "reviews_pickle.pickle")
+    pre.review_features_dir = os.path.join(work_dir, "review_features")
+    pre.final_pre_data_dir = os.path.join(work_dir, "final_pre_data")
+    pre.id_maps_dir = os.path.join(work_dir, "id_maps")
+    pre.min_date, pre.max_date = '2018-01-01 00:00:00', '2019-12-31 23:59:59'
+    pre.num_workers = num_workers
+    pre.report_path = os.path.join(work_dir, "pre_data_preparation.json")
+    pre.instrumentation = instrumentation
+    with instrumentation.stage('feature_store') as counters:
+        counters['records_out'] = len(pre._get_review_with_features())
+    pre.pre_data_preparation()
+
+    prep = DataPreparation()
+    prep.final_pre_data_dir = pre.final_pre_data_dir
+    prep.id_maps_dir = pre.id_maps_dir
+    prep.output_dir = os.path.join(work_dir, "prompts")
+    prep.num_workers = num_workers
+    prep.report_path = os.path.join(work_dir, "data_preparation.json")
+    prep.instrumentation = instrumentation
+    prep.data_preparation()
+    return instrumentation.report()
+
+
+def _run_scale(scale, data_root, num_workers, profile, trace_memory, queue):
+    # runs in its own process, so peak rss belongs to this scale only; a failure is sent back as its traceback
+    try:
+        queue.put(('ok', _prepare_scale(scale, data_root, num_workers, profile, trace_memory)))
+    except BaseException:
+        queue.put(('error', traceback.format_exc()))
+
+
+def _wait_result(process, queue, poll_interval=5.0):
+    # a child killed by the oom killer never puts anything, so the queue is only waited on while the child is alive
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except Empty:
+            if not process.is_alive():
+                break
+    # the result can still arrive from the feeder thread of a child that just exited
+    try:
+        return queue.get(timeout=poll_interval)
+    except Empty:
+        return 'error', f"process exited with code {process.exitcode} without a result"
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline):
+    for scale, report in results['scales'].items():
+        base = baseline['scales'].get(scale)
+        if base is None or 'stages' not in report or 'stages' not in base:
+            continue
+        print(f"{scale}: {results['label']} vs {baseline['label']}")
+        for stage, entry in report['stages'].items():
+            base_entry = base['stages'].get(stage)
+            if base_entry and base_entry['wall_time'] > 0:
+                print(f"  {stage:<14} {entry['wall_time']:8.2f}s vs {base_entry['wall_time']:8.2f}s "
+                      f"({entry['wall_time'] / base_entry['wall_time']:.2f}x), peak rss {entry['peak_rss_mb']:.0f} vs {base_entry['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run both preparation stages on synthetic yelp data at several scales")
+    parser.add_argument("--scales", nargs="+", default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument("--data-root", default="./data/bench")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--label", default=None, help="name of the results file, defaults to the git revision")
+    parser.add_argument("--compare", default=None, help="results file of another branch to compare against")
+    parser.add_argument("--out", default="benchmarks/results", help="directory of the results files, ignored by git")
+    args = parser.parse_args()
+
+    label = args.label or git_revision()
+    results = {'label': label, 'workers': args.workers, 'scales': {}}
+    for scale in args.scales:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_scale, args=(scale, args.data_root, args.workers, args.profile, args.trace_memory, queue))
+        process.start()
+        status, payload = _wait_result(process, queue)
+        process.join()
+        if status == 'error':
+            results['scales'][scale] = {'error': payload}
+            print(f"[{scale}] failed:\n{payload}")
+            continue
+        results['scales'][scale] = payload
+        for stage, entry in results['scales'][scale]['stages'].items():
+            print(f"[{scale}] {stage:<14} {entry['wall_time']:8.2f}s  cpu {entry['cpu_time']:8.2f}s  "
+                  f"in {entry['records_in']:>9}  out {entry['records_out']:>9}  peak rss {entry['peak_rss_mb']:.0f} MB")
+
+    os.makedirs(args.out, exist_ok=True)
+    results_path = os.path.join(args.out, f"{label}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print("Results written to", results_path)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
+    if any('error' in report for report in results['scales'].values()):
+        raise SystemExit(1)
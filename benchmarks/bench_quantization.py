@@ -0,0 +1,72 @@
+import os
+import argparse
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from transformers import T5Tokenizer, T5ForConditionalGeneration
+
+from src.output_writer import iter_prompt_shards
+from src.evaluation import Evaluator
+from src.quantization import QuantizedGenerator, OnnxGenerator, export_onnx, model_size_mb, quantize_dynamic_int8
+
+
+def held_out_sample(prompt_dir, per_family):
+    # the first per_family test rows of every task family
+    rows, counts = [], {}
+    for row in iter_prompt_shards(prompt_dir, 'test'):
+        family = row['task_desc'].rsplit('_', 1)[0]
+        if counts.get(family, 0) < per_family:
+            counts[family] = counts.get(family, 0) + 1
+            rows.append(row)
+    return rows
+
+
+def run(name, generate, rows, batch_size, max_length):
+    predictions, latencies = [], []
+    generate([row['inp_text'] for row in rows[:batch_size]], max_length)  # warm up
+    t1 = perf_counter()
+    for start in range(0, len(rows), batch_size):
+        t = perf_counter()
+        predictions.extend(generate([row['inp_text'] for row in rows[start:start + batch_size]], max_length))
+        latencies.append(perf_counter() - t)
+    elapsed = perf_counter() - t1
+    report = Evaluator(num_workers=1).evaluate(rows, predictions)
+    print(f"{name:<10} batch p50 {np.percentile(latencies, 50) * 1000:7.0f} ms  p99 {np.percentile(latencies, 99) * 1000:7.0f} ms  "
+          f"{len(rows) / elapsed:7.1f} prompts/s")
+    for family, family_report in report['families'].items():
+        scores = {k: v for k, v in family_report.items() if k in ('accuracy', 'MAE', 'HR@1', 'ROUGE-L')}
+        print(f"    {family:<28} " + ", ".join(f"{k}={v:.4f}" for k, v in scores.items()))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fp32 vs dynamic int8 cpu inference on a held out sample per task family")
+    parser.add_argument("prompt_dir", nargs="?", default="./data/prompts")
+    parser.add_argument("--model", default="t5-small", help="model name or checkpoint dir")
+    parser.add_argument("--per-family", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-length", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--onnx", action="store_true", help="also export to onnx and run the kv cache decoder")
+    args = parser.parse_args()
+
+    tokenizer = T5Tokenizer.from_pretrained(args.model)
+    model = T5ForConditionalGeneration.from_pretrained(args.model).eval()
+    whole_word_embed = hasattr(model.encoder, 'whole_word_embeddings')
+    rows = held_out_sample(args.prompt_dir, args.per_family)
+    print(f"{len(rows)} held out prompts, fp32 {model_size_mb(model):.0f} MB, int8 {model_size_mb(quantize_dynamic_int8(model)):.0f} MB")
+
+    fp32 = QuantizedGenerator(model, tokenizer, whole_word_embed=whole_word_embed, quantize=False, num_threads=args.threads)
+    int8 = QuantizedGenerator(model, tokenizer, whole_word_embed=whole_word_embed, quantize=True, num_threads=args.threads)
+    run("fp32", fp32.generate, rows, args.batch_size, args.max_length)
+    run("int8", int8.generate, rows, args.batch_size, args.max_length)
+    if args.onnx:
+        with tempfile.TemporaryDirectory() as dir_path:
+            export_onnx(model, tokenizer, dir_path, whole_word_embed=whole_word_embed, quantize=True)
+            for quantized in (False, True):
+                onnx = OnnxGenerator(dir_path, tokenizer, quantized=quantized, num_threads=args.threads)
+                suffix = ".int8.onnx" if quantized else ".onnx"
+                size = sum(os.path.getsize(os.path.join(dir_path, graph + suffix)) for graph in onnx.meta['graphs']) / 2**20
+                print(f"onnx {'int8' if quantized else 'fp32'}: {size:.0f} MB of graphs")
+                run("onnx int8" if quantized else "onnx fp32", onnx.generate, rows, args.batch_size, args.max_length)
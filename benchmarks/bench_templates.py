@@ -0,0 +1,62 @@
+import random
+from time import perf_counter
+
+from src.data_templates import tasks
+from src.template_compiler import compiled_tasks, task_keys, JoinedPrefixes, YES_NO
+
+
+def sample_values(history_length=40):
+    item_ids = [f"item_{random.randint(1, 20000)}" for _ in range(history_length)]
+    item_titles = [f"Business {i}_Las Vegas_NV" for i in range(history_length)]
+    return {
+        'user_id': 'user_1234', 'user_desc': 'Jane', 'item_id': 'item_42', 'item_title': 'Pizza Place_Phoenix_AZ',
+        'rating': 4.0, 'review_body': 'Great food and friendly staff. ' * 10, 'explanation': 'the pizza was great',
+        'feature': 'pizza', 'candidate_item_id': 'item_7', 'candidate_item_title': 'Cafe_Tampa_FL',
+        'target_item_id': 'item_99', 'target_item_title': 'Sushi Bar_Reno_NV',
+        'candiate_item_id_list': "{" + "--".join(f"item_{i}" for i in range(51)) + "}",
+        'original_item_id_list': item_ids, 'original_item_title_list': item_titles,
+    }
+
+
+def legacy_render(family, keys, values):
+    for sub_task_key in keys:
+        if family == 'sequential':
+            size = len(values['original_item_id_list']) - 1
+            values['item_id_list'] = "{" + "--".join(values['original_item_id_list'][:size]) + "}"
+            values['item_title_list'] = "{" + "--".join(values['original_item_title_list'][:size]) + "}"
+        template = tasks[family][sub_task_key]
+        int(sub_task_key)
+        template[0].format(**values)
+        template[1].format(**values)
+
+
+def compiled_render(family, keys, values):
+    if family == 'sequential':
+        item_id_prefixes = JoinedPrefixes(values['original_item_id_list'])
+        item_title_prefixes = JoinedPrefixes(values['original_item_title_list'])
+    for sub_task_key in keys:
+        if family == 'sequential':
+            size = len(values['original_item_id_list']) - 1
+            values['item_id_list'] = item_id_prefixes.braced(size)
+            values['item_title_list'] = item_title_prefixes.braced(size)
+        task = compiled_tasks[family][sub_task_key]
+        task.category == YES_NO
+        task.source.render(values)
+        task.target.render(values)
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    num_users, prompts_per_user = 20000, 5
+    values = sample_values()
+    for family in tasks:
+        key_batches = [random.sample(task_keys[family], prompts_per_user) for _ in range(num_users)]
+        num_prompts = num_users * prompts_per_user
+        timings = {}
+        for name, render in [("str.format", legacy_render), ("compiled", compiled_render)]:
+            t1 = perf_counter()
+            for keys in key_batches:
+                render(family, keys, values)
+            timings[name] = (perf_counter() - t1) / num_prompts * 1e6
+        print(f"{family}: str.format {timings['str.format']:.2f} us/prompt, compiled {timings['compiled']:.2f} us/prompt, "
+              f"speedup {timings['str.format'] / timings['compiled']:.2f}x")
@@ -0,0 +1,56 @@
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+from torch.utils.data import DataLoader
+from transformers import T5Tokenizer
+
+from src.output_writer import iter_prompt_shards
+from src.token_cache import build_token_cache, calculate_whole_word_ids, padding_waste, TokenCacheDataset, LengthBucketSampler
+
+
+def on_the_fly(rows, tokenizer, batch_size, max_text_length=256):
+    # what P5YelpDataset does per example every epoch, its collate_fn then pads to the longest input of the batch
+    num_tokens, t1 = 0, time()
+    for start in range(0, len(rows), batch_size):
+        for row in rows[start:start + batch_size]:
+            input_ids = tokenizer.encode(row['inp_text'], truncation=True, max_length=max_text_length)
+            calculate_whole_word_ids(tokenizer.tokenize(row['inp_text']), len(input_ids))
+            tokenizer.encode(row['out_text'], truncation=True, max_length=64)
+            num_tokens += len(input_ids)
+    return num_tokens, time() - t1
+
+
+def from_cache(dataset, batch_sampler):
+    loader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn)
+    num_tokens, t1 = 0, time()
+    for batch in loader:
+        num_tokens += int((batch['input_ids'] != dataset.pad_token_id).sum())
+    return num_tokens, time() - t1
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_token_cache ./data/prompts [tokenizer name]
+    prompt_dir = sys.argv[1] if len(sys.argv) > 1 else "./data/prompts"
+    tokenizer = T5Tokenizer.from_pretrained(sys.argv[2] if len(sys.argv) > 2 else "t5-small")
+    batch_size, max_text_length = 32, 256
+    rows = list(iter_prompt_shards(prompt_dir, 'train'))[:20000]
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        t1 = time()
+        meta = build_token_cache(prompt_dir, dir_path, tokenizer, 'train', max_text_length)
+        print(f"cache build: {meta['num_examples']} examples, {meta['num_input_tokens']} tokens in {time() - t1:.2f}s")
+
+        dataset = TokenCacheDataset(dir_path)
+        lengths = dataset.lengths[:len(rows)]
+        fixed_batches = [list(range(i, min(i + batch_size, len(rows)))) for i in range(0, len(rows), batch_size)]
+        sampler = LengthBucketSampler(lengths, batch_size)
+
+        num_tokens, elapsed = on_the_fly(rows, tokenizer, batch_size, max_text_length)
+        print(f"on the fly, padded to batch max: {num_tokens / elapsed:.0f} tokens/s, "
+              f"padding waste {padding_waste(lengths, fixed_batches):.1%}")
+        num_tokens, elapsed = from_cache(dataset, fixed_batches)
+        print(f"cache, padded to batch max: {num_tokens / elapsed:.0f} tokens/s, padding waste {padding_waste(lengths, fixed_batches):.1%}")
+        num_tokens, elapsed = from_cache(dataset, sampler.batches())
+        print(f"cache, length buckets: {num_tokens / elapsed:.0f} tokens/s, padding waste {padding_waste(lengths, sampler.batches()):.1%}")
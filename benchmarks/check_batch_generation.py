@@ -0,0 +1,103 @@
+import random
+import tempfile
+from time import time
+from collections import Counter
+
+import numpy as np
+
+from src.utils import flatten_dict
+from src.id_maps import IdMaps
+from src.columnar import write_columnar, ColumnarPreData
+from src.data_preparation import DataPreparation
+from src.batch_generation import InteractionColumns, rating_batch, review_batch
+from src.template_compiler import compiled_tasks, DIRECT
+
+
+def synthetic_pre_data(dir_path, num_users, num_items, seed=42):
+    rng = random.Random(seed)
+    users = [f"user{u}" for u in range(num_users)]
+    items = [f"item{i}" for i in range(num_items)]
+    user_item_interaction = {}
+    for user in users:
+        history = rng.sample(items, rng.randint(5, 40))
+        user_item_interaction[user] = [
+            (item, 20190101000000 + t, float(rng.randint(1, 5)), "" if rng.random() < 0.1 else f"review {t} of {item}", "", "")
+            for t, item in enumerate(history)
+        ]
+    id_maps = IdMaps.build(users, items)
+    write_columnar(
+        dir_path, user_item_interaction, id_maps,
+        {user: {'user_desc': user.upper()} for user in users}, {item: {'item_desc': item + "_Las Vegas_NV"} for item in items},
+    )
+    return ColumnarPreData(dir_path)
+
+
+def per_user_rows(prep, whole_data, seed):
+    random.seed(seed)
+    rating_rows, review_rows = [], []
+    for idx in range(len(whole_data)):
+        data_dct = whole_data.record(idx)
+        rating_rows.extend(prep._rating_data_preparation(data_dct))
+        review_rows.extend(prep._review_data_preparation(data_dct))
+    return rating_rows, review_rows
+
+
+def batch_rows(whole_data, seed, chunk_size=256):
+    rng = np.random.default_rng(seed)
+    rating_rows, review_rows = [], []
+    for start in range(0, len(whole_data), chunk_size):
+        columns = InteractionColumns(whole_data, start, min(start + chunk_size, len(whole_data)))
+        rating_rows.extend(rating_batch(columns, rng))
+        review_rows.extend(review_batch(columns, rng))
+    return rating_rows, review_rows
+
+
+def compare_counts(name, expected_rows, actual_rows, num_sigma=5):
+    # per sub task (and per answer for the fixed answer tasks) counts agree within binomial noise; both sides are random
+    # draws, so the difference has twice the variance of one count
+    key = lambda row: (row[0], row[2]) if row[2] in ("yes", "no", "like", "dislike") else (row[0], "")
+    expected, actual = Counter(map(key, expected_rows)), Counter(map(key, actual_rows))
+    assert len(expected_rows) == len(actual_rows), f"{name}: {len(expected_rows)} != {len(actual_rows)} rows"
+    for k in sorted(set(expected) | set(actual)):
+        p = expected[k] / len(expected_rows)
+        sigma = max(np.sqrt(2 * len(expected_rows) * p * (1 - p)), 1.0)
+        assert abs(expected[k] - actual[k]) <= num_sigma * sigma, f"{name} {k}: {expected[k]} vs {actual[k]}"
+    print(f"{name}: {len(actual_rows)} rows, {len(actual)} (sub task, answer) counts within {num_sigma} sigma")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as dir_path:
+        whole_data = synthetic_pre_data(dir_path, num_users=20000, num_items=5000)
+        prep = DataPreparation()
+
+        t1 = time()
+        legacy_rating, legacy_review = per_user_rows(prep, whole_data, seed=42)
+        legacy_time = time() - t1
+        t1 = time()
+        rating_rows, review_rows = batch_rows(whole_data, seed=42)
+        batch_time = time() - t1
+
+        # same seed, same rows
+        assert (rating_rows, review_rows) == batch_rows(whole_data, seed=42)
+        assert (rating_rows, review_rows) != batch_rows(whole_data, seed=43)
+
+        compare_counts("rating", legacy_rating, rating_rows)
+        compare_counts("review", legacy_review, review_rows)
+
+        # rating rows come in pairs per interaction, the direct ones must render exactly what the per user code renders,
+        # the answer being either the true rating or one perturbed by an earlier "no" of the same interaction
+        interactions = [
+            sub_dct for data_dct in map(whole_data.record, range(len(whole_data)))
+            for sub_dct in flatten_dict({'user_id': data_dct['user_id'], 'user_desc': data_dct['user_desc'], 'item_id': data_dct['item_id_list'],
+                                         'item_title': data_dct['item_title_list'], 'rating': data_dct['rating_list']})
+        ]
+        for i, row in enumerate(rating_rows):
+            task = compiled_tasks['rating'][row[0].rsplit('_', 1)[1]]
+            sub_dct = interactions[i // 2]
+            if task.category == DIRECT:
+                assert row[1] == task.source.render(sub_dct), row
+                assert row[2] in {task.target.render(sub_dct)} | {str(r) for r in range(5)}, row
+
+        num_rows = len(rating_rows) + len(review_rows)
+        print(f"per user: {legacy_time:.2f}s ({num_rows / legacy_time:.0f} prompts/s), "
+              f"batched: {batch_time:.2f}s ({num_rows / batch_time:.0f} prompts/s), speedup {legacy_time / batch_time:.2f}x")
@@ -0,0 +1,89 @@
+import json
+import random
+import asyncio
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from src.id_maps import IdMaps
+
+
+KINDS = ['rating', 'sequential', 'traditional', 'explanation']
+# yes/no templates, asked about the request's business_id (and rating)
+YES_NO_TEMPLATES = {'rating': ['11', '12', '13', '14'], 'sequential': ['24', '25', '26', '27', '28', '29']}
+
+
+def random_request(rng, id_maps, kind, num_candidates=20):
+    user = id_maps.users.to_raw(rng.randrange(len(id_maps.users)))
+    business = id_maps.items.to_raw(rng.randrange(len(id_maps.items)))
+    request = {'user_id': user, 'business_id': business}
+    if kind in ('sequential', 'traditional') and rng.random() < 0.5:
+        request['candidates'] = [id_maps.items.to_raw(rng.randrange(len(id_maps.items))) for _ in range(num_candidates)]
+    if kind == 'explanation' and rng.random() < 0.5:
+        request['feature'] = rng.choice(["food", "service", "price", "staff", "location"])
+    if kind in YES_NO_TEMPLATES and 'candidates' not in request and rng.random() < 0.25:
+        request['template'] = rng.choice(YES_NO_TEMPLATES[kind])
+        if kind == 'rating':
+            request['rating'] = float(rng.randint(1, 5))
+    return request
+
+
+async def call(reader, writer, method, path, body=None):
+    payload = b"" if body is None else json.dumps(body).encode('utf-8')
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def client(host, port, requests, latencies, statuses):
+    # one keep alive connection per client, requests are sent back to back
+    reader, writer = await asyncio.open_connection(host, port)
+    for kind, request in requests:
+        t = perf_counter()
+        status, _ = await call(reader, writer, 'POST', f"/{kind}", request)
+        latencies.append(perf_counter() - t)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    id_maps = IdMaps.load(args.id_maps_dir)
+    kinds = args.kinds
+    requests = [(kind, random_request(rng, id_maps, kind)) for kind in (rng.choice(kinds) for _ in range(args.requests))]
+    latencies, statuses = [], {}
+    t = perf_counter()
+    await asyncio.gather(*(
+        client(args.host, args.port, requests[i::args.concurrency], latencies, statuses) for i in range(args.concurrency)
+    ))
+    elapsed = perf_counter() - t
+    latencies = np.asarray(latencies) * 1000
+    print(f"{len(latencies)} requests, concurrency {args.concurrency}: {len(latencies) / elapsed:.1f} requests/s, "
+          f"client p50 {np.percentile(latencies, 50):.1f} ms, p99 {np.percentile(latencies, 99):.1f} ms, statuses {statuses}")
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await call(reader, writer, 'GET', "/metrics")
+    writer.close()
+    print(json.dumps(metrics, indent=4))
+
+
+if __name__ == "__main__":
+    # start the service first: python serve.py, then python -m benchmarks.load_generator --concurrency 32
+    parser = argparse.ArgumentParser(description="Concurrent load against the local recommendation service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--id-maps-dir", default="./data/id_maps")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--kinds", nargs="+", default=KINDS, choices=KINDS)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,109 @@
+import os
+import json
+import base64
+import pickle
+import hashlib
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+
+WORDS = ("food service great place staff friendly pizza burger coffee price time order table wait menu "
+         "delicious fresh nice bad slow clean drinks dinner lunch atmosphere music parking location").split()
+FEATURES = "food service pizza burger coffee price staff menu drinks atmosphere parking location".split()
+ADJECTIVES = "great friendly delicious fresh nice bad slow clean".split()
+CITIES = [("Las Vegas", "NV"), ("Phoenix", "AZ"), ("Toronto", "ON"), ("Charlotte", "NC"), ("Scottsdale", "AZ"), ("Pittsburgh", "PA")]
+
+
+def yelp_id(prefix, idx):
+    # 22 character url safe ids like the real dump, stable for a given (prefix, idx)
+    digest = hashlib.blake2b(f"{prefix}{idx}".encode('utf-8'), digest_size=16).digest()
+    return base64.urlsafe_b64encode(digest).decode('ascii')[:22]
+
+
+def power_law_weights(rng, n, alpha):
+    # pareto distributed activity, a few heavy users / popular businesses own most of the reviews
+    weights = rng.pareto(alpha, n) + 1.0
+    return weights / weights.sum()
+
+
+def _text(rng, mean_words):
+    return " ".join(rng.choice(WORDS, size=max(1, int(rng.exponential(mean_words)))).tolist())
+
+
+def generate_yelp(dir_path, num_users=1000, num_items=300, num_reviews=20000, min_date='2018-01-01 00:00:00',
+                  max_date='2019-12-31 23:59:59', user_alpha=1.2, item_alpha=1.1, feature_ratio=0.6, mean_words=60,
+                  seed=42, batch_size=100000):
+    # writes review.json, business.json, user_filtered.json (one json object per line, the yelp dump schema)
+    # and reviews_pickle.pickle (list of {'user', 'item', 'rating', 'review', 'sentence': [(feature, adj, text, polarity)]})
+    os.makedirs(dir_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    user_ids = [yelp_id("user", i) for i in range(num_users)]
+    item_ids = [yelp_id("business", i) for i in range(num_items)]
+
+    with open(os.path.join(dir_path, "business.json"), "w") as f:
+        for i, item_id in enumerate(item_ids):
+            city, state = CITIES[int(rng.integers(len(CITIES)))]
+            f.write(json.dumps({
+                'business_id': item_id, 'name': f"Business {i}", 'address': f"{i} Main St", 'city': city, 'state': state,
+                'postal_code': f"{10000 + i % 90000}", 'latitude': float(rng.uniform(30, 45)), 'longitude': float(rng.uniform(-120, -75)),
+                'stars': float(rng.integers(2, 11)) / 2, 'review_count': 0, 'is_open': 1, 'attributes': None,
+                'categories': "Restaurants, Food", 'hours': None,
+            }) + "\n")
+    with open(os.path.join(dir_path, "user_filtered.json"), "w") as f:
+        for i, user_id in enumerate(user_ids):
+            f.write(json.dumps({
+                'user_id': user_id, 'name': f"User{i}", 'review_count': 0, 'yelping_since': "2015-01-01 00:00:00",
+                'useful': 0, 'funny': 0, 'cool': 0, 'fans': 0, 'average_stars': 3.5,
+            }) + "\n")
+
+    user_p = power_law_weights(rng, num_users, user_alpha)
+    item_p = power_law_weights(rng, num_items, item_alpha)
+    start = datetime.strptime(min_date, '%Y-%m-%d %H:%M:%S').timestamp()
+    end = datetime.strptime(max_date, '%Y-%m-%d %H:%M:%S').timestamp()
+    features = []
+    with open(os.path.join(dir_path, "review.json"), "w") as f:
+        for batch_start in range(0, num_reviews, batch_size):
+            n = min(batch_size, num_reviews - batch_start)
+            users = rng.choice(num_users, size=n, p=user_p)
+            items = rng.choice(num_items, size=n, p=item_p)
+            stars = rng.choice([1.0, 2.0, 3.0, 4.0, 5.0], size=n, p=[0.1, 0.08, 0.12, 0.3, 0.4])
+            dates = rng.uniform(start, end, size=n)
+            with_features = rng.random(n) < feature_ratio
+            for j in range(n):
+                text = _text(rng, mean_words)
+                user_id, item_id = user_ids[users[j]], item_ids[items[j]]
+                f.write(json.dumps({
+                    'review_id': yelp_id("review", batch_start + j), 'user_id': user_id, 'business_id': item_id,
+                    'stars': float(stars[j]), 'useful': 0, 'funny': 0, 'cool': 0, 'text': text,
+                    'date': datetime.fromtimestamp(dates[j]).strftime('%Y-%m-%d %H:%M:%S'),
+                }) + "\n")
+                if with_features[j]:
+                    sentences = [
+                        (feature, str(rng.choice(ADJECTIVES)), f"the {feature} was {rng.choice(ADJECTIVES)}", int(rng.choice([-1, 1])))
+                        for feature in rng.choice(FEATURES, size=int(rng.integers(1, 4)), replace=False).tolist()
+                    ]
+                    features.append({'user': user_id, 'item': item_id, 'rating': float(stars[j]), 'review': text, 'sentence': sentences})
+
+    with open(os.path.join(dir_path, "reviews_pickle.pickle"), "wb") as f:
+        pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {'users': num_users, 'items': num_items, 'reviews': num_reviews, 'reviews_with_features': len(features)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic yelp shaped dataset")
+    parser.add_argument("dir_path")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--items", type=int, default=300)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--min-date", default='2018-01-01 00:00:00')
+    parser.add_argument("--max-date", default='2019-12-31 23:59:59')
+    parser.add_argument("--user-alpha", type=float, default=1.2)
+    parser.add_argument("--item-alpha", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    print(generate_yelp(
+        args.dir_path, args.users, args.items, args.reviews, args.min_date, args.max_date,
+        args.user_alpha, args.item_alpha, seed=args.seed,
+    ))
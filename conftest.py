@@ -0,0 +1,44 @@
+# the tests live next to their modules in src/ and import them as src.*, this file puts the repo root on sys.path
+import os
+
+import pytest
+
+from benchmarks.synthetic_yelp import generate_yelp
+
+
+@pytest.fixture(scope="session")
+def yelp_dir(tmp_path_factory):
+    # a small synthetic yelp dump, reviews in random date order over 2018-2019
+    dir_path = str(tmp_path_factory.mktemp("yelp"))
+    generate_yelp(dir_path, num_users=300, num_items=80, num_reviews=6000, mean_words=8, seed=7)
+    return dir_path
+
+
+@pytest.fixture
+def preparations(tmp_path):
+    # (PreDataPreparation, DataPreparation) reading raw_dir and writing everything under tmp_path / name
+    from src.pre_data_preparation import PreDataPreparation
+    from src.data_preparation import DataPreparation
+
+    def make(raw_dir, name="work"):
+        work_dir = os.path.join(tmp_path, name)
+        pre = PreDataPreparation()
+        pre.review_file_path = os.path.join(raw_dir, "review.json")
+        pre.user_file_path = os.path.join(raw_dir, "user_filtered.json")
+        pre.item_file_path = os.path.join(raw_dir, "business.json")
+        pre.review_with_features_file = os.path.join(raw_dir, "reviews_pickle.pickle")
+        pre.review_features_dir = os.path.join(work_dir, "review_features")
+        pre.final_pre_data_dir = os.path.join(work_dir, "final_pre_data")
+        pre.id_maps_dir = os.path.join(work_dir, "id_maps")
+        pre.spill_dir = os.path.join(work_dir, "spill")
+        pre.report_path = os.path.join(work_dir, "pre_data_preparation.json")
+        pre.min_date, pre.max_date = '2018-01-01 00:00:00', '2019-12-31 23:59:59'
+        prep = DataPreparation()
+        prep.final_pre_data_dir = pre.final_pre_data_dir
+        prep.id_maps_dir = pre.id_maps_dir
+        prep.output_dir = os.path.join(work_dir, "prompts")
+        prep.report_path = os.path.join(work_dir, "data_preparation.json")
+        prep.num_workers = 1
+        return pre, prep
+
+    return make
@@ -0,0 +1,33 @@
+import asyncio
+import argparse
+
+from transformers import T5Tokenizer, T5ForConditionalGeneration
+
+from src.id_maps import IdMaps
+from src.columnar import ColumnarPreData
+from src.quantization import QuantizedGenerator
+from src.serving import PromptRenderer, RecommendationService
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local micro-batching recommendation service on cpu")
+    parser.add_argument("--model", default="t5-small", help="model name or checkpoint dir")
+    parser.add_argument("--final-pre-data-dir", default="./data/final_pre_data")
+    parser.add_argument("--id-maps-dir", default="./data/id_maps")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-delay-ms", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--fp32", action="store_true", help="skip the dynamic int8 quantization")
+    args = parser.parse_args()
+
+    tokenizer = T5Tokenizer.from_pretrained(args.model)
+    model = T5ForConditionalGeneration.from_pretrained(args.model)
+    generator = QuantizedGenerator(
+        model, tokenizer, whole_word_embed=hasattr(model.encoder, 'whole_word_embeddings'),
+        quantize=not args.fp32, num_threads=args.threads,
+    )
+    renderer = PromptRenderer(IdMaps.load(args.id_maps_dir), ColumnarPreData(args.final_pre_data_dir))
+    service = RecommendationService(renderer, generator.generate, args.max_batch_size, args.max_delay_ms)
+    asyncio.run(service.serve(args.host, args.port))
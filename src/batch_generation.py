@@ -0,0 +1,115 @@
+import numpy as np
+
+from src.template_compiler import compiled_tasks, task_keys, DIRECT, YES_NO, LIKE_DISLIKE
+
+
+class InteractionColumns:
+    # the interactions of the users [start, end) as parallel lists, what flatten_dict gives per user but for a whole chunk
+
+    def __init__(self, whole_data, start, end):
+        offsets = whole_data.user_offsets[start:end + 1]
+        lo, hi = int(offsets[0]), int(offsets[-1])
+        user_pos = np.repeat(np.arange(end - start), np.diff(offsets)).tolist()
+        user_index = whole_data.user_index[start:end].tolist()
+        user_ids = ["user_" + str(i + 1) for i in user_index]
+        user_descs = [whole_data.user_desc[i] for i in range(start, end)]
+        # titles are decoded once per distinct item of the chunk
+        unique_items, item_pos = np.unique(whole_data.item_index[lo:hi], return_inverse=True)
+        item_titles = [whole_data.item_title[int(i)] for i in unique_items]
+        item_index = whole_data.item_index[lo:hi].tolist()
+        self.columns = {
+            'user_index': [user_index[p] for p in user_pos],
+            'user_id': [user_ids[p] for p in user_pos],
+            'user_desc': [user_descs[p] for p in user_pos],
+            'item_id': ["item_" + str(i + 1) for i in item_index],
+            'item_title': [item_titles[p] for p in item_pos.tolist()],
+            'rating': whole_data.rating[lo:hi].tolist(),
+            'review_body': whole_data.review.slice(lo, hi),
+        }
+
+    def __len__(self):
+        return len(self.columns['rating'])
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+
+def sample_distinct_pairs(rng, n, num_keys):
+    # two different template indices per row, every ordered pair equally likely like random.sample(keys, 2)
+    first = rng.integers(0, num_keys, size=n)
+    second = rng.integers(0, num_keys - 1, size=n)
+    second += second >= first
+    return first, second
+
+
+def perturb_ratings(rng, ratings):
+    # random.choice([i for i in range(0, 5) if i != rating]) for every rating at once
+    ratings = np.asarray(ratings, dtype=np.float64)
+    excluded = (ratings == np.floor(ratings)) & (ratings >= 0) & (ratings <= 4)
+    draws = np.floor(rng.random(len(ratings)) * (5 - excluded)).astype(np.int64)
+    draws += excluded & (draws >= ratings)
+    return draws.tolist()
+
+
+def render_rows(template, columns, rows):
+    # template.render for each row in rows, the field values are gathered column by column
+    if template.getter is None:
+        return [template.pattern] * len(rows)
+    field_values = [[columns[field][r] for r in rows] for field in template.fields]
+    pattern = template.pattern
+    return [pattern % values for values in zip(*field_values)]
+
+
+def rating_batch(columns, rng):
+    tasks = [compiled_tasks['rating'][key] for key in task_keys['rating']]
+    n = len(columns)
+    data_lst = [None] * (2 * n)
+    columns = columns.columns
+    ratings = columns['rating']
+    for slot, choice in enumerate(sample_distinct_pairs(rng, n, len(tasks))):
+        # gauss(50, 20) clipped to [0, 100] is above 50 with probability one half
+        yes = rng.random(n) < 0.5
+        is_yes_no = np.array([task.category == YES_NO for task in tasks])[choice]
+        no_rows = np.flatnonzero(is_yes_no & ~yes).tolist()
+        if no_rows:
+            # like the per user code, a "no" rating stays in place for the second template of the same interaction
+            ratings = list(ratings)
+            for r, rating in zip(no_rows, perturb_ratings(rng, [ratings[r] for r in no_rows])):
+                ratings[r] = rating
+        slot_columns = dict(columns, rating=ratings)
+
+        for t, task in enumerate(tasks):
+            rows = np.flatnonzero(choice == t).tolist()
+            if not rows:
+                continue
+            inp_texts = render_rows(task.source, slot_columns, rows)
+            if task.category == DIRECT:
+                out_texts = render_rows(task.target, slot_columns, rows)
+            elif task.category == YES_NO:
+                out_texts = ["yes" if yes[r] else "no" for r in rows]
+            elif task.category == LIKE_DISLIKE:
+                out_texts = ["like" if ratings[r] >= 4 else "dislike" for r in rows]
+            else:
+                out_texts = [""] * len(rows)
+            for r, inp_text, out_text in zip(rows, inp_texts, out_texts):
+                data_lst[2 * r + slot] = [task.task_desc, inp_text, out_text, task.metric]
+    return data_lst
+
+
+def review_batch(columns, rng):
+    tasks = [compiled_tasks['review'][key] for key in task_keys['review']]
+    columns = columns.columns
+    rows_with_review = [r for r, body in enumerate(columns['review_body']) if body != ""]
+    n = len(rows_with_review)
+    data_lst = [None] * (2 * n)
+    for slot, choice in enumerate(sample_distinct_pairs(rng, n, len(tasks))):
+        for t, task in enumerate(tasks):
+            positions = np.flatnonzero(choice == t).tolist()
+            if not positions:
+                continue
+            rows = [rows_with_review[p] for p in positions]
+            inp_texts = render_rows(task.source, columns, rows)
+            out_texts = render_rows(task.target, columns, rows)
+            for p, inp_text, out_text in zip(positions, inp_texts, out_texts):
+                data_lst[2 * p + slot] = [task.task_desc, inp_text, out_text, task.metric]
+    return data_lst
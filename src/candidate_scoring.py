@@ -0,0 +1,115 @@
+from collections import OrderedDict
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from src.token_cache import calculate_whole_word_ids
+
+
+class EncoderCache:
+    # LRU bounded text -> encoder hidden states (length x d_model, no padding)
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class CandidateScorer:
+    # scores yes/no candidate prompts with one teacher forced decoder pass for the answer instead of generate,
+    # encoder states come from an LRU cache so a text is encoded at most once while it stays in the cache.
+    # score() is exact: the encoder is bidirectional, so a yes/no prompt that names its candidate has states that
+    # depend on the candidate everywhere and only identical prompts can share them. score_candidates() shares the
+    # user context across candidates, which is faster but not the model's score of the full prompt
+
+    def __init__(self, model, tokenizer, cache_size=1024, answer="yes", max_text_length=256, whole_word_embed=True):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.cache = EncoderCache(cache_size)
+        self.max_text_length = max_text_length
+        self.whole_word_embed = whole_word_embed
+        self.device = next(model.parameters()).device
+        self.answer_ids = tokenizer(answer)['input_ids']
+        self.decoder_start_token_id = model.config.decoder_start_token_id
+
+    def _encode_batch(self, texts):
+        batch = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_text_length, return_tensors='pt')
+        input_ids, attention_mask = batch['input_ids'].to(self.device), batch['attention_mask'].to(self.device)
+        kwargs = {}
+        if self.whole_word_embed:
+            whole_word_ids = torch.full_like(batch['input_ids'], self.tokenizer.pad_token_id)
+            for i, mask in enumerate(batch['attention_mask']):
+                length = int(mask.sum())
+                tokens = self.tokenizer.convert_ids_to_tokens(batch['input_ids'][i, :length - 1].tolist())
+                whole_word_ids[i, :length] = torch.tensor(calculate_whole_word_ids(tokens, length))
+            kwargs['whole_word_ids'] = whole_word_ids.to(self.device)
+        hidden = self.model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True, **kwargs).last_hidden_state
+        lengths = attention_mask.sum(dim=1).tolist()
+        return [hidden[i, :length] for i, length in enumerate(lengths)]
+
+    def encode(self, texts):
+        states = [self.cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, state in zip(texts, states) if state is None))
+        if missing:
+            encoded = dict(zip(missing, self._encode_batch(missing)))
+            for text, state in encoded.items():
+                self.cache.put(text, state)
+            states = [encoded[text] if state is None else state for text, state in zip(texts, states)]
+        return states
+
+    def _answer_log_probs(self, states):
+        # log P(answer | encoder states) for every element of the batch, a single decoder forward pass
+        lengths = [len(state) for state in states]
+        hidden = torch.zeros(len(states), max(lengths), states[0].shape[-1], dtype=states[0].dtype, device=self.device)
+        attention_mask = torch.zeros(len(states), max(lengths), dtype=torch.long, device=self.device)
+        for i, state in enumerate(states):
+            hidden[i, :len(state)] = state
+            attention_mask[i, :len(state)] = 1
+        labels = torch.tensor([self.answer_ids] * len(states), device=self.device)
+        decoder_input_ids = torch.cat([torch.full_like(labels[:, :1], self.decoder_start_token_id), labels[:, :-1]], dim=1)
+        logits = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=hidden), attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids, return_dict=True,
+        ).logits
+        return torch.log_softmax(logits, dim=-1).gather(-1, labels.unsqueeze(-1)).squeeze(-1).sum(dim=1)
+
+    @torch.no_grad()
+    def score(self, prompts):
+        # exact: prompts are grouped by their encoder input, every distinct one is encoded once (one batch for the ones
+        # not in the cache) and all of them are scored in one decoder pass over encoder_outputs
+        distinct = list(dict.fromkeys(prompts))
+        scores = dict(zip(distinct, self._answer_log_probs(self.encode(distinct)).tolist()))
+        return [scores[prompt] for prompt in prompts]
+
+    @torch.no_grad()
+    def score_candidates(self, context, candidates):
+        # approximate, shared prefix: the user / history context is encoded once and joined with each separately encoded
+        # candidate, the decoder cross attends over both; the context states never see the candidate, so the scores
+        # differ from score() on the full prompts. benchmarks/bench_candidate_scoring.py reports how far, use it for
+        # long histories only where its top-1 agreement with score() is acceptable
+        context_state = self.encode([context])[0]
+        states = [torch.cat([context_state, candidate_state], dim=0) for candidate_state in self.encode(candidates)]
+        return self._answer_log_probs(states).tolist()
+
+    def rank(self, prompts, candidate_ids):
+        scores = self.score(prompts)
+        return sorted(zip(candidate_ids, scores), key=lambda x: -x[1])
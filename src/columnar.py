@@ -0,0 +1,159 @@
+import os
+import json
+import numpy as np
+
+from src.utils import save_string_table, load_string_table, ChainedStringTable
+from src.id_maps import IdMaps
+
+
+COLUMNAR_VERSION = 1
+
+
+def write_columnar(dir_path, user_item_interaction, id_maps, user_data_dct, item_data_dct):
+    # user_item_interaction: raw user -> [(item, time, rating, review, feature, explanation), ...]
+    # users and items are stored by their dense index, "user_N"/"item_N" are only rebuilt when a record is read
+    os.makedirs(dir_path, exist_ok=True)
+    num_items = len(id_maps.items)
+    item_raw = [id_maps.items.to_raw(i) for i in range(num_items)]
+
+    user_lookup = {id_maps.users.to_raw(i): i for i in range(len(id_maps.users))}
+    item_lookup = {raw: i for i, raw in enumerate(item_raw)}
+
+    user_raw, user_desc = [], []
+    user_index, user_offsets = [], [0]
+    item_index, visit_date, rating = [], [], []
+    review, review_feature, review_explanation = [], [], []
+    for user, records in user_item_interaction.items():
+        user_raw.append(user)
+        user_desc.append(user_data_dct[user]['user_desc'])
+        user_index.append(user_lookup[user])
+        for item, time, item_rating, user_review, feature, explanation in records:
+            item_index.append(item_lookup[item])
+            visit_date.append(time)
+            rating.append(item_rating)
+            review.append(user_review)
+            review_feature.append(feature)
+            review_explanation.append(explanation)
+        user_offsets.append(len(item_index))
+
+    np.save(os.path.join(dir_path, "user_index.npy"), np.asarray(user_index, dtype=np.int32))
+    np.save(os.path.join(dir_path, "user_offsets.npy"), np.asarray(user_offsets, dtype=np.int64))
+    np.save(os.path.join(dir_path, "item_index.npy"), np.asarray(item_index, dtype=np.int32))
+    np.save(os.path.join(dir_path, "visit_date.npy"), np.asarray(visit_date, dtype=np.int64))
+    np.save(os.path.join(dir_path, "rating.npy"), np.asarray(rating, dtype=np.float64))
+    save_string_table(dir_path, "user_raw", user_raw)
+    save_string_table(dir_path, "user_desc", user_desc)
+    save_string_table(dir_path, "item_raw", item_raw)
+    save_string_table(dir_path, "item_title", [item_data_dct[i]['item_desc'] for i in item_raw])
+    save_string_table(dir_path, "review", review)
+    save_string_table(dir_path, "review_feature", review_feature)
+    save_string_table(dir_path, "review_explanation", review_explanation)
+
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump({
+            'version': COLUMNAR_VERSION,
+            'num_users': len(user_raw),
+            'num_items': num_items,
+            'num_interactions': len(item_index),
+        }, f, indent=4)
+
+
+def write_columnar_segment(dir_path, columns, user_raw, user_desc, item_raw, item_title, num_items, item_tables=None):
+    # columnar files of some of the users, written straight from dense indices: columns holds user_index, user_offsets,
+    # item_index, visit_date, rating, review, review_feature and review_explanation. with item_tables the item tables
+    # only hold the items added with this segment, readers put them after those of the sibling segments it names
+    os.makedirs(dir_path, exist_ok=True)
+    np.save(os.path.join(dir_path, "user_index.npy"), np.asarray(columns['user_index'], dtype=np.int32))
+    np.save(os.path.join(dir_path, "user_offsets.npy"), np.asarray(columns['user_offsets'], dtype=np.int64))
+    np.save(os.path.join(dir_path, "item_index.npy"), np.asarray(columns['item_index'], dtype=np.int32))
+    np.save(os.path.join(dir_path, "visit_date.npy"), np.asarray(columns['visit_date'], dtype=np.int64))
+    np.save(os.path.join(dir_path, "rating.npy"), np.asarray(columns['rating'], dtype=np.float64))
+    for name in ['review', 'review_feature', 'review_explanation']:
+        save_string_table(dir_path, name, columns[name])
+    save_string_table(dir_path, "user_raw", user_raw)
+    save_string_table(dir_path, "user_desc", user_desc)
+    save_string_table(dir_path, "item_raw", item_raw)
+    save_string_table(dir_path, "item_title", item_title)
+
+    meta = {
+        'version': COLUMNAR_VERSION,
+        'num_users': len(user_raw),
+        'num_items': num_items,
+        'num_interactions': len(columns['item_index']),
+    }
+    if item_tables is not None:
+        meta['item_tables'] = item_tables
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def convert_json_to_columnar(final_pre_data_file_path, data_maps_file_path, dir_path):
+    # rebuilds the columnar files from an old final_pre_data.json + data_maps.json pair
+    with open(data_maps_file_path, "r") as f:
+        id_maps = IdMaps.from_data_maps(json.load(f))
+    with open(final_pre_data_file_path, "r") as f:
+        whole_data = json.load(f)
+
+    user_item_interaction, user_data_dct, item_data_dct = {}, {}, {}
+    for data_dct in whole_data:
+        user = data_dct['user_id1']
+        user_data_dct[user] = {'user_desc': data_dct['user_desc']}
+        for item, title in zip(data_dct['item_id_list1'], data_dct['item_title_list']):
+            item_data_dct[item] = {'item_desc': title}
+        user_item_interaction[user] = list(zip(
+            data_dct['item_id_list1'], data_dct['visit_date_list'], data_dct['rating_list'],
+            data_dct['review_list'], data_dct['review_feature_list'], data_dct['review_explanation_list']
+        ))
+    write_columnar(dir_path, user_item_interaction, id_maps, user_data_dct, item_data_dct)
+
+
+class ColumnarPreData:
+
+    def __init__(self, dir_path, mmap_mode='r'):
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.user_index = np.load(os.path.join(dir_path, "user_index.npy"), mmap_mode=mmap_mode)
+        self.user_offsets = np.load(os.path.join(dir_path, "user_offsets.npy"), mmap_mode=mmap_mode)
+        self.item_index = np.load(os.path.join(dir_path, "item_index.npy"), mmap_mode=mmap_mode)
+        self.visit_date = np.load(os.path.join(dir_path, "visit_date.npy"), mmap_mode=mmap_mode)
+        self.rating = np.load(os.path.join(dir_path, "rating.npy"), mmap_mode=mmap_mode)
+        self.user_raw = load_string_table(dir_path, "user_raw", mmap_mode)
+        self.user_desc = load_string_table(dir_path, "user_desc", mmap_mode)
+        self.item_raw = load_string_table(dir_path, "item_raw", mmap_mode)
+        self.item_title = load_string_table(dir_path, "item_title", mmap_mode)
+        if 'item_tables' in self.meta:
+            # a segment of the incremental updater only stores the items it added, the earlier ones are in its siblings
+            segments_dir = os.path.dirname(os.path.abspath(dir_path))
+            siblings = [os.path.join(segments_dir, name) for name in self.meta['item_tables']]
+            self.item_raw = ChainedStringTable([load_string_table(d, "item_raw", mmap_mode) for d in siblings] + [self.item_raw])
+            self.item_title = ChainedStringTable([load_string_table(d, "item_title", mmap_mode) for d in siblings] + [self.item_title])
+        self.review = load_string_table(dir_path, "review", mmap_mode)
+        self.review_feature = load_string_table(dir_path, "review_feature", mmap_mode)
+        self.review_explanation = load_string_table(dir_path, "review_explanation", mmap_mode)
+
+    def __len__(self):
+        return len(self.user_index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def record(self, idx):
+        # same keys as a row of the old final_pre_data.json, plus the dense item indices
+        start, end = int(self.user_offsets[idx]), int(self.user_offsets[idx + 1])
+        item_index = self.item_index[start:end].tolist()
+        return {
+            'user_id1': self.user_raw[idx],
+            'item_id_list1': [self.item_raw[i] for i in item_index],
+            'visit_date_list': self.visit_date[start:end].tolist(),
+            'rating_list': self.rating[start:end].tolist(),
+            'review_list': self.review.slice(start, end),
+            'review_feature_list': self.review_feature.slice(start, end),
+            'review_explanation_list': self.review_explanation.slice(start, end),
+            'user_id': "user_" + str(int(self.user_index[idx]) + 1),
+            'item_id_list': ["item_" + str(i + 1) for i in item_index],
+            'item_index_list': item_index,
+            'user_desc': self.user_desc[idx],
+            'item_title_list': [self.item_title[i] for i in item_index],
+        }
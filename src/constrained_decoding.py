@@ -0,0 +1,120 @@
+import torch
+
+from src.token_cache import calculate_whole_word_ids
+
+
+class ItemTrie:
+    # prefix trie over the token ids of "item_N" strings, every path ends with </s> and a leaf holding the item index
+
+    LEAF = -1
+
+    def __init__(self, eos_token_id):
+        self.eos_token_id = eos_token_id
+        self.root = {}
+        self.depth = 0
+
+    @classmethod
+    def build(cls, tokenizer, item_tokens, item_indices=None):
+        trie = cls(tokenizer.eos_token_id)
+        item_indices = range(len(item_tokens)) if item_indices is None else item_indices
+        for token_ids, item_index in zip(tokenizer(list(item_tokens))['input_ids'], item_indices):
+            trie.add(token_ids, item_index)
+        return trie
+
+    @classmethod
+    def from_id_maps(cls, id_maps, tokenizer):
+        return cls.build(tokenizer, [id_maps.items.token(i) for i in range(len(id_maps.items))])
+
+    def add(self, token_ids, item_index):
+        node = self.root
+        for token_id in token_ids:
+            node = node.setdefault(token_id, {})
+        node[self.LEAF] = item_index
+        self.depth = max(self.depth, len(token_ids))
+
+    def _node(self, token_ids):
+        node = self.root
+        for token_id in token_ids:
+            node = node.get(token_id)
+            if node is None:
+                return None
+        return node
+
+    def allowed(self, token_ids):
+        # next tokens that keep the prefix on a valid item id, a finished or invalid prefix can only be closed
+        node = self._node(token_ids)
+        if node is None:
+            return [self.eos_token_id]
+        allowed = [token_id for token_id in node if token_id != self.LEAF]
+        return allowed or [self.eos_token_id]
+
+    def item(self, token_ids):
+        node = self._node(token_ids)
+        return None if node is None else node.get(self.LEAF)
+
+
+class ConstrainedItemDecoder:
+    # beam search restricted to the item trie, many users' prompts go through generate as one batch
+
+    def __init__(self, model, tokenizer, trie, num_beams=20, max_text_length=256, whole_word_embed=True):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.trie = trie
+        self.num_beams = num_beams
+        self.max_text_length = max_text_length
+        self.whole_word_embed = whole_word_embed
+        self.device = next(model.parameters()).device
+
+    def _encode(self, inp_texts):
+        batch = self.tokenizer(inp_texts, padding=True, truncation=True, max_length=self.max_text_length, return_tensors='pt')
+        inputs = {'input_ids': batch['input_ids'].to(self.device), 'attention_mask': batch['attention_mask'].to(self.device)}
+        if self.whole_word_embed:
+            whole_word_ids = torch.full_like(batch['input_ids'], self.tokenizer.pad_token_id)
+            for i, mask in enumerate(batch['attention_mask']):
+                length = int(mask.sum())
+                tokens = self.tokenizer.convert_ids_to_tokens(batch['input_ids'][i, :length - 1].tolist())
+                whole_word_ids[i, :length] = torch.tensor(calculate_whole_word_ids(tokens, length))
+            inputs['whole_word_ids'] = whole_word_ids.to(self.device)
+        return inputs
+
+    def _candidate_trie(self, candidates):
+        # candidate prompts only allow the listed items, candidates are "item_N" tokens
+        item_indices = [int(token.rsplit('_', 1)[1]) - 1 for token in candidates]
+        return ItemTrie.build(self.tokenizer, candidates, item_indices)
+
+    @torch.no_grad()
+    def recommend(self, inp_texts, k=10, candidates=None):
+        # top k (item index, sequence score) per prompt, candidates optionally restricts each prompt to its own list
+        tries = [
+            self.trie if candidates is None or candidates[i] is None else self._candidate_trie(candidates[i])
+            for i in range(len(inp_texts))
+        ]
+        num_beams = max(self.num_beams, k)
+
+        def prefix_allowed_tokens_fn(batch_id, sent):
+            # sent starts with the decoder start token
+            return tries[batch_id].allowed(sent.tolist()[1:])
+
+        output = self.model.generate(
+            **self._encode(inp_texts),
+            num_beams=num_beams,
+            num_return_sequences=k,
+            max_length=max(trie.depth for trie in tries) + 1,
+            prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+            output_scores=True,
+            return_dict_in_generate=True,
+            early_stopping=True,
+        )
+        sequences = output.sequences.view(len(inp_texts), k, -1).tolist()
+        scores = output.sequences_scores.view(len(inp_texts), k).tolist()
+        results = []
+        for trie, user_sequences, user_scores in zip(tries, sequences, scores):
+            ranked, seen = [], set()
+            for sequence, score in zip(user_sequences, user_scores):
+                token_ids = [t for t in sequence[1:] if t != self.tokenizer.pad_token_id]
+                item_index = trie.item(token_ids)
+                if item_index is not None and item_index not in seen:
+                    seen.add(item_index)
+                    ranked.append((item_index, score))
+            results.append(ranked)
+        return results
@@ -1,67 +1,285 @@
+import os
 import random
-import pandas as pd
-from time import time 
+import numpy as np
+from time import time, perf_counter, process_time
 from tqdm import tqdm
-import concurrent.futures
-from sklearn.model_selection import train_test_split
+import multiprocessing
 
 from src.utils import *
-from src.data_templates import tasks
+from src.template_compiler import compiled_tasks, task_keys, JoinedPrefixes, DIRECT, YES_NO, LIKE_DISLIKE
+from src.columnar import ColumnarPreData, convert_json_to_columnar
+from src.id_maps import IdMaps, convert_data_maps_json
+from src.negative_sampling import NegativeSampler
+from src.output_writer import ShardedPromptWriter, iter_prompt_shards
+from src.batch_generation import InteractionColumns, rating_batch, review_batch
+from src.instrumentation import Instrumentation
+
+
+_WORKER_PREPARATION = None
+
+
+def _init_worker(preparation):
+    # every worker opens the memory mapped id maps and pre data itself, the pages are shared read-only through the os
+    global _WORKER_PREPARATION
+    _WORKER_PREPARATION = preparation
+    _WORKER_PREPARATION._load_state()
+
+
+def _generate_chunk(chunk):
+    return _WORKER_PREPARATION._generate_chunk(chunk)
 
 
 class DataPreparation:
 
-    def __init__(self):
+    ERROR_COUNTERS = ['sequential_error_cnt', 'review_error_cnt', 'traditional_error_cnt', 'explanation_error_cnt', 'rating_error_cnt']
+
+    def __init__(self, profile=False, trace_memory=False):
         self.final_pre_data_file_path = "./data/final_pre_data.json"
+        self.final_pre_data_dir = "./data/final_pre_data"
         self.data_maps_file_path = "./data/data_maps.json"
-        self.data_maps = None
+        self.id_maps_dir = "./data/id_maps"
+        self.id_maps = None
+        self.whole_data = None
+        self.negative_sampler = None
+        self.batch_rng = None
+        self.negative_sampling_size = 50
+        # 'uniform' or 'popularity', popularity draws negatives proportional to their interaction count
+        self.negative_sampling = 'uniform'
+        self.seed = 42
         self.sequential_error_cnt = 0
         self.review_error_cnt = 0
         self.traditional_error_cnt = 0
         self.explanation_error_cnt = 0
         self.rating_error_cnt = 0
-        self.num_threads = 8
-        self.train_data_path = "./data/train_data.json"
-        self.test_data_path = "./data/test_data.json"
-
-
-    def data_preparation(self):
-        final_data_lst = []
-
-        with open(self.data_maps_file_path, "r") as f:
-            self.data_maps = json.load(f)
-        whole_data = pd.read_json(self.final_pre_data_file_path).to_dict(orient="records")
-        # whole_data = whole_data[:100]
-
-        functions_to_run = [
+        # a few error messages per counter are kept for the run report
+        self.error_samples = {}
+        # per stage / task family timings, rss and errors, written as json after a run, optionally with a cProfile dump and
+        # the tracemalloc peak of every stage
+        self.instrumentation = Instrumentation(profile=profile, trace_memory=trace_memory)
+        self.report_path = "./data/reports/data_preparation.json"
+        # prompts are generated by worker processes, each one handles chunk_size users at a time for all five task families
+        self.num_workers = 8
+        self.chunk_size = 256
+        # the rating and review families are generated for a whole chunk of interactions at once with numpy draws
+        self.batch_generation = True
+        # train/test prompts are written as rotating jsonl shards plus a manifest.json
+        self.output_dir = "./data/prompts"
+        self.test_size = 0.2
+        self.shard_size = 500000
+        self.compress_output = False
+        # every prompt row also records the dense index of its user, the incremental updater drops superseded rows by it
+        self.tag_users = False
+
+
+    def __getstate__(self):
+        # workers reload the memory mapped state themselves instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['id_maps'] = None
+        state['whole_data'] = None
+        state['negative_sampler'] = None
+        state['batch_rng'] = None
+        state['instrumentation'] = None
+        return state
+
+
+    def _load_state(self):
+        self.id_maps = self._load_id_maps()
+        self.whole_data = self._load_whole_data()
+        self.negative_sampler = self._get_negative_sampler(self.whole_data)
+
+
+    def _task_functions(self):
+        return [
             self._rating_data_preparation,
             self._sequential_data_preparation,
             self._explanation_data_preparation,
             self._review_data_preparation,
             self._traditional_data_preparation
         ]
-        for func in functions_to_run:
-            prev_len = len(final_data_lst)
-            t1 = time()
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-                futures = [executor.submit(func, data_dct) for data_dct in whole_data]
-                results = []
-                for future in tqdm(concurrent.futures.as_completed(futures), total=len(whole_data), desc=f"Running {func.__name__}"):
-                    results.extend(future.result())
-                final_data_lst.extend(results)
-            t2 = time()
-            print(f"{func.__name__}: Time: {t2 - t1:.2f}s, Length: {len(final_data_lst) - prev_len}")
 
+
+    def _batch_task_functions(self):
+        # replacements for per user task functions, keyed by the name of the function they replace
+        if not self.batch_generation:
+            return {}
+        return {
+            '_rating_data_preparation': self._rating_batch_preparation,
+            '_review_data_preparation': self._review_batch_preparation,
+        }
+
+
+    def _record_error(self, counter, e):
+        print(str(e))
+        setattr(self, counter, getattr(self, counter) + 1)
+        samples = self.error_samples.setdefault(counter, [])
+        if len(samples) < 5:
+            samples.append(f"{type(e).__name__}: {e}")
+
+
+    def _generate_chunk(self, chunk):
+        # seeding per chunk keeps the output independent of the number of workers
+        chunk_idx, start, end = chunk
+        random.seed(self.seed * 1000003 + chunk_idx)
+        self.negative_sampler.reseed([self.seed, chunk_idx])
+        self.batch_rng = np.random.default_rng([self.seed, chunk_idx, 1])
+        for counter in self.ERROR_COUNTERS:
+            setattr(self, counter, 0)
+        self.error_samples = {}
+
+        results = {func.__name__: [] for func in self._task_functions()}
+        row_users = {func.__name__: [] for func in self._task_functions()} if self.tag_users else None
+        # wall / cpu seconds per task family, measured inside the worker
+        timings = {func.__name__: [0.0, 0.0] for func in self._task_functions()}
+        batch_functions = self._batch_task_functions()
+        user_functions = [func for func in self._task_functions() if func.__name__ not in batch_functions]
+        for idx in range(start, end):
+            data_dct = self.whole_data.record(idx)
+            for func in user_functions:
+                wall, cpu = perf_counter(), process_time()
+                data_lst = func(data_dct)
+                results[func.__name__].extend(data_lst)
+                if row_users is not None:
+                    row_users[func.__name__].extend([int(self.whole_data.user_index[idx])] * len(data_lst))
+                timings[func.__name__][0] += perf_counter() - wall
+                timings[func.__name__][1] += process_time() - cpu
+        if batch_functions:
+            columns = InteractionColumns(self.whole_data, start, end)
+            for func_name, func in batch_functions.items():
+                wall, cpu = perf_counter(), process_time()
+                results[func_name] = func(columns)
+                if row_users is not None:
+                    row_users[func_name] = self._batch_row_users(func_name, columns, results[func_name])
+                timings[func_name][0] += perf_counter() - wall
+                timings[func_name][1] += process_time() - cpu
+        error_counts = {counter: getattr(self, counter) for counter in self.ERROR_COUNTERS}
+        stats = {'timings': timings, 'error_samples': self.error_samples, 'row_users': row_users}
+        return results, error_counts, stats
+
+
+    def _batch_row_users(self, func_name, columns, data_lst):
+        # the batch functions give two rows per interaction in interaction order, the review family only for the
+        # interactions with a review and no rows at all after an error
+        if not data_lst:
+            return []
+        interactions = range(len(columns))
+        if func_name == '_review_data_preparation':
+            interactions = [r for r, body in enumerate(columns['review_body']) if body != ""]
+        return [columns['user_index'][r] for r in interactions for _ in range(2)]
+
+
+    def _chunks(self):
+        num_users = len(self.whole_data)
+        return [(i, start, min(start + self.chunk_size, num_users)) for i, start in enumerate(range(0, num_users, self.chunk_size))]
+
+
+    def _iter_generated_chunks(self):
+        chunks = self._chunks()
+        if self.num_workers <= 1:
+            for chunk in chunks:
+                yield self._generate_chunk(chunk)
+            return
+        with multiprocessing.Pool(self.num_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            yield from pool.imap(_generate_chunk, chunks)
+
+
+    def _write_prompts(self, writer, split=None, stage='prompt_gen'):
+        self._load_state()
+        family_lengths = {func.__name__: 0 for func in self._task_functions()}
+        error_totals = {counter: 0 for counter in self.ERROR_COUNTERS}
+
+        t1 = time()
+        with self.instrumentation.stage(stage) as counters, tqdm(total=len(self.whole_data), desc="Generating prompts") as pbar:
+            for (results, error_counts, stats), (_, start, end) in zip(self._iter_generated_chunks(), self._chunks()):
+                for func_name, data_lst in results.items():
+                    family_lengths[func_name] += len(data_lst)
+                    writer.write_many(data_lst, split, stats['row_users'][func_name] if stats['row_users'] else None)
+                    wall_time, cpu_time = stats['timings'][func_name]
+                    family = func_name.replace('_data_preparation', '').lstrip('_')
+                    self.instrumentation.add_family(stage, family, wall_time, cpu_time, end - start, len(data_lst))
+                for counter, cnt in error_counts.items():
+                    error_totals[counter] += cnt
+                    if cnt:
+                        self.instrumentation.add_errors(stage, counter, cnt, stats['error_samples'].get(counter, []))
+                pbar.update(end - start)
+            counters['records_in'] = len(self.whole_data)
+            counters['records_out'] = sum(family_lengths.values())
+        t2 = time()
+        for counter, cnt in error_totals.items():
+            setattr(self, counter, cnt)
+
+        for func_name, length in family_lengths.items():
+            print(f"{func_name}: Length: {length}")
         print(self.sequential_error_cnt, self.review_error_cnt, self.traditional_error_cnt, self.explanation_error_cnt, self.rating_error_cnt)
-        print(f"Total data length: {len(final_data_lst)}")
+        total_length = sum(family_lengths.values())
+        print(f"Total data length: {total_length}, Time: {t2 - t1:.2f}s, {total_length / max(t2 - t1, 1e-9):.0f} prompts/s")
+
+
+    def data_preparation(self):
+        writer = ShardedPromptWriter(self.output_dir, self.test_size, self.shard_size, self.compress_output, self.seed)
+        self._write_prompts(writer)
+        manifest = writer.close()
+        rows = {split: info['rows'] for split, info in manifest['splits'].items()}
+        print(f"Train: {rows.get('train', 0)}, Test: {rows.get('test', 0)}, written to {self.output_dir}")
+        print("Run report written to", self.instrumentation.save(self.report_path))
 
-        df = pd.DataFrame(final_data_lst, columns=['task_desc', 'inp_text', 'out_text', 'metric'])
-        train, test = train_test_split(df, test_size=0.2, stratify=df['task_desc'])
-        train.to_json(self.train_data_path, orient="records", default_handler=str)
-        test.to_json(self.test_data_path, orient="records", default_handler=str)
+
+    def generate_prompts(self, dir_path):
+        # the whole corpus goes into a single 'all' split, split_prompts assigns train/test afterwards
+        writer = ShardedPromptWriter(dir_path, shard_size=self.shard_size, compress=self.compress_output)
+        self._write_prompts(writer, split='all')
+        return writer.close()
+
+
+    def split_prompts(self, input_dir, dir_path):
+        writer = ShardedPromptWriter(dir_path, self.test_size, self.shard_size, self.compress_output, self.seed)
+        with self.instrumentation.stage('split') as counters:
+            for row in iter_prompt_shards(input_dir, 'all'):
+                writer.write(row['task_desc'], row['inp_text'], row['out_text'], row['metric'])
+                counters['records_in'] += 1
+            counters['records_out'] = counters['records_in']
+        return writer.close()
+
+
+    def _load_id_maps(self):
+        if not IdMaps.exists(self.id_maps_dir):
+            print("Converting", self.data_maps_file_path, "to", self.id_maps_dir)
+            convert_data_maps_json(self.data_maps_file_path, self.id_maps_dir)
+        return IdMaps.load(self.id_maps_dir)
+
+
+    def _get_negative_sampler(self, whole_data):
+        weights = None
+        if self.negative_sampling == 'popularity':
+            weights = np.bincount(whole_data.item_index, minlength=len(self.id_maps.items))
+        return NegativeSampler(len(self.id_maps.items), weights=weights, seed=self.seed)
+
+
+    def _sample_negative_ids(self, k, item_index_list):
+        return [self.id_maps.items.token(i) for i in self.negative_sampler.sample(k, set(item_index_list))]
+
+
+    def _load_whole_data(self):
+        # older runs only produced final_pre_data.json, convert it once and use the columnar files from then on
+        if not os.path.exists(os.path.join(self.final_pre_data_dir, "meta.json")):
+            print("Converting", self.final_pre_data_file_path, "to", self.final_pre_data_dir)
+            convert_json_to_columnar(self.final_pre_data_file_path, self.data_maps_file_path, self.final_pre_data_dir)
+        return ColumnarPreData(self.final_pre_data_dir)
+
+
+    def _rating_batch_preparation(self, columns):
+        return rating_batch(columns, self.batch_rng)
+
+
+    def _review_batch_preparation(self, columns):
+        try:
+            return review_batch(columns, self.batch_rng)
+        except Exception as e:
+            self._record_error('review_error_cnt', e)
+            return []
 
 
     def _traditional_data_preparation(self, data_dct):
+        item_index_list = data_dct['item_index_list']
         data_dct = {
             'user_id': data_dct['user_id'],
             'user_desc': data_dct['user_desc'],
@@ -73,9 +291,10 @@ class DataPreparation:
 
         try:
             for sub_dct in flattened_dct:
-                random_keys = random.sample(list(tasks['traditional'].keys()), 3)
+                random_keys = random.sample(task_keys['traditional'], 3)
                 for sub_task_key in random_keys:
-                    if 0 <= int(sub_task_key) <= 15:
+                    task = compiled_tasks['traditional'][sub_task_key]
+                    if task.category == YES_NO:
                         choice_bet_yes_no = max(0, min(100, random.gauss(mu=50, sigma=20)))
                         if choice_bet_yes_no >= 50:
                             random_idx = random.choice(range(0, len(data_dct['item_id_list']) - 1))
@@ -83,25 +302,22 @@ class DataPreparation:
                             sub_dct['candidate_item_title'] = data_dct['item_title_list'][random_idx]
                             out_text = "yes"
                         else:
-                            random_item_id = random.choice(list(set(self.data_maps['id2item'].keys()) - set(data_dct['item_id_list'])))
-                            sub_dct['candidate_item_id'] = random_item_id
-                            sub_dct['candidate_item_title'] = self.data_maps['id2item'][random_item_id]
+                            random_item_idx = self.negative_sampler.sample(1, set(item_index_list))[0]
+                            sub_dct['candidate_item_id'] = self.id_maps.items.token(random_item_idx)
+                            sub_dct['candidate_item_title'] = self.id_maps.items.to_raw(random_item_idx)
                             out_text = "no"
                     else:
-                        random_pos_to_add_the_target_item = random.randint(0, 49)
-                        candidate_item_id_list = random.sample(list(set(self.data_maps['id2item'].keys()) - set(data_dct['item_id_list'])), 50)
+                        random_pos_to_add_the_target_item = random.randint(0, self.negative_sampling_size - 1)
+                        candidate_item_id_list = self._sample_negative_ids(self.negative_sampling_size, item_index_list)
                         sub_dct['target_item_id'] = sub_dct['item_id_list']
                         candidate_item_id_list.insert(random_pos_to_add_the_target_item, sub_dct['target_item_id'])
                         sub_dct['candiate_item_id_list'] = "{" + "--".join(candidate_item_id_list) + "}"
-                        out_text = tasks['traditional'][sub_task_key][1].format(**sub_dct)
+                        out_text = task.target.render(sub_dct)
 
-                    # print(sub_dct)
-                    inp_text = tasks['traditional'][sub_task_key][0].format(**sub_dct)
-                    metric = tasks['traditional'][sub_task_key][2]
-                    data_lst.append(['traditional_' + sub_task_key, inp_text, out_text, metric])
+                    inp_text = task.source.render(sub_dct)
+                    data_lst.append([task.task_desc, inp_text, out_text, task.metric])
         except Exception as e:
-            print(str(e))
-            self.traditional_error_cnt += 1
+            self._record_error('traditional_error_cnt', e)
 
         return data_lst
 
@@ -120,15 +336,12 @@ class DataPreparation:
             for sub_dct in flattened_dct:
                 if sub_dct['review_body'] == "":
                     continue
-                random_keys = random.sample(list(tasks['review'].keys()), 2)
+                random_keys = random.sample(task_keys['review'], 2)
                 for sub_task_key in random_keys:
-                    inp_text = tasks['review'][sub_task_key][0].format(**sub_dct)
-                    out_text = tasks['review'][sub_task_key][1].format(**sub_dct)
-                    metric = tasks['review'][sub_task_key][2]
-                    data_lst.append(['review_' + sub_task_key, inp_text, out_text, metric])
+                    task = compiled_tasks['review'][sub_task_key]
+                    data_lst.append([task.task_desc, task.source.render(sub_dct), task.target.render(sub_dct), task.metric])
         except Exception as e:
-            print(str(e))
-            self.review_error_cnt += 1
+            self._record_error('review_error_cnt', e)
 
         return data_lst
 
@@ -150,20 +363,18 @@ class DataPreparation:
             for sub_dct in flattened_dct:
                 if sub_dct['explanation'] == "" or sub_dct['feature'] == "":
                     continue
-                random_keys = random.sample(list(tasks['explanation'].keys()), 3)
+                random_keys = random.sample(task_keys['explanation'], 3)
                 for sub_task_key in random_keys:
-                    inp_text = tasks['explanation'][sub_task_key][0].format(**sub_dct)
-                    out_text = tasks['explanation'][sub_task_key][1].format(**sub_dct)
-                    metric = tasks['explanation'][sub_task_key][2]
-                    data_lst.append(['explanation_' + sub_task_key, inp_text, out_text, metric])
+                    task = compiled_tasks['explanation'][sub_task_key]
+                    data_lst.append([task.task_desc, task.source.render(sub_dct), task.target.render(sub_dct), task.metric])
         except Exception as e:
-            print(str(e))
-            self.explanation_error_cnt += 1
+            self._record_error('explanation_error_cnt', e)
 
         return data_lst
 
 
     def _sequential_data_preparation(self, data_dct):
+        item_index_list = data_dct['item_index_list']
         data_dct = {
             'user_id': data_dct['user_id'],
             'user_desc': data_dct['user_desc'],
@@ -172,46 +383,47 @@ class DataPreparation:
             'original_item_id_list': data_dct['item_id_list'],
             'original_item_title_list': data_dct['item_title_list']
         }
+        # the history strings for every prefix length come from one join per user
+        item_id_prefixes = JoinedPrefixes(data_dct['original_item_id_list'])
+        item_title_prefixes = JoinedPrefixes(data_dct['original_item_title_list'])
 
         # out of all the items visited by the user, we will select 80% to 90% as the visit history, next item will be the target
         # incase where we need candidates, we will use same 80% to 90% as visit history, next item + another randomly selected 50 items for candidates
-        random_keys = random.sample(list(tasks['sequential'].keys()), 5)
+        random_keys = random.sample(task_keys['sequential'], 5)
         data_lst = []
-        # random_keys = tasks['sequential'].keys()
 
         try:
             for sub_task_key in random_keys:
+                task = compiled_tasks['sequential'][sub_task_key]
                 min_frac, max_frac = 0.7, 0.95
                 min_size = int(min_frac * len(data_dct['original_item_id_list']))
                 max_size = int(max_frac * len(data_dct['original_item_id_list']))
                 selected_size = random.randint(min_size, max_size)
 
-                data_dct['item_id_list'] = "{" + "--".join(data_dct['original_item_id_list'][:selected_size]) + "}"
-                data_dct['item_title_list'] = "{" + "--".join(data_dct['original_item_title_list'][:selected_size]) + "}"
+                data_dct['item_id_list'] = item_id_prefixes.braced(selected_size)
+                data_dct['item_title_list'] = item_title_prefixes.braced(selected_size)
                 data_dct['target_item_id'] = data_dct['original_item_id_list'][selected_size]
                 data_dct['target_item_title'] = data_dct['original_item_title_list'][selected_size]
 
-                random_pos_to_add_the_target_item = random.randint(0, 49)
-                candidate_item_id_list = random.sample(list(set(self.data_maps['id2item'].keys()) - set(data_dct['original_item_id_list'])), 50)
+                random_pos_to_add_the_target_item = random.randint(0, self.negative_sampling_size - 1)
+                candidate_item_id_list = self._sample_negative_ids(self.negative_sampling_size, item_index_list)
                 candidate_item_id_list.insert(random_pos_to_add_the_target_item, data_dct['target_item_id'])
                 data_dct['candiate_item_id_list'] = "{" + "--".join(candidate_item_id_list) + "}"
 
-                inp_text = tasks['sequential'][sub_task_key][0].format(**data_dct)
-                if 24 <= int(sub_task_key) <= 29:
+                inp_text = task.source.render(data_dct)
+                if task.category == YES_NO:
                     choice_bet_yes_no = max(0, min(100, random.gauss(mu=50, sigma=20)))
                     if choice_bet_yes_no > 50:
                         out_text = "yes"
                     else:
-                        data_dct['target_item_id'] = random.choice(list(set(self.data_maps['id2item'].keys()) - set(data_dct['original_item_id_list'])))
+                        data_dct['target_item_id'] = self._sample_negative_ids(1, item_index_list)[0]
                         out_text = "no"
                 else:
-                    out_text = tasks['sequential'][sub_task_key][1].format(**data_dct)
-                metric = tasks['sequential'][sub_task_key][2]
-                data_lst.append(['sequential_' + sub_task_key, inp_text, out_text, metric])
+                    out_text = task.target.render(data_dct)
+                data_lst.append([task.task_desc, inp_text, out_text, task.metric])
 
         except Exception as e:
-            print(str(e))
-            self.sequential_error_cnt += 1
+            self._record_error('sequential_error_cnt', e)
 
         return data_lst
 
@@ -230,22 +442,22 @@ class DataPreparation:
 
         data_lst = []
         for sub_dct in flattened_dct:
-            random_keys = random.sample(list(tasks['rating'].keys()), 2)
+            random_keys = random.sample(task_keys['rating'], 2)
             out_text = ""
             for sub_task_key in random_keys:
-                if 0 <= int(sub_task_key) <= 10:
-                    out_text = tasks['rating'][sub_task_key][1].format(**sub_dct)
-                elif 11 <= int(sub_task_key) <= 14:
+                task = compiled_tasks['rating'][sub_task_key]
+                if task.category == DIRECT:
+                    out_text = task.target.render(sub_dct)
+                elif task.category == YES_NO:
                     choice_bet_yes_no = max(0, min(100, random.gauss(mu=50, sigma=20)))
                     if choice_bet_yes_no > 50:
                         out_text = "yes"
                     else:
                         sub_dct['rating'] = random.choice([i for i in range(0, 5) if i != sub_dct['rating']])
                         out_text = "no"
-                elif 15 <= int(sub_task_key) <= 18:
+                elif task.category == LIKE_DISLIKE:
                     out_text = "like" if sub_dct['rating'] >= 4 else "dislike"
-                inp_text = tasks['rating'][sub_task_key][0].format(**sub_dct)
-                metric = tasks['rating'][sub_task_key][2]
-                data_lst.append(['rating_' + sub_task_key, inp_text, out_text, metric])
+                inp_text = task.source.render(sub_dct)
+                data_lst.append([task.task_desc, inp_text, out_text, task.metric])
 
-        return data_lst
\ No newline at end of file
+        return data_lst
@@ -0,0 +1,268 @@
+import os
+import gzip
+import json
+import math
+import multiprocessing
+from collections import Counter, defaultdict
+from itertools import zip_longest
+import numpy as np
+
+from src.metrics import target_ranks, ranking_metrics
+from src.output_writer import iter_prompt_shards
+from src.template_compiler import compiled_tasks
+
+
+ACCURACY = 'accuracy'
+RANKING = 'HR, NDCG, MRR'
+# spelled like this in data_templates.tasks
+TEXT = 'BLUE, ROUGE'
+BLEU_ORDER = 4
+_MISSING = object()
+
+
+def iter_predictions(path):
+    # one json object per test row, in the order of the test shards: {"prediction": "..."} or, for the ranking
+    # sub tasks, {"predictions": [best, second, ...]} with the beam outputs best first
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            yield row['predictions'] if 'predictions' in row else row['prediction']
+
+
+def _tokens(text):
+    return text.lower().split()
+
+
+def _ngrams(tokens, n):
+    return Counter(tuple(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+
+
+def _lcs(a, b):
+    if len(a) < len(b):
+        a, b = b, a
+    previous = [0] * (len(b) + 1)
+    for x in a:
+        current = [0]
+        for j, y in enumerate(b):
+            current.append(previous[j] + 1 if x == y else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+def _f1(overlap, hyp_total, ref_total):
+    if overlap == 0:
+        return 0.0
+    precision, recall = overlap / hyp_total, overlap / ref_total
+    return 2 * precision * recall / (precision + recall)
+
+
+def text_stats(pairs):
+    # additive statistics of (hypothesis, reference) pairs: clipped n-gram matches and totals for corpus BLEU,
+    # summed ROUGE-1 / ROUGE-2 / ROUGE-L F1, so batches from any worker can simply be added up
+    stats = np.zeros(2 * BLEU_ORDER + 5)
+    for hypothesis, reference in pairs:
+        hyp, ref = _tokens(hypothesis), _tokens(reference)
+        for n in range(1, BLEU_ORDER + 1):
+            overlap = sum((_ngrams(hyp, n) & _ngrams(ref, n)).values())
+            stats[n - 1] += overlap
+            stats[BLEU_ORDER + n - 1] += max(len(hyp) - n + 1, 0)
+            if n <= 2:
+                stats[2 * BLEU_ORDER + 1 + n] += _f1(overlap, max(len(hyp) - n + 1, 0), max(len(ref) - n + 1, 0))
+        stats[2 * BLEU_ORDER] += len(ref)
+        stats[2 * BLEU_ORDER + 1] += len(hyp)
+        stats[2 * BLEU_ORDER + 4] += _f1(_lcs(hyp, ref), len(hyp), len(ref))
+    return stats
+
+
+def bleu_rouge(stats, count):
+    matches, totals = stats[:BLEU_ORDER], stats[BLEU_ORDER:2 * BLEU_ORDER]
+    ref_length, hyp_length = stats[2 * BLEU_ORDER], stats[2 * BLEU_ORDER + 1]
+    if matches.min() == 0 or hyp_length == 0:
+        bleu = 0.0
+    else:
+        brevity = 1.0 if hyp_length > ref_length else math.exp(1 - ref_length / hyp_length)
+        bleu = brevity * math.exp(np.log(matches / totals).mean())
+    count = max(count, 1)
+    return {
+        'BLEU-4': 100 * bleu,
+        'ROUGE-1': 100 * stats[2 * BLEU_ORDER + 2] / count,
+        'ROUGE-2': 100 * stats[2 * BLEU_ORDER + 3] / count,
+        'ROUGE-L': 100 * stats[2 * BLEU_ORDER + 4] / count,
+    }
+
+
+def _to_float(values):
+    out = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        try:
+            out[i] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return out
+
+
+class SubTaskAccumulator:
+    # running sums for one task_desc, mergeable, so a family total is the merge of its sub tasks
+
+    def __init__(self, metric, ks):
+        self.metric = metric
+        self.ks = ks
+        self.sums = defaultdict(float)
+        self.text = np.zeros(2 * BLEU_ORDER + 5)
+
+    def merge(self, other):
+        for key, value in other.sums.items():
+            self.sums[key] += value
+        self.text += other.text
+
+    def add_accuracy(self, predictions, targets):
+        predictions = [p[0] if isinstance(p, list) else p for p in predictions]
+        exact = np.asarray([p.strip().lower() == t.strip().lower() for p, t in zip(predictions, targets)])
+        predicted, expected = _to_float(predictions), _to_float(targets)
+        numeric = ~np.isnan(expected)
+        valid = numeric & ~np.isnan(predicted)
+        # numeric targets (ratings) also count as correct when the values match, "4" == "4.0"
+        correct = exact | (valid & (predicted == expected))
+        errors = predicted[valid] - expected[valid]
+        self.sums['scored'] += len(targets)
+        self.sums['correct'] += int(correct.sum())
+        self.sums['numeric'] += int(numeric.sum())
+        self.sums['numeric_valid'] += int(valid.sum())
+        self.sums['squared_error'] += float((errors ** 2).sum())
+        self.sums['absolute_error'] += float(np.abs(errors).sum())
+
+    def add_text(self, stats, count):
+        self.text += stats
+        self.sums['count'] += count
+
+    def add_ranking(self, predictions, targets):
+        ranked = [p if isinstance(p, list) else [p] for p in predictions]
+        metrics = ranking_metrics(target_ranks(ranked, targets), self.ks)
+        self.sums['count'] += len(targets)
+        for name, value in metrics.items():
+            self.sums[name] += value * len(targets)
+
+    def report(self):
+        count = self.sums['count']
+        report = {'metric': self.metric, 'count': int(count)}
+        if count == 0:
+            return report
+        if self.sums['scored']:
+            # for the text sub tasks this covers the leading rating of "{rating}, {explanation}" targets only
+            report['accuracy'] = self.sums['correct'] / self.sums['scored']
+        if self.sums['numeric']:
+            valid = max(self.sums['numeric_valid'], 1)
+            report['RMSE'] = math.sqrt(self.sums['squared_error'] / valid)
+            report['MAE'] = self.sums['absolute_error'] / valid
+            # predictions that could not be parsed as a number are left out of RMSE / MAE
+            report['invalid'] = int(self.sums['numeric'] - self.sums['numeric_valid'])
+        if self.metric == RANKING:
+            report.update({name: self.sums[name] / count for name in ranking_metrics([], self.ks)})
+        if self.metric == TEXT:
+            report.update(bleu_rouge(self.text, count))
+        return report
+
+
+class Evaluator:
+    # streams the test shards and the predictions side by side and scores them per task_desc: exact match accuracy,
+    # RMSE / MAE for numeric targets, HR@k / NDCG@k / MRR over ranked lists and BLEU / ROUGE for the text sub tasks,
+    # numbers are computed per batch with numpy, the text statistics in a pool of num_workers processes
+
+    def __init__(self, batch_size=4096, num_workers=4, ks=(1, 5, 10), max_pending=None):
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.ks = ks
+        self.max_pending = max_pending or 4 * max(num_workers, 1)
+        self.accumulators = {}
+
+    def _accumulator(self, task_desc, metric):
+        if task_desc not in self.accumulators:
+            self.accumulators[task_desc] = SubTaskAccumulator(metric, self.ks)
+        return self.accumulators[task_desc]
+
+    @staticmethod
+    def _split_rating(task_desc, text):
+        # "{rating}, {explanation}" targets: the rating is scored like a rating prediction, the rest as text
+        family, key = task_desc.rsplit('_', 1)
+        task = compiled_tasks.get(family, {}).get(key)
+        if task is None or task.target.fields[:1] != ['rating'] or len(task.target.fields) == 1:
+            return None, text
+        rating, _, rest = text.partition(", ")
+        return rating, rest
+
+    def _add_batch(self, rows, predictions, pool, pending):
+        groups = defaultdict(lambda: ([], []))
+        for row, prediction in zip(rows, predictions):
+            group = groups[(row['task_desc'], row['metric'])]
+            group[0].append(prediction)
+            group[1].append(row['out_text'])
+        for (task_desc, metric), (preds, targets) in groups.items():
+            accumulator = self._accumulator(task_desc, metric)
+            if metric == RANKING:
+                accumulator.add_ranking(preds, targets)
+            elif metric == TEXT:
+                preds = [p[0] if isinstance(p, list) else p for p in preds]
+                split_preds = [self._split_rating(task_desc, p) for p in preds]
+                split_targets = [self._split_rating(task_desc, t) for t in targets]
+                if split_targets and split_targets[0][0] is not None:
+                    accumulator.add_accuracy([p[0] or "" for p in split_preds], [t[0] for t in split_targets])
+                pairs = [(p[1], t[1]) for p, t in zip(split_preds, split_targets)]
+                if pool is None:
+                    accumulator.add_text(text_stats(pairs), len(pairs))
+                else:
+                    pending.append((task_desc, len(pairs), pool.apply_async(text_stats, (pairs,))))
+            else:
+                accumulator.add_accuracy(preds, targets)
+                accumulator.sums['count'] += len(targets)
+        # bounded number of text batches in flight, so memory does not grow with the input
+        while len(pending) > self.max_pending:
+            task_desc, count, result = pending.pop(0)
+            self.accumulators[task_desc].add_text(result.get(), count)
+
+    def evaluate(self, rows, predictions):
+        # rows: dicts with task_desc / out_text / metric (iter_prompt_shards), predictions: aligned iterable
+        pool = multiprocessing.Pool(self.num_workers) if self.num_workers > 1 else None
+        pending = []
+        try:
+            batch_rows, batch_predictions = [], []
+            for row, prediction in zip_longest(rows, predictions, fillvalue=_MISSING):
+                if row is _MISSING or prediction is _MISSING:
+                    raise ValueError("Predictions and test rows have different lengths")
+                batch_rows.append(row)
+                batch_predictions.append(prediction)
+                if len(batch_rows) >= self.batch_size:
+                    self._add_batch(batch_rows, batch_predictions, pool, pending)
+                    batch_rows, batch_predictions = [], []
+            if batch_rows:
+                self._add_batch(batch_rows, batch_predictions, pool, pending)
+            for task_desc, count, result in pending:
+                self.accumulators[task_desc].add_text(result.get(), count)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return self.report()
+
+    def evaluate_shards(self, prompt_dir, predictions_path, split='test'):
+        return self.evaluate(iter_prompt_shards(prompt_dir, split), iter_predictions(predictions_path))
+
+    def report(self):
+        families = {}
+        for task_desc, accumulator in self.accumulators.items():
+            family = task_desc.rsplit('_', 1)[0]
+            if (family, accumulator.metric) not in families:
+                families[(family, accumulator.metric)] = SubTaskAccumulator(accumulator.metric, self.ks)
+            families[(family, accumulator.metric)].merge(accumulator)
+        sub_task_key = lambda name: (name.rsplit('_', 1)[0], int(name.rsplit('_', 1)[1]) if name.rsplit('_', 1)[1].isdigit() else 0)
+        return {
+            'sub_tasks': {name: self.accumulators[name].report() for name in sorted(self.accumulators, key=sub_task_key)},
+            # a family can hold sub tasks of different metrics (sequential has ranking and yes / no ones)
+            'families': {f"{family} ({metric})": acc.report() for (family, metric), acc in sorted(families.items())},
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+        return path
@@ -0,0 +1,95 @@
+import os
+import json
+import numpy as np
+
+from src.utils import load_pickle, save_string_table, load_string_table
+
+
+class FeatureStore:
+    # sorted "user\titem" keys plus offsets into packed feature / explanation string tables, everything memory mapped
+
+    def __init__(self, keys, pair_offsets, features, explanations):
+        self.keys = keys
+        self.pair_offsets = pair_offsets
+        self.features = features
+        self.explanations = explanations
+
+    @staticmethod
+    def _key(user, item):
+        return (user + "\t" + item).encode('utf-8')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, user, item):
+        key = self._key(user, item)
+        pos = int(np.searchsorted(self.keys, key))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def num_sentences(self, pos):
+        return int(self.pair_offsets[pos + 1] - self.pair_offsets[pos])
+
+    def sentence(self, pos, idx):
+        sentence_idx = int(self.pair_offsets[pos]) + idx
+        return self.features[sentence_idx], self.explanations[sentence_idx]
+
+    @classmethod
+    def exists(cls, dir_path):
+        return os.path.exists(os.path.join(dir_path, "meta.json"))
+
+    @classmethod
+    def is_current(cls, dir_path, review_with_features_file):
+        # the store is rebuilt once the pickle it was converted from changes, a store without its pickle is kept
+        if not cls.exists(dir_path):
+            return False
+        if not os.path.exists(review_with_features_file):
+            return True
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            return json.load(f).get('source') == source_stamp(review_with_features_file)
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        return cls(
+            np.load(os.path.join(dir_path, "keys.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(dir_path, "pair_offsets.npy"), mmap_mode=mmap_mode),
+            load_string_table(dir_path, "feature", mmap_mode),
+            load_string_table(dir_path, "explanation", mmap_mode),
+        )
+
+
+def source_stamp(path):
+    # size + mtime like the pipeline's file fingerprints, cheap even for a multi GB pickle
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def convert_reviews_pickle(review_with_features_file, dir_path):
+    # one time conversion of reviews_pickle.pickle, later runs only open the index until the pickle changes
+    source = source_stamp(review_with_features_file)
+    raw_data = load_pickle(review_with_features_file)
+    # a later record for the same (user, item) pair replaces an earlier one, like the old dict did
+    latest = {}
+    for i, record in enumerate(raw_data):
+        if record.get('sentence'):
+            latest[FeatureStore._key(record['user'], record['item'])] = i
+        else:
+            latest.pop(FeatureStore._key(record['user'], record['item']), None)
+
+    keys = sorted(latest)
+    pair_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    features, explanations = [], []
+    for i, key in enumerate(keys):
+        for sentence in raw_data[latest[key]]['sentence']:
+            features.append(sentence[0])
+            explanations.append(sentence[2])
+        pair_offsets[i + 1] = len(features)
+
+    os.makedirs(dir_path, exist_ok=True)
+    np.save(os.path.join(dir_path, "keys.npy"), np.array(keys, dtype=bytes))
+    np.save(os.path.join(dir_path, "pair_offsets.npy"), pair_offsets)
+    save_string_table(dir_path, "feature", features)
+    save_string_table(dir_path, "explanation", explanations)
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump({'num_pairs': len(keys), 'num_sentences': len(features), 'source': source}, f, indent=4)
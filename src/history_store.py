@@ -0,0 +1,299 @@
+import os
+import json
+import pickle
+import numpy as np
+
+from src.utils import load_pickle
+from src.feature_store import source_stamp
+from src.id_maps import IdMaps
+
+
+# one row per review, prev_user / prev_item link to the previous row of the same user / item (-1 for the first one)
+REVIEW_COLUMNS = {'user': np.int32, 'item': np.int32, 'time': np.int64, 'rating': np.float64, 'prev_user': np.int64, 'prev_item': np.int64}
+TEXT_COLUMNS = ['review', 'review_feature', 'review_explanation']
+# one row per seen user / item: its last review row, number of reviews and dense id (-1 outside the k-core)
+NODE_COLUMNS = {'last': np.int64, 'degree': np.int32, 'dense': np.int32}
+NODE_DEFAULTS = {'last': -1, 'degree': 0, 'dense': -1}
+
+
+class AppendColumn:
+    # fixed width values in a raw binary file, appended at the end and read back through a memory map
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self.length = os.path.getsize(path) // self.dtype.itemsize
+        self.view = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if self.view is None:
+            self.view = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(self.length,)) if self.length else np.zeros(0, self.dtype)
+        return self.view[idx]
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        with open(self.path, "ab") as f:
+            f.write(values.tobytes())
+        self.length += len(values)
+        self.view = None
+
+    def write(self, idx, values):
+        view = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=(self.length,))
+        view[idx] = values
+        view.flush()
+        del view
+        self.view = None
+
+    def truncate(self, length):
+        os.truncate(self.path, length * self.dtype.itemsize)
+        self.length = length
+        self.view = None
+
+
+class AppendStringColumn:
+    # utf-8 strings packed into one byte column, the end offset of every string in a second one
+
+    def __init__(self, path):
+        self.blob = AppendColumn(path + ".blob.bin", np.uint8)
+        self.ends = AppendColumn(path + ".ends.bin", np.int64)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, idx):
+        start = int(self.ends[idx - 1]) if idx else 0
+        return self.blob[start:int(self.ends[idx])].tobytes().decode('utf-8')
+
+    def append(self, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.ends.append(np.cumsum([len(s) for s in encoded], dtype=np.int64) + len(self.blob))
+        self.blob.append(np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def truncate(self, length):
+        self.blob.truncate(int(self.ends[length - 1]) if length else 0)
+        self.ends.truncate(length)
+
+
+class LineIndex:
+    # byte offset of every line of a json lines file by its id field, a few records are read back with one seek each
+    # instead of a scan of the file; the index is only valid for the file version (size + mtime) it was built from
+
+    def __init__(self, keys, offsets, source):
+        self.keys = keys
+        self.offsets = offsets
+        self.source = source
+
+    @classmethod
+    def build(cls, path, id_field):
+        keys, offsets, offset = [], [], 0
+        with open(path, "rb") as f:
+            for line in f:
+                keys.append(json.loads(line)[id_field].encode('utf-8'))
+                offsets.append(offset)
+                offset += len(line)
+        keys = np.array(keys, dtype=bytes)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order], np.asarray(offsets, dtype=np.int64)[order], source_stamp(path))
+
+    def is_current(self, path):
+        return self.source == source_stamp(path)
+
+    def read(self, path, raw_ids, record_fn):
+        # {raw id: record_fn(line)} for the ids found in the file, the last line wins for an id that is there twice
+        if not raw_ids or not len(self.keys):
+            return {}
+        keys = np.array([raw_id.encode('utf-8') for raw_id in raw_ids], dtype=bytes)
+        pos = np.searchsorted(self.keys, keys, side='right') - 1
+        found = (pos >= 0) & (self.keys[np.maximum(pos, 0)] == keys)
+        hits = sorted((int(self.offsets[p]), raw_id) for raw_id, p, hit in zip(raw_ids, pos.tolist(), found.tolist()) if hit)
+        records = {}
+        with open(path, "rb") as f:
+            for offset, raw_id in hits:
+                f.seek(offset)
+                records[raw_id] = record_fn(json.loads(f.readline()))
+        return records
+
+    def save(self, dir_path, name):
+        np.save(os.path.join(dir_path, f"{name}_keys.npy"), self.keys)
+        np.save(os.path.join(dir_path, f"{name}_offsets.npy"), self.offsets)
+        with open(os.path.join(dir_path, f"{name}.json"), "w") as f:
+            json.dump({'source': self.source}, f, indent=4)
+
+    @classmethod
+    def load(cls, dir_path, name, mmap_mode='r'):
+        if not os.path.exists(os.path.join(dir_path, f"{name}.json")):
+            return None
+        with open(os.path.join(dir_path, f"{name}.json"), "r") as f:
+            source = json.load(f)['source']
+        return cls(
+            np.load(os.path.join(dir_path, f"{name}_keys.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(dir_path, f"{name}_offsets.npy"), mmap_mode=mmap_mode),
+            source,
+        )
+
+
+class HistoryStore:
+    # every review of the window in arrival order as append only columns. the rows of a user (or an item) are linked
+    # from its last row backwards, so one history is read without touching the others, and an update only appends
+    # its reviews and rewrites the node entries it touches. seen ids (all users / items before k-core) map raw ids
+    # to node rows, user_seen / item_seen map dense ids back to them, user_desc / item_title are by dense id.
+    # appended rows past the lengths of the last commit and in place writes of an unfinished commit are rolled back
+    # by recover
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+        self.columns = {name: AppendColumn(self._path(name + ".bin"), dtype) for name, dtype in REVIEW_COLUMNS.items()}
+        for kind in ('user', 'item'):
+            for name, dtype in NODE_COLUMNS.items():
+                self.columns[f"{kind}_{name}"] = AppendColumn(self._path(f"{kind}_{name}.bin"), dtype)
+            self.columns[f"{kind}_seen"] = AppendColumn(self._path(f"{kind}_seen.bin"), np.int32)
+        for name in TEXT_COLUMNS + ['user_desc', 'item_title']:
+            self.columns[name] = AppendStringColumn(self._path(name))
+        # in place writes of the current update, {column: {row: value}}, applied by commit
+        self.pending = {}
+        if not IdMaps.exists(self.seen_dir()):
+            IdMaps.build([], []).save(self.seen_dir())
+        self.seen = IdMaps.load(self.seen_dir())
+
+    def _path(self, name):
+        return os.path.join(self.dir_path, name)
+
+    def seen_dir(self):
+        return self._path("seen")
+
+    def lengths(self):
+        return {name: len(column) for name, column in self.columns.items()}
+
+    def num_reviews(self):
+        return len(self.columns['user'])
+
+    def get(self, name, idx):
+        pending = self.pending.get(name)
+        if pending is not None and idx in pending:
+            return pending[idx]
+        return self.columns[name][idx].item()
+
+    def set(self, name, idx, value):
+        self.pending.setdefault(name, {})[idx] = value
+
+    def text(self, name, idx):
+        return self.columns[name][idx]
+
+    def add_seen(self, user_ids, item_ids):
+        # node rows for ids seen for the first time, numbered after the existing ones
+        self.seen = IdMaps.append(self.seen_dir(), user_ids, item_ids, prune=False)
+        for kind, raw_ids in [('user', user_ids), ('item', item_ids)]:
+            for name, default in NODE_DEFAULTS.items():
+                self.columns[f"{kind}_{name}"].append(np.full(len(raw_ids), default))
+
+    def seen_index(self, kind, raw_ids):
+        # node row of every raw id, -1 for ids not seen so far
+        return getattr(self.seen, kind + "s").to_index_batch(raw_ids)
+
+    def add_reviews(self, users, items, times, ratings, reviews, features, explanations):
+        # users / items are node rows, every new row is linked after the current last row of its user and item
+        start = self.num_reviews()
+        prev_user, prev_item = [], []
+        for row, (user, item) in enumerate(zip(users, items), start):
+            prev_user.append(self.get('user_last', user))
+            prev_item.append(self.get('item_last', item))
+            self.set('user_last', user, row)
+            self.set('item_last', item, row)
+            self.set('user_degree', user, self.get('user_degree', user) + 1)
+            self.set('item_degree', item, self.get('item_degree', item) + 1)
+        for name, values in [('user', users), ('item', items), ('time', times), ('rating', ratings),
+                             ('prev_user', prev_user), ('prev_item', prev_item)]:
+            self.columns[name].append(values)
+        for name, strings in zip(TEXT_COLUMNS, [reviews, features, explanations]):
+            self.columns[name].append(strings)
+
+    def rows(self, kind, node):
+        # review rows of a user / item in arrival order
+        rows = []
+        row = self.get(f"{kind}_last", node)
+        prev = self.columns[f"prev_{kind}"]
+        while row >= 0:
+            rows.append(row)
+            row = int(prev[row])
+        rows.reverse()
+        return rows
+
+    def items_of(self, user):
+        column = self.columns['item']
+        return [int(column[row]) for row in self.rows('user', user)]
+
+    def users_of(self, item):
+        column = self.columns['user']
+        return [int(column[row]) for row in self.rows('item', item)]
+
+    def add_dense(self, kind, nodes, descs):
+        # dense ids for nodes that joined the k-core, numbered after the existing ones
+        start = len(self.columns[f"{kind}_seen"])
+        for dense, node in enumerate(nodes, start):
+            self.set(f"{kind}_dense", node, dense)
+        self.columns[f"{kind}_seen"].append(np.asarray(nodes, dtype=np.int32))
+        self.columns['user_desc' if kind == 'user' else 'item_title'].append(descs)
+
+    def _journal_file(self):
+        return self._path("journal.pickle")
+
+    def _write_journal(self, journal):
+        tmp_file = self._journal_file() + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(journal, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._journal_file())
+
+    def begin(self, id_maps_dirs):
+        # keeps the run lists of the id maps that the update appends to, so recover can put them back
+        meta_files = [os.path.join(d, "meta.json") for d in [self.seen_dir()] + list(id_maps_dirs)]
+        journal = {'files': {}, 'writes': {}}
+        for path in meta_files:
+            with open(path, "rb") as f:
+                journal['files'][path] = f.read()
+        self._write_journal(journal)
+
+    def commit(self, state_file, state):
+        # old values of every entry written in place go to the journal first, state_file is replaced last: a crash at
+        # any point before that leaves the previous state recoverable
+        journal = load_pickle(self._journal_file()) if os.path.exists(self._journal_file()) else {'files': {}, 'writes': {}}
+        state['commit'] = journal['commit'] = state.get('commit', 0) + 1
+        writes = {name: (np.fromiter(values.keys(), dtype=np.int64, count=len(values)), np.fromiter(values.values(), dtype=self.columns[name].dtype, count=len(values)))
+                  for name, values in self.pending.items() if values}
+        journal['writes'] = {name: (idx, np.array(self.columns[name][idx])) for name, (idx, _) in writes.items()}
+        self._write_journal(journal)
+        for name, (idx, values) in writes.items():
+            self.columns[name].write(idx, values)
+        self.pending = {}
+        state['lengths'] = self.lengths()
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_file, state_file)
+        os.remove(self._journal_file())
+        for path in journal['files']:
+            IdMaps.prune(os.path.dirname(path))
+
+    def recover(self, state):
+        # undoes an update that did not reach its commit, state is the last committed one
+        if os.path.exists(self._journal_file()):
+            journal = load_pickle(self._journal_file())
+            if journal.get('commit') != state.get('commit'):
+                for name, (idx, values) in journal['writes'].items():
+                    self.columns[name].write(idx, values)
+                for path, content in journal['files'].items():
+                    with open(path, "wb") as f:
+                        f.write(content)
+            for path in journal['files']:
+                IdMaps.prune(os.path.dirname(path))
+            os.remove(self._journal_file())
+        for name, column in self.columns.items():
+            if len(column) > state['lengths'].get(name, 0):
+                column.truncate(state['lengths'][name])
+        self.pending = {}
+        self.seen = IdMaps.load(self.seen_dir())
@@ -0,0 +1,196 @@
+import os
+import json
+from bisect import bisect_right
+import numpy as np
+
+from src.utils import save_string_table, load_string_table
+
+
+RUN_SUFFIXES = ["_raw.blob.npy", "_raw.offsets.npy", "_sorted_keys.npy", "_sorted_index.npy"]
+
+
+class IdMap:
+    # dense index <-> raw yelp id, index i is rendered as "{prefix}_{i + 1}" in the prompts. the ids are kept as runs of
+    # consecutive indices with their own sorted keys, extending adds a run for the new ids so no existing user_N / item_N
+    # is renumbered and the stored ids are neither re-sorted nor rewritten
+
+    # a run is merged into the one before it while that one is at most this many times larger
+    MERGE_RATIO = 2
+
+    def __init__(self, prefix, runs, names=None):
+        self.prefix = prefix
+        # [(raw, sorted_keys, sorted_index)], sorted_index holds the dense indices, those of run r follow run r - 1
+        self.runs = runs
+        # file name of every run, None while the run is only in memory
+        self.names = list(names) if names is not None else [None] * len(runs)
+        self.starts = np.cumsum([0] + [len(raw) for raw, _, _ in runs]).tolist()
+
+    @staticmethod
+    def _run(raw_ids, start):
+        keys = np.array([raw_id.encode('utf-8') for raw_id in raw_ids], dtype=bytes)
+        order = np.argsort(keys, kind='stable')
+        return list(raw_ids), keys[order], (order + start).astype(np.int32)
+
+    @classmethod
+    def build(cls, prefix, raw_ids):
+        return cls(prefix, [cls._run(raw_ids, 0)])
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def extend(self, raw_ids):
+        # new ids are appended after the existing ones, so no existing user_N / item_N is renumbered
+        raw_ids = list(raw_ids)
+        if not raw_ids:
+            return self
+        return IdMap(self.prefix, self.runs + [self._run(raw_ids, len(self))], self.names + [None])
+
+    def compact(self):
+        # merges the newest runs while the one before is not much larger, so there are O(log n) runs and every id is
+        # merged O(log n) times however many extensions it goes through
+        runs, names = list(self.runs), list(self.names)
+        while len(runs) > 1 and len(runs[-2][0]) <= self.MERGE_RATIO * len(runs[-1][0]):
+            (raw_a, keys_a, index_a), (raw_b, keys_b, index_b) = runs.pop(-2), runs.pop()
+            names[-2:] = [None]
+            keys = np.concatenate([keys_a, keys_b])
+            order = np.argsort(keys, kind='stable')
+            raw = [raw_a[i] for i in range(len(raw_a))] + [raw_b[i] for i in range(len(raw_b))]
+            runs.append((raw, keys[order], np.concatenate([index_a, index_b])[order]))
+        return IdMap(self.prefix, runs, names)
+
+    def __contains__(self, raw_id):
+        return self.to_index(raw_id) is not None
+
+    def to_raw(self, idx):
+        if len(self.runs) == 1:
+            return self.runs[0][0][idx]
+        run = bisect_right(self.starts, idx) - 1
+        return self.runs[run][0][idx - self.starts[run]]
+
+    def to_index(self, raw_id):
+        key = raw_id.encode('utf-8')
+        for _, sorted_keys, sorted_index in self.runs:
+            pos = int(np.searchsorted(sorted_keys, key))
+            if pos < len(sorted_keys) and sorted_keys[pos] == key:
+                return int(sorted_index[pos])
+        return None
+
+    def to_index_batch(self, raw_ids):
+        # dtype=bytes sizes the queries to the longest one, casting to the key width would cut longer ids down to a
+        # prefix that can equal a known id
+        keys = np.array([raw_id.encode('utf-8') for raw_id in raw_ids], dtype=bytes)
+        indices = np.full(len(keys), -1, dtype=np.int64)
+        for _, sorted_keys, sorted_index in self.runs:
+            if len(sorted_keys) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+            found = sorted_keys[pos] == keys
+            indices[found] = sorted_index[pos[found]]
+        return indices
+
+    def token(self, idx):
+        return self.prefix + "_" + str(idx + 1)
+
+    def token_to_index(self, token):
+        return int(token[len(self.prefix) + 1:]) - 1
+
+    def _save_run(self, dir_path, run_name, run):
+        raw, sorted_keys, sorted_index = run
+        save_string_table(dir_path, f"{run_name}_raw", [raw[i] for i in range(len(raw))])
+        np.save(os.path.join(dir_path, f"{run_name}_sorted_keys.npy"), sorted_keys)
+        np.save(os.path.join(dir_path, f"{run_name}_sorted_index.npy"), sorted_index)
+
+    def save(self, dir_path, name, only_new=False):
+        # the first run of a full save keeps the plain file names, every other run is named after its index range;
+        # only_new writes just the runs that are not on disk yet. returns the file names of all runs
+        names = []
+        for run, (start, end), run_name in zip(self.runs, zip(self.starts[:-1], self.starts[1:]), self.names):
+            if run_name is None or not only_new:
+                run_name = name if not names and not only_new else f"{name}.{start}-{end}"
+                self._save_run(dir_path, run_name, run)
+            names.append(run_name)
+        self.names = names
+        return names
+
+    @classmethod
+    def load(cls, prefix, dir_path, name, mmap_mode='r', run_names=None):
+        run_names = run_names or [name]
+        return cls(prefix, [(
+            load_string_table(dir_path, f"{run_name}_raw", mmap_mode),
+            np.load(os.path.join(dir_path, f"{run_name}_sorted_keys.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(dir_path, f"{run_name}_sorted_index.npy"), mmap_mode=mmap_mode),
+        ) for run_name in run_names], run_names)
+
+
+class IdMaps:
+
+    def __init__(self, users, items):
+        self.users = users
+        self.items = items
+
+    @classmethod
+    def build(cls, user_ids, item_ids):
+        return cls(IdMap.build("user", user_ids), IdMap.build("item", item_ids))
+
+    def extend(self, user_ids, item_ids):
+        return IdMaps(self.users.extend(user_ids), self.items.extend(item_ids))
+
+    @classmethod
+    def from_data_maps(cls, data_maps):
+        # data_maps is the old dict of user2id / id2user / item2id / id2item
+        user_ids = [data_maps['id2user'][f"user_{i + 1}"] for i in range(len(data_maps['id2user']))]
+        item_ids = [data_maps['id2item'][f"item_{i + 1}"] for i in range(len(data_maps['id2item']))]
+        return cls.build(user_ids, item_ids)
+
+    def _save_meta(self, dir_path, user_runs, item_runs):
+        # replaced in one rename, the maps on disk are the runs it lists
+        tmp_file = os.path.join(dir_path, "meta.json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({'num_users': len(self.users), 'num_items': len(self.items), 'user_runs': user_runs, 'item_runs': item_runs}, f, indent=4)
+        os.replace(tmp_file, os.path.join(dir_path, "meta.json"))
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        self._save_meta(dir_path, self.users.save(dir_path, "user"), self.items.save(dir_path, "item"))
+
+    @classmethod
+    def append(cls, dir_path, user_ids, item_ids, prune=True):
+        # extends the maps stored in dir_path, only the runs of the new ids and the runs merged by compact are written;
+        # the runs they replace stay on disk until prune, so an old meta.json can still be put back before that
+        id_maps = cls.load(dir_path)
+        id_maps = IdMaps(id_maps.users.extend(user_ids).compact(), id_maps.items.extend(item_ids).compact())
+        id_maps._save_meta(dir_path, id_maps.users.save(dir_path, "user", only_new=True), id_maps.items.save(dir_path, "item", only_new=True))
+        if prune:
+            cls.prune(dir_path)
+        return id_maps
+
+    @classmethod
+    def prune(cls, dir_path):
+        # removes the run files meta.json does not list
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        runs = set(meta.get('user_runs', ["user"])) | set(meta.get('item_runs', ["item"]))
+        for file_name in os.listdir(dir_path):
+            for suffix in RUN_SUFFIXES:
+                if file_name.endswith(suffix) and file_name[:-len(suffix)] not in runs:
+                    os.remove(os.path.join(dir_path, file_name))
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        # maps saved before runs existed have no run list, they are the single run under the plain names
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        return cls(
+            IdMap.load("user", dir_path, "user", mmap_mode, meta.get('user_runs')),
+            IdMap.load("item", dir_path, "item", mmap_mode, meta.get('item_runs')),
+        )
+
+    @classmethod
+    def exists(cls, dir_path):
+        return os.path.exists(os.path.join(dir_path, "meta.json"))
+
+
+def convert_data_maps_json(data_maps_file_path, dir_path):
+    with open(data_maps_file_path, "r") as f:
+        data_maps = json.load(f)
+    IdMaps.from_data_maps(data_maps).save(dir_path)
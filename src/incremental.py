@@ -0,0 +1,342 @@
+import os
+import json
+import random
+import shutil
+from functools import partial
+
+from src.utils import *
+from src.ingestion import iter_records, review_record, user_record, item_record
+from src.pre_data_preparation import PreDataPreparation
+from src.data_preparation import DataPreparation
+from src.columnar import write_columnar_segment
+from src.history_store import HistoryStore, LineIndex
+from src.output_writer import iter_prompt_shards
+from src.id_maps import IdMaps
+
+
+def _dated_review_record(review, min_date, max_date):
+    # every line comes back with its date, so a scan also finds the latest review date in the file
+    return review['date'], review_record(review, min_date, max_date)
+
+
+class IncrementalUpdater:
+    # keeps every filtered review (before k-core) in an append only history store next to the current k-core, so a new
+    # date window only ingests the reviews after the watermark, re-runs k-core around the touched nodes and regenerates
+    # prompts for the users whose history changed; the work of an update follows the size of its delta, not of the
+    # state built so far
+
+    def __init__(self, pre_data_preparation=None, data_preparation=None):
+        self.pre = pre_data_preparation or PreDataPreparation()
+        self.prep = data_preparation or DataPreparation()
+        self.state_dir = "./data/incremental"
+        # when the review file only ever grows, only the bytes after the last read offset are parsed as long as no line
+        # read before is newer than the watermark, otherwise the earlier lines are scanned again too
+        self.append_only = True
+        self.scanned_max_date = ""
+        self.scanned_offset = 0
+
+    def _state_file(self):
+        return os.path.join(self.state_dir, "state.json")
+
+    def _id_maps_dir(self):
+        return os.path.join(self.state_dir, "id_maps")
+
+    def _segments_dir(self):
+        return os.path.join(self.state_dir, "segments")
+
+    def _prompts_dir(self, name):
+        return os.path.join(self.state_dir, "prompts", name)
+
+    def _load_state(self):
+        with open(self._state_file(), "r") as f:
+            return json.load(f)
+
+    def _open_store(self, state):
+        store = HistoryStore(os.path.join(self.state_dir, "history"))
+        store.recover(state)
+        return store
+
+    def _iter_window(self, min_date, max_date):
+        # review records of [min_date, max_date] in the whole file; once exhausted, scanned_max_date is the latest date
+        # of any line and scanned_offset the number of bytes read
+        meter = ThroughputMeter("review scan")
+        record_fn = partial(_dated_review_record, min_date=min_date, max_date=max_date)
+        self.scanned_max_date = ""
+        for date, record in iter_records(self.pre.review_file_path, record_fn, self.pre.num_workers, meter):
+            self.scanned_max_date = max(self.scanned_max_date, date)
+            if record is not None:
+                yield record
+        self.scanned_offset = meter.bytes_read
+
+    def _iter_lines(self, start, end, min_date, max_date):
+        # (date, record or None) for every line in the byte range [start, end)
+        record_fn = partial(_dated_review_record, min_date=min_date, max_date=max_date)
+        with open(self.pre.review_file_path, "rb") as f:
+            f.seek(start)
+            pos = start
+            while pos < end:
+                line = f.readline()
+                if not line:
+                    break
+                pos += len(line)
+                yield record_fn(json.loads(line))
+
+    def _descs(self, store, kind, raw_ids):
+        # names / titles of new dense ids, read by offset from the user / business file; the offsets are indexed again
+        # only when the file itself changed
+        path, record_fn, id_field = (self.pre.user_file_path, user_record, 'user_id') if kind == 'user' else \
+            (self.pre.item_file_path, item_record, 'business_id')
+        index = LineIndex.load(store.dir_path, f"{kind}_lines")
+        if index is None or not index.is_current(path):
+            index = LineIndex.build(path, id_field)
+            index.save(store.dir_path, f"{kind}_lines")
+        records = index.read(path, raw_ids, record_fn)
+        return [records[raw_id][1] if raw_id in records else "" for raw_id in raw_ids]
+
+    def _core_rows(self, store, user, new_items=()):
+        # review rows of the user whose item is in the k-core (or joins it with new_items), by time and arrival order
+        item_column, time_column = store.columns['item'], store.columns['time']
+        rows = [row for row in store.rows('user', user)
+                if store.get('item_dense', int(item_column[row])) >= 0 or int(item_column[row]) in new_items]
+        return sorted(rows, key=lambda row: int(time_column[row]))
+
+    def _segment_columns(self, store, id_maps, users):
+        columns = {key: [] for key in ['user_index', 'item_index', 'visit_date', 'rating', 'review', 'review_feature', 'review_explanation']}
+        columns['user_offsets'] = [0]
+        user_raw, user_desc = [], []
+        for user in users:
+            dense = store.get('user_dense', user)
+            user_raw.append(id_maps.users.to_raw(dense))
+            user_desc.append(store.text('user_desc', dense))
+            columns['user_index'].append(dense)
+            for row in self._core_rows(store, user):
+                columns['item_index'].append(store.get('item_dense', int(store.columns['item'][row])))
+                columns['visit_date'].append(int(store.columns['time'][row]))
+                columns['rating'].append(float(store.columns['rating'][row]))
+                for text in ['review', 'review_feature', 'review_explanation']:
+                    columns[text].append(store.text(text, row))
+            columns['user_offsets'].append(len(columns['item_index']))
+        return columns, user_raw, user_desc
+
+    @staticmethod
+    def _segment_name(state, max_date):
+        # sequence number first, so several updates ending on the same day (or the same second) never share a name
+        return f"update-{len(state['segments']):05d}-" + max_date.replace("-", "").replace(":", "").replace(" ", "T")
+
+    def _write_segment(self, store, state, users, new_items, name):
+        # columnar segment + prompts for the given users (node rows) only, with the item tables of the items new to it;
+        # directories of the name can only be left over from an update that never committed
+        if name in state['segments']:
+            raise ValueError(f"Segment {name} already exists in {self.state_dir}")
+        id_maps = IdMaps.load(self._id_maps_dir())
+        segment_dir = os.path.join(self._segments_dir(), name)
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        shutil.rmtree(self._prompts_dir(name), ignore_errors=True)
+        write_columnar_segment(
+            segment_dir, *self._segment_columns(store, id_maps, users),
+            [id_maps.items.to_raw(store.get('item_dense', item)) for item in new_items],
+            [store.text('item_title', store.get('item_dense', item)) for item in new_items],
+            len(id_maps.items), list(state['segments']),
+        )
+
+        self.prep.final_pre_data_dir = segment_dir
+        self.prep.id_maps_dir = self._id_maps_dir()
+        self.prep.output_dir = self._prompts_dir(name)
+        self.prep.tag_users = True
+        self.prep.data_preparation()
+
+    def _supersede(self, name, users):
+        # the prompts of these dense users in earlier segments are replaced by the ones of this segment
+        manifest_file = os.path.join(self._prompts_dir(name), "manifest.json")
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        manifest['superseded_users'] = sorted(users)
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    def initialize(self):
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        os.makedirs(self.state_dir)
+        random.seed(self.pre.seed)
+        interactions = self.pre._get_user_item_interactions(
+            self.pre._iter_review_data(self._iter_window(self.pre.min_date, self.pre.max_date)))
+        core = self.pre._filter_kcore(interactions)
+
+        state = {
+            'watermark': self.pre.max_date,
+            'review_offset': self.scanned_offset,
+            'file_max_date': self.scanned_max_date,
+            'segments': [],
+            'lengths': {},
+        }
+        store = HistoryStore(os.path.join(self.state_dir, "history"))
+        seen_items = {}
+        for records in interactions.values():
+            for record in records:
+                seen_items.setdefault(record[0], len(seen_items))
+        seen_users = {user: i for i, user in enumerate(interactions)}
+        store.add_seen(list(seen_users), list(seen_items))
+        rows = [(seen_users[user], seen_items[record[0]]) + record[1:] for user, records in interactions.items() for record in records]
+        if rows:
+            store.add_reviews(*(list(column) for column in zip(*rows)))
+
+        id_maps = self.pre._get_mappings(core)
+        id_maps.save(self._id_maps_dir())
+        core_users = [seen_users[id_maps.users.to_raw(i)] for i in range(len(id_maps.users))]
+        core_items = [seen_items[id_maps.items.to_raw(i)] for i in range(len(id_maps.items))]
+        store.add_dense('user', core_users, self._descs(store, 'user', [id_maps.users.to_raw(i) for i in range(len(id_maps.users))]))
+        store.add_dense('item', core_items, self._descs(store, 'item', [id_maps.items.to_raw(i) for i in range(len(id_maps.items))]))
+
+        self._write_segment(store, state, core_users, core_items, "base")
+        state['segments'].append("base")
+        store.commit(self._state_file(), state)
+        print(f"Initialized incremental state, users: {len(core_users)}, items: {len(core_items)}")
+
+    def _iter_delta_records(self, state, max_date):
+        # new reviews of the window: the lines appended after review_offset anywhere in [min_date, max_date] and, when
+        # a line read before is newer than the watermark (the previous window ended before it), the earlier lines in
+        # (watermark, max_date]. a file that shrank, or any file without append_only, is read again as a whole and
+        # only the reviews after the watermark are new
+        watermark_time = int(state['watermark'].replace('-', '').replace(':', '').replace(' ', ''))
+        file_size = os.path.getsize(self.pre.review_file_path)
+        offset = state['review_offset'] if self.append_only and file_size >= state['review_offset'] else 0
+        self.scanned_max_date = state['file_max_date'] if offset else ""
+        if offset and state['file_max_date'] > state['watermark']:
+            for _, record in self._iter_lines(0, offset, state['watermark'], max_date):
+                if record is not None and record[2] > watermark_time:
+                    yield record
+        for date, record in self._iter_lines(offset, file_size, self.pre.min_date, max_date):
+            self.scanned_max_date = max(self.scanned_max_date, date)
+            if record is not None and (offset or record[2] > watermark_time):
+                yield record
+        self.scanned_offset = file_size
+
+    def _local_kcore(self, store, delta_users, delta_items):
+        # only nodes reachable from the delta through edges outside the current core can change their k-core status,
+        # the current core itself never shrinks when edges are added
+        region_users, region_items = set(), set()
+        user_stack = [user for user in delta_users if store.get('user_dense', user) < 0]
+        item_stack = [item for item in delta_items if store.get('item_dense', item) < 0]
+        items_of, users_of = {}, {}
+        while user_stack or item_stack:
+            while user_stack:
+                user = user_stack.pop()
+                if user in region_users:
+                    continue
+                region_users.add(user)
+                items_of[user] = store.items_of(user)
+                item_stack.extend(i for i in items_of[user] if store.get('item_dense', i) < 0 and i not in region_items)
+            while item_stack:
+                item = item_stack.pop()
+                if item in region_items:
+                    continue
+                region_items.add(item)
+                users_of[item] = store.users_of(item)
+                user_stack.extend(u for u in users_of[item] if store.get('user_dense', u) < 0 and u not in region_users)
+
+        user_degree = {user: store.get('user_degree', user) for user in region_users}
+        item_degree = {item: store.get('item_degree', item) for item in region_items}
+        user_queue = [user for user, cnt in user_degree.items() if cnt < self.pre.user_core]
+        item_queue = [item for item, cnt in item_degree.items() if cnt < self.pre.item_core]
+        removed_users, removed_items = set(user_queue), set(item_queue)
+        while user_queue or item_queue:
+            next_user_queue, next_item_queue = [], []
+            for user in user_queue:
+                for item in items_of[user]:
+                    if item in region_items and item not in removed_items:
+                        item_degree[item] -= 1
+                        if item_degree[item] < self.pre.item_core:
+                            removed_items.add(item)
+                            next_item_queue.append(item)
+            for item in item_queue:
+                for user in users_of[item]:
+                    if user in region_users and user not in removed_users:
+                        user_degree[user] -= 1
+                        if user_degree[user] < self.pre.user_core:
+                            removed_users.add(user)
+                            next_user_queue.append(user)
+            user_queue, item_queue = next_user_queue, next_item_queue
+        return region_users - removed_users, region_items - removed_items, len(region_users) + len(region_items)
+
+    def update(self, max_date):
+        state = self._load_state()
+        if max_date <= state['watermark']:
+            print("Nothing to do, watermark is already", state['watermark'])
+            return []
+        store = self._open_store(state)
+        store.begin([self._id_maps_dir()])
+        random.seed(f"{self.pre.seed}-{max_date}")
+        delta = list(self.pre._iter_review_data(self._iter_delta_records(state, max_date)))
+        print(f"New reviews after {state['watermark']}: {len(delta)}")
+
+        # node rows of the delta ids, ids seen for the first time are numbered in order of first appearance
+        raw_users = list(dict.fromkeys(record[0] for record in delta))
+        raw_items = list(dict.fromkeys(record[1] for record in delta))
+        user_nodes = dict(zip(raw_users, store.seen_index('user', raw_users).tolist()))
+        item_nodes = dict(zip(raw_items, store.seen_index('item', raw_items).tolist()))
+        new_users = [user for user in raw_users if user_nodes[user] < 0]
+        new_items = [item for item in raw_items if item_nodes[item] < 0]
+        user_nodes.update(zip(new_users, range(len(store.seen.users), len(store.seen.users) + len(new_users))))
+        item_nodes.update(zip(new_items, range(len(store.seen.items), len(store.seen.items) + len(new_items))))
+        store.add_seen(new_users, new_items)
+        if delta:
+            users, items, times, ratings, reviews, features, explanations = (list(column) for column in zip(*delta))
+            store.add_reviews([user_nodes[u] for u in users], [item_nodes[i] for i in items], times, ratings, reviews, features, explanations)
+        delta_users = [user_nodes[user] for user in raw_users]
+        delta_items = [item_nodes[item] for item in raw_items]
+
+        added_users, added_items, region_size = self._local_kcore(store, delta_users, delta_items)
+        changed_users = {user for user in delta_users if store.get('user_dense', user) >= 0} | added_users
+        for item in added_items:
+            changed_users.update(user for user in store.users_of(item) if store.get('user_dense', user) >= 0)
+        superseded = sorted(store.get('user_dense', user) for user in changed_users if store.get('user_dense', user) >= 0)
+        print(f"Local k-core region: {region_size} nodes, new users: {len(added_users)}, new items: {len(added_items)}, changed users: {len(changed_users)}")
+
+        # new dense ids go after the existing ones, users in order of first appearance, items in the order the
+        # changed users' histories reach them
+        added_users = sorted(added_users)
+        changed_users = sorted(changed_users)
+        ordered_items = {}
+        for user in changed_users:
+            for row in self._core_rows(store, user, added_items):
+                item = int(store.columns['item'][row])
+                if item in added_items:
+                    ordered_items.setdefault(item, None)
+        added_items = list(ordered_items)
+        raw_added_users = [store.seen.users.to_raw(user) for user in added_users]
+        raw_added_items = [store.seen.items.to_raw(item) for item in added_items]
+        IdMaps.append(self._id_maps_dir(), raw_added_users, raw_added_items, prune=False)
+        store.add_dense('user', added_users, self._descs(store, 'user', raw_added_users))
+        store.add_dense('item', added_items, self._descs(store, 'item', raw_added_items))
+
+        state['watermark'] = max_date
+        state['review_offset'] = self.scanned_offset
+        state['file_max_date'] = self.scanned_max_date
+        if changed_users:
+            name = self._segment_name(state, max_date)
+            self._write_segment(store, state, changed_users, added_items, name)
+            self._supersede(name, superseded)
+            state['segments'].append(name)
+        store.commit(self._state_file(), state)
+        return sorted(store.seen.users.to_raw(user) for user in changed_users)
+
+    def iter_prompts(self, split):
+        # prompt rows of all segments, a user's rows only come from the last segment that generated them
+        segments = self._load_state()['segments']
+        skip_users = [set() for _ in segments]
+        for i in range(len(segments) - 1, 0, -1):
+            with open(os.path.join(self._prompts_dir(segments[i]), "manifest.json"), "r") as f:
+                skip_users[i - 1] = skip_users[i] | set(json.load(f).get('superseded_users', []))
+        for name, skip in zip(segments, skip_users):
+            yield from iter_prompt_shards(self._prompts_dir(name), split, skip)
+
+    def export(self, dir_path):
+        # full columnar pre data for the current state, e.g. to run a complete DataPreparation again
+        state = self._load_state()
+        store = self._open_store(state)
+        id_maps = IdMaps.load(self._id_maps_dir())
+        num_items = len(id_maps.items)
+        write_columnar_segment(
+            dir_path, *self._segment_columns(store, id_maps, store.columns['user_seen'][:].tolist()),
+            [id_maps.items.to_raw(i) for i in range(num_items)], [store.text('item_title', i) for i in range(num_items)], num_items,
+        )
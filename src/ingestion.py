@@ -0,0 +1,76 @@
+import os
+import json
+import multiprocessing
+from functools import partial
+
+from src.utils import *
+
+
+def review_record(review, min_date, max_date, rating_score=0.0):
+    rating = review['stars']
+    date = review['date']
+    if date < min_date or date > max_date or float(rating) <= rating_score:
+        return None
+    time = date.replace('-', '').replace(':', '').replace(' ', '')
+    return review['user_id'], review['business_id'], int(time), rating, review['text']
+
+
+def item_record(item):
+    return item['business_id'], item['name'] + "_" + item['city'] + "_" + item['state']
+
+
+def user_record(user):
+    return user['user_id'], user['name']
+
+
+def shard_file(filename, num_shards):
+    # split the file into byte ranges whose boundaries always fall right after a newline
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(file_size * i // num_shards - 1, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+
+def _parse_shard(byte_range, filename, record_fn):
+    start, end = byte_range
+    num_lines = 0
+    records = []
+    with open(filename, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            num_lines += 1
+            record = record_fn(json.loads(line))
+            if record is not None:
+                records.append(record)
+    return end - start, num_lines, records
+
+
+def iter_parallel_records(filename, record_fn, num_workers, meter=None, shards_per_worker=4):
+    # shards come back in file order, so the merged stream is identical to a single process read
+    shards = shard_file(filename, num_workers * shards_per_worker)
+    worker = partial(_parse_shard, filename=filename, record_fn=record_fn)
+    with multiprocessing.Pool(num_workers) as pool:
+        for num_bytes, num_lines, records in pool.imap(worker, shards):
+            if meter is not None:
+                meter.update(num_bytes, num_lines)
+            yield from records
+
+
+def iter_records(filename, record_fn, num_workers=1, meter=None):
+    if num_workers > 1:
+        yield from iter_parallel_records(filename, record_fn, num_workers, meter)
+        return
+    for obj in iter_json_lines(filename, meter):
+        record = record_fn(obj)
+        if record is not None:
+            yield record
@@ -0,0 +1,235 @@
+import os
+import io
+import json
+import pstats
+import cProfile
+import resource
+import threading
+import tracemalloc
+from time import time, perf_counter, process_time
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    # lifetime peak resident set size of this process and of its finished children (the worker pools), linux reports
+    # KB; it never goes down, so after the heaviest stage every later stage would show the same number
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+class RssSampler:
+    # peak rss of this process per open stage: a background thread polls /proc/self/status every interval. A rise of
+    # VmHWM since the previous poll is the exact peak in between, otherwise only VmRSS at the poll is seen and short
+    # spikes below the lifetime peak can be missed. With reset_peak VmHWM is reset through /proc/self/clear_refs after
+    # every poll, which makes every peak exact but also clears the page reference bits of the whole process
+
+    def __init__(self, interval=0.05, reset_peak=False):
+        self.interval = interval
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.available = self._read_status('VmRSS') is not None
+        # the reset also lowers ru_maxrss, so the lifetime peak is kept here from then on
+        self.lifetime_peak = peak_rss_mb()[0]
+        self.last_hwm = self._read_status('VmHWM') or 0.0
+        self.can_reset = False
+        if reset_peak:
+            self.enable_reset()
+
+    def enable_reset(self):
+        with self.lock:
+            if self.available and not self.can_reset:
+                self.can_reset = self._reset()
+                self.last_hwm = 0.0
+
+    @staticmethod
+    def _read_status(field):
+        try:
+            with open("/proc/self/status", "r") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        return int(line.split()[1]) / 1024
+        except (OSError, ValueError):
+            return None
+        return None
+
+    @staticmethod
+    def _reset():
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            return True
+        except OSError:
+            return False
+
+    def _sample(self):
+        hwm = self._read_status('VmHWM')
+        if hwm is not None and hwm > self.last_hwm:
+            value = hwm
+        else:
+            value = self._read_status('VmRSS')
+        if hwm is not None:
+            self.last_hwm = max(self.last_hwm, hwm)
+        if self.can_reset and self._reset():
+            self.last_hwm = 0.0
+        return value
+
+    def poll(self):
+        with self.lock:
+            value = self._sample()
+            # a failed read only loses this sample, the next poll tries again
+            if value is None:
+                return
+            self.lifetime_peak = max(self.lifetime_peak, value)
+            for name in self.peaks:
+                self.peaks[name] = max(self.peaks[name], value)
+
+    def _run(self, stop_event):
+        while not stop_event.wait(self.interval):
+            self.poll()
+
+    def start(self, key):
+        # the peak so far belongs to the stages that are already open
+        self.poll()
+        with self.lock:
+            self.peaks[key] = self._read_status('VmRSS') or 0.0
+            if self.stop_event is None:
+                self.stop_event = threading.Event()
+                threading.Thread(target=self._run, args=(self.stop_event,), daemon=True).start()
+
+    def stop(self, key):
+        self.poll()
+        with self.lock:
+            peak = self.peaks.pop(key)
+            if not self.peaks and self.stop_event is not None:
+                self.stop_event.set()
+                self.stop_event = None
+        return peak
+
+
+_RSS_SAMPLER = None
+
+
+def shared_rss_sampler(reset_peak=False):
+    # one sampler per process, the VmHWM reset of one instrumentation would otherwise hide peaks from another; the
+    # reset stays on once any instrumentation of the process asked for it
+    global _RSS_SAMPLER
+    if _RSS_SAMPLER is None:
+        _RSS_SAMPLER = RssSampler(reset_peak=reset_peak)
+    elif reset_peak:
+        _RSS_SAMPLER.enable_reset()
+    return _RSS_SAMPLER
+
+
+class Instrumentation:
+    # per stage and per task family wall / cpu time, peak rss, records in / out, error counts with sampled messages,
+    # optionally a cProfile dump and the tracemalloc peak per stage, everything ends up in one json report; reset_peak_rss
+    # makes the per stage rss peaks exact at the cost of resetting the kernel's page reference bits on every poll
+
+    def __init__(self, profile=False, trace_memory=False, profile_dir="./data/reports/profiles", max_error_samples=5,
+                 reset_peak_rss=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.max_error_samples = max_error_samples
+        self.started_at = time()
+        self.stages = {}
+        self.active = set()
+        self.rss_sampler = shared_rss_sampler(reset_peak_rss)
+
+    def _stage_entry(self, name):
+        if name not in self.stages:
+            self.stages[name] = {
+                'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'records_in': 0, 'records_out': 0,
+                'peak_rss_mb': 0.0, 'cumulative_peak_rss_mb': 0.0, 'children_cumulative_peak_rss_mb': 0.0,
+                'families': {}, 'errors': {},
+            }
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        # the yielded dict takes records_in / records_out (and any extra numbers) from the caller
+        counters = {'records_in': 0, 'records_out': 0}
+        if name in self.active:
+            # nested use of the same stage (the pipeline wraps what DataPreparation measures itself), time it only once
+            yield counters
+            entry = self._stage_entry(name)
+            for key, value in counters.items():
+                entry[key] = entry.get(key, 0) + value
+            return
+        self.active.add(name)
+        if self.rss_sampler.available:
+            self.rss_sampler.start((id(self), name))
+        profiler = cProfile.Profile() if self.profile else None
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall, cpu = perf_counter(), process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield counters
+        finally:
+            self.active.discard(name)
+            if profiler is not None:
+                profiler.disable()
+            wall, cpu = perf_counter() - wall, process_time() - cpu
+            entry = self._stage_entry(name)
+            entry['calls'] += 1
+            entry['wall_time'] += wall
+            # cpu time of this process only, worker processes show up in their families
+            entry['cpu_time'] += cpu
+            # peak_rss_mb is the peak while this stage ran (max over its calls), the cumulative ones are process
+            # lifetime peaks, the children one covers finished worker processes only
+            entry['cumulative_peak_rss_mb'], entry['children_cumulative_peak_rss_mb'] = peak_rss_mb()
+            if self.rss_sampler.available:
+                entry['peak_rss_mb'] = max(entry['peak_rss_mb'], self.rss_sampler.stop((id(self), name)))
+                entry['cumulative_peak_rss_mb'] = max(entry['cumulative_peak_rss_mb'], self.rss_sampler.lifetime_peak)
+            else:
+                entry['peak_rss_mb'] = entry['cumulative_peak_rss_mb']
+            for key, value in counters.items():
+                entry[key] = entry.get(key, 0) + value
+            entry['records_per_s'] = entry['records_out'] / max(entry['wall_time'], 1e-9)
+            if self.trace_memory:
+                entry['tracemalloc_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+                if started_tracing:
+                    tracemalloc.stop()
+            if profiler is not None:
+                entry['profile'] = self._dump_profile(name, profiler)
+
+    def _dump_profile(self, name, profiler):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{name}.prof")
+        profiler.dump_stats(path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+        return {'file': path, 'top_cumulative': stream.getvalue().strip().splitlines()[-15:]}
+
+    def add_family(self, stage, family, wall_time=0.0, cpu_time=0.0, records_in=0, records_out=0):
+        families = self._stage_entry(stage)['families']
+        entry = families.setdefault(family, {'wall_time': 0.0, 'cpu_time': 0.0, 'records_in': 0, 'records_out': 0})
+        entry['wall_time'] += wall_time
+        entry['cpu_time'] += cpu_time
+        entry['records_in'] += records_in
+        entry['records_out'] += records_out
+        # summed over workers, so this is the throughput of one core spent on the family
+        entry['records_per_cpu_s'] = entry['records_out'] / max(entry['cpu_time'], 1e-9)
+
+    def add_errors(self, stage, counter, count, messages=()):
+        errors = self._stage_entry(stage)['errors']
+        entry = errors.setdefault(counter, {'count': 0, 'samples': []})
+        entry['count'] += count
+        room = self.max_error_samples - len(entry['samples'])
+        entry['samples'].extend(list(messages)[:max(room, 0)])
+
+    def report(self):
+        return {'started_at': self.started_at, 'wall_time': time() - self.started_at, 'stages': self.stages}
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=4)
+        return path
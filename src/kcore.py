@@ -0,0 +1,70 @@
+from collections import defaultdict
+
+
+class KCoreFilter:
+
+    def __init__(self, user_core=5, item_core=5):
+        self.user_core = user_core
+        self.item_core = item_core
+        self.stats = {}
+
+    def filter(self, user_item_interaction):
+        # user_item_interaction maps user -> list of interaction tuples whose first element is the item
+        # degrees are counted once and only decremented for the neighbours of removed nodes, so the work is O(edges)
+        user_degree = {}
+        item_degree = defaultdict(int)
+        item_users = defaultdict(list)
+        for user, records in user_item_interaction.items():
+            user_degree[user] = len(records)
+            for record in records:
+                item_degree[record[0]] += 1
+                item_users[record[0]].append(user)
+
+        removed_users, removed_items = set(), set()
+        user_queue = [user for user, cnt in user_degree.items() if cnt < self.user_core]
+        item_queue = [item for item, cnt in item_degree.items() if cnt < self.item_core]
+        removed_users.update(user_queue)
+        removed_items.update(item_queue)
+
+        rounds = 0
+        while user_queue or item_queue:
+            rounds += 1
+            next_user_queue, next_item_queue = [], []
+            for user in user_queue:
+                for record in user_item_interaction[user]:
+                    item = record[0]
+                    if item in removed_items:
+                        continue
+                    item_degree[item] -= 1
+                    if item_degree[item] < self.item_core:
+                        removed_items.add(item)
+                        next_item_queue.append(item)
+            for item in item_queue:
+                for user in item_users[item]:
+                    if user in removed_users:
+                        continue
+                    user_degree[user] -= 1
+                    if user_degree[user] < self.user_core:
+                        removed_users.add(user)
+                        next_user_queue.append(user)
+            user_queue, item_queue = next_user_queue, next_item_queue
+
+        filtered = {}
+        num_edges_before, num_edges_after = 0, 0
+        for user, records in user_item_interaction.items():
+            num_edges_before += len(records)
+            if user in removed_users:
+                continue
+            filtered[user] = [record for record in records if record[0] not in removed_items]
+            num_edges_after += len(filtered[user])
+
+        self.stats = {
+            'rounds': rounds,
+            'removed_users': len(removed_users),
+            'removed_items': len(removed_items),
+            'removed_edges': num_edges_before - num_edges_after,
+            'users': len(filtered),
+            'items': len(item_degree) - len(removed_items),
+            'edges': num_edges_after,
+        }
+        return filtered
@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def target_ranks(ranked_items, targets):
+    # 0 based position of the target in each ranked list, -1 when it was not retrieved
+    ranks = np.full(len(targets), -1, dtype=np.int64)
+    for i, (items, target) in enumerate(zip(ranked_items, targets)):
+        for pos, item in enumerate(items):
+            if item == target:
+                ranks[i] = pos
+                break
+    return ranks
+
+
+def ranking_metrics(ranks, ks=(1, 5, 10)):
+    # HR@k, NDCG@k (one relevant item, so the ideal DCG is 1) and MRR from the target ranks
+    ranks = np.asarray(ranks)
+    if len(ranks) == 0:
+        return {**{f"{name}@{k}": 0.0 for k in ks for name in ("HR", "NDCG")}, "MRR": 0.0}
+    found = ranks >= 0
+    positions = np.where(found, ranks, 0)
+    metrics = {}
+    for k in ks:
+        hit = found & (ranks < k)
+        metrics[f"HR@{k}"] = float(hit.mean())
+        metrics[f"NDCG@{k}"] = float((hit / np.log2(positions + 2)).mean())
+    metrics["MRR"] = float((found / (positions + 1)).mean())
+    return metrics
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def build_alias_table(weights):
+    # vose's alias method, afterwards every weighted draw is one uniform int + one uniform float
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    prob = weights * n / weights.sum()
+    alias = np.zeros(n, dtype=np.int64)
+    small = [i for i in range(n) if prob[i] < 1.0]
+    large = [i for i in range(n) if prob[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    for i in small + large:
+        prob[i] = 1.0
+    return prob, alias
+
+
+class NegativeSampler:
+
+    def __init__(self, num_items, weights=None, seed=None):
+        # the item universe is the dense index range [0, num_items), it is never materialised per call
+        self.num_items = num_items
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+        self.alias_prob, self.alias_idx = (None, None) if weights is None else build_alias_table(weights)
+        # rejection rounds before sample() switches to drawing from the complement
+        self.max_rounds = 8
+
+    def reseed(self, seed):
+        self.rng = np.random.default_rng(seed)
+
+    def _draw(self, size):
+        idx = self.rng.integers(0, self.num_items, size=size)
+        if self.alias_prob is None:
+            return idx
+        keep = self.rng.random(size) < self.alias_prob[idx]
+        return np.where(keep, idx, self.alias_idx[idx])
+
+    def _sample_from_complement(self, k, exclude):
+        candidates = np.setdiff1d(np.arange(self.num_items), np.fromiter(exclude, dtype=np.int64, count=len(exclude)))
+        if self.weights is None:
+            return self.rng.choice(candidates, size=k, replace=False).tolist()
+        weights = self.weights[candidates]
+        positive = candidates[weights > 0]
+        if len(positive) >= k:
+            return self.rng.choice(positive, size=k, replace=False, p=weights[weights > 0] / weights[weights > 0].sum()).tolist()
+        # not enough items with any popularity left, they all go in and the rest is drawn uniformly from the others
+        rest = self.rng.choice(candidates[weights <= 0], size=k - len(positive), replace=False)
+        return self.rng.permutation(positive).tolist() + rest.tolist()
+
+    def _excluded_fraction(self, exclude):
+        # share of the sampling distribution the rejection loop would throw away, by probability mass, not item count
+        if self.weights is None:
+            return len(exclude) / self.num_items
+        total = self.weights.sum()
+        if not exclude or total <= 0:
+            return 1.0 if total <= 0 else 0.0
+        return float(self.weights[np.fromiter(exclude, dtype=np.int64, count=len(exclude))].sum() / total)
+
+    def sample(self, k, exclude=()):
+        # k distinct items outside exclude, expected O(k) draws while exclude holds less than half the probability mass
+        if k > self.num_items - len(exclude):
+            raise ValueError("Sample larger than population or is negative")
+        if k <= 0:
+            return []
+        if 2 * self._excluded_fraction(exclude) > 1:
+            return self._sample_from_complement(k, exclude)
+        chosen = []
+        seen = set(exclude)
+        for _ in range(self.max_rounds):
+            for item in self._draw(2 * (k - len(chosen)) + 1).tolist():
+                if item not in seen:
+                    seen.add(item)
+                    chosen.append(item)
+                    if len(chosen) == k:
+                        return chosen
+        # the items already chosen can hold most of the remaining mass, the complement finishes the draw
+        return chosen + self._sample_from_complement(k - len(chosen), seen)
+
+    def sample_batch(self, histories, k):
+        # one vectorised draw for every user, only rows that came up short fall back to sample()
+        draws = self._draw((len(histories), 2 * k)).tolist()
+        result = []
+        for row, exclude in zip(draws, histories):
+            chosen = []
+            seen = set(exclude)
+            for item in row:
+                if item not in seen:
+                    seen.add(item)
+                    chosen.append(item)
+                    if len(chosen) == k:
+                        break
+            if len(chosen) < k:
+                chosen += self.sample(k - len(chosen), seen)
+            result.append(chosen)
+        return result
@@ -0,0 +1,144 @@
+import random
+import numpy as np
+import torch
+from collections import deque
+from torch.utils.data import IterableDataset, get_worker_info
+
+from src.batch_generation import InteractionColumns
+from src.token_cache import calculate_whole_word_ids, TokenCacheDataset
+
+
+def family_name(func_name):
+    return func_name.replace('_data_preparation', '').lstrip('_')
+
+
+class OnlinePromptDataset(IterableDataset):
+    # renders prompts from the columnar pre data while training instead of replaying a written corpus: every epoch
+    # draws new templates, negatives and yes / no flips, only the memory mapped interactions and id maps are kept.
+    # preparation is a configured DataPreparation, its five task families and templates do the rendering.
+    # mixture weights the families per emitted example, e.g. {'sequential': 2, 'rating': 1, ...}, missing families are off
+
+    def __init__(self, preparation, mixture=None, samples_per_epoch=None, tokenizer=None, max_text_length=256,
+                 gen_max_length=64, shuffle_buffer=1024, seed=42):
+        self.preparation = preparation
+        self.families = {family_name(func.__name__): func.__name__ for func in preparation._task_functions()}
+        mixture = mixture or {family: 1.0 for family in self.families}
+        unknown = set(mixture) - set(self.families)
+        if unknown:
+            raise ValueError(f"Unknown task families in mixture: {sorted(unknown)}")
+        self.mixture = {family: float(weight) for family, weight in mixture.items() if weight > 0}
+        # defaults to one prompt per interaction
+        self.samples_per_epoch = samples_per_epoch
+        self.tokenizer = tokenizer
+        self.pad_token_id = None if tokenizer is None else tokenizer.pad_token_id
+        self.max_text_length = max_text_length
+        self.gen_max_length = gen_max_length
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # has to be called before every epoch, workers get a copy of the dataset and never see their own increments
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.samples_per_epoch is None:
+            self._load_state()
+            return len(self.preparation.whole_data.item_index)
+        return self.samples_per_epoch
+
+    def _load_state(self):
+        if self.preparation.whole_data is None:
+            self.preparation._load_state()
+
+    def _worker_share(self):
+        info = get_worker_info()
+        worker_id, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        total = len(self)
+        return worker_id, num_workers, total // num_workers + (1 if worker_id < total % num_workers else 0)
+
+    def _seed_worker(self, worker_id):
+        # one independent stream per (seed, epoch, worker) for the templates, the negatives and the batched draws
+        prep = self.preparation
+        random.seed(f"{self.seed}-{self.epoch}-{worker_id}")
+        prep.negative_sampler.reseed([self.seed, self.epoch, worker_id])
+        prep.batch_rng = np.random.default_rng([self.seed, self.epoch, worker_id, 1])
+        return np.random.default_rng([self.seed, self.epoch, worker_id, 2])
+
+    def _render(self, func_name, user):
+        prep = self.preparation
+        batch_functions = prep._batch_task_functions()
+        if func_name in batch_functions:
+            return batch_functions[func_name](InteractionColumns(prep.whole_data, user, user + 1))
+        return getattr(prep, func_name)(prep.whole_data.record(user))
+
+    def _tokenize(self, rows):
+        if self.tokenizer is None:
+            return [{'task': row[0].rsplit('_', 1)[0], 'task_desc': row[0], 'inp_text': row[1], 'out_text': row[2], 'metric': row[3]}
+                    for row in rows]
+        source_ids = self.tokenizer([row[1] for row in rows], truncation=True, max_length=self.max_text_length)['input_ids']
+        target_ids = self.tokenizer([row[2] for row in rows], truncation=True, max_length=self.gen_max_length)['input_ids']
+        examples = []
+        for row, input_ids, output_ids in zip(rows, source_ids, target_ids):
+            tokens = self.tokenizer.convert_ids_to_tokens(input_ids[:-1])
+            examples.append({
+                'input_ids': torch.tensor(input_ids, dtype=torch.long),
+                'input_length': len(input_ids),
+                'whole_word_ids': torch.tensor(calculate_whole_word_ids(tokens, len(input_ids)), dtype=torch.long),
+                'target_ids': torch.tensor(output_ids, dtype=torch.long),
+                'target_length': len(output_ids),
+                'task': row[0].rsplit('_', 1)[0],
+                'task_desc': row[0],
+                'loss_weight': 1.0,
+            })
+        return examples
+
+    def _iter_examples(self, worker_id, num_workers, count, rng):
+        # the workers split a per epoch permutation of the users, every family walks the worker's users on its own
+        # cursor and buffers the prompts of its current user, the family of each example is drawn from the mixture
+        num_users = len(self.preparation.whole_data)
+        users = np.random.default_rng([self.seed, self.epoch]).permutation(num_users)[worker_id::num_workers].tolist()
+        if not users:
+            return
+        families = list(self.mixture)
+        weights = np.asarray([self.mixture[family] for family in families])
+        cursors = {family: 0 for family in families}
+        buffers = {family: deque() for family in families}
+        emitted = 0
+        while emitted < count:
+            for family_idx in rng.choice(len(families), size=min(count - emitted, 4096), p=weights / weights.sum()).tolist():
+                family = families[family_idx]
+                # a user can give no prompt for a family (no review text, no features), bounded by one pass over the users
+                for _ in range(len(users)):
+                    if buffers[family]:
+                        break
+                    user = users[cursors[family] % len(users)]
+                    cursors[family] += 1
+                    buffers[family].extend(self._tokenize(self._render(self.families[family], user)))
+                if not buffers[family]:
+                    raise ValueError(f"Task family {family} produced no prompts for any user")
+                yield buffers[family].popleft()
+                emitted += 1
+
+    def __iter__(self):
+        self._load_state()
+        worker_id, num_workers, count = self._worker_share()
+        rng = self._seed_worker(worker_id)
+        examples = self._iter_examples(worker_id, num_workers, count, rng)
+        if self.shuffle_buffer <= 1:
+            yield from examples
+            return
+        # prompts of one user come out together, a shuffle buffer spreads them over batches
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            pos = int(rng.integers(len(buffer)))
+            yield buffer[pos]
+            buffer[pos] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    # same padded batch as TokenCacheDataset, so either dataset can feed the training loop
+    collate_fn = TokenCacheDataset.collate_fn
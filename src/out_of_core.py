@@ -0,0 +1,381 @@
+import os
+import json
+import random
+import shutil
+import hashlib
+import numpy as np
+from tqdm import tqdm
+
+from src.utils import ThroughputMeter
+from src.ingestion import iter_records, review_record, user_record, item_record
+from src.columnar import COLUMNAR_VERSION
+from src.id_maps import IdMaps
+
+
+# one spilled review: hashed user / item ids, time, byte offset of its line in review.json and the chosen feature
+# sentence (-1 for none), the text fields stay in the file until enrichment
+RECORD_DTYPE = np.dtype([('user', '<u8'), ('item', '<u8'), ('time', '<i8'), ('offset', '<i8'), ('sentence', '<i8')])
+SORT_ORDER = ['user', 'time', 'offset']
+
+
+def id_hash(raw_id):
+    return int.from_bytes(hashlib.blake2b(raw_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class NpyAppender:
+    # appends to a raw file and turns it into a .npy at close, nothing but the current chunk is held in memory
+
+    def __init__(self, path, dtype, copy_block=1 << 20):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.copy_block = copy_block
+        self.count = 0
+        self.file = open(path + ".raw", "wb")
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.count += len(values)
+
+    def close(self):
+        self.file.close()
+        out = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype, shape=(self.count,))
+        with open(self.path + ".raw", "rb") as f:
+            for start in range(0, self.count, self.copy_block):
+                block = np.fromfile(f, dtype=self.dtype, count=min(self.copy_block, self.count - start))
+                out[start:start + len(block)] = block
+        out.flush()
+        del out
+        os.remove(self.path + ".raw")
+
+
+class StringTableAppender:
+    # streaming counterpart of save_string_table, same {name}.blob.npy / {name}.offsets.npy files
+
+    def __init__(self, dir_path, name):
+        self.blob = NpyAppender(os.path.join(dir_path, f"{name}.blob.npy"), np.uint8)
+        self.offsets = NpyAppender(os.path.join(dir_path, f"{name}.offsets.npy"), np.int64)
+        self.offsets.append([0])
+        self.position = 0
+
+    def append(self, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.blob.file.write(b"".join(encoded))
+        self.blob.count += sum(len(s) for s in encoded)
+        offsets = np.cumsum([len(s) for s in encoded], dtype=np.int64) + self.position
+        if len(offsets):
+            self.position = int(offsets[-1])
+        self.offsets.append(offsets)
+
+    def close(self):
+        self.blob.close()
+        self.offsets.close()
+
+
+class ExternalSorter:
+    # records are written in place into a preallocated run buffer, sorted and spilled as run files, then merged block
+    # by block with numpy into one sorted file; no record is ever turned into a python object and the run files are
+    # read and the output written through plain file io, so page cache does not show up as resident memory
+
+    def __init__(self, dir_path, run_records, dtype=RECORD_DTYPE, order=SORT_ORDER):
+        self.dir_path = dir_path
+        self.run_records = run_records
+        self.dtype = np.dtype(dtype)
+        self.order = order
+        self.key_dtype = np.dtype([(name, self.dtype[name]) for name in order])
+        self.buffer = np.empty(run_records, dtype=self.dtype)
+        self.filled = 0
+        self.runs = []
+        self.count = 0
+        os.makedirs(dir_path, exist_ok=True)
+
+    def add(self, record):
+        self.buffer[self.filled] = record
+        self.filled += 1
+        self.count += 1
+        if self.filled == self.run_records:
+            self._spill()
+
+    def _spill(self):
+        if not self.filled:
+            return
+        run = self.buffer[:self.filled]
+        run.sort(order=self.order)
+        path = os.path.join(self.dir_path, f"run-{len(self.runs):05d}.npy")
+        np.save(path, run)
+        self.runs.append(path)
+        self.filled = 0
+
+    def _keys(self, records):
+        # packed copy of the sort fields, structured arrays compare field by field so these sort and search directly
+        keys = np.empty(len(records), dtype=self.key_dtype)
+        for name in self.order:
+            keys[name] = records[name]
+        return keys
+
+    def _open_run(self, path):
+        f = open(path, "rb")
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, _ = read_header(f)
+        return f, shape[0]
+
+    def merge(self, out_path, block_size):
+        self._spill()
+        # the buffer is not needed any more, the merge gets the memory instead
+        self.buffer = np.empty(0, dtype=self.dtype)
+        runs = [self._open_run(path) for path in self.runs]
+        # every run gets an equal share of the block budget for its head block
+        run_block = max(block_size // max(len(runs), 1), 1)
+        remaining = [length for _, length in runs]
+        heads = [np.empty(0, dtype=self.dtype) for _ in runs]
+        with open(out_path, "wb") as out:
+            np.lib.format.write_array_header_1_0(out, {
+                'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (self.count,),
+            })
+            while True:
+                for i, (f, _) in enumerate(runs):
+                    if not len(heads[i]) and remaining[i]:
+                        heads[i] = np.fromfile(f, dtype=self.dtype, count=min(run_block, remaining[i]))
+                        remaining[i] -= len(heads[i])
+                live = [i for i in range(len(runs)) if len(heads[i])]
+                if not live:
+                    break
+                # a run that still has records on disk can not produce anything below the last key of its head, so
+                # everything up to the smallest such key is final; a run with no records left puts no bound at all
+                bounded = [i for i in live if remaining[i]]
+                bound = np.sort(np.concatenate([self._keys(heads[i][-1:]) for i in bounded]))[:1] if bounded else None
+                parts = []
+                for i in live:
+                    take = len(heads[i]) if bound is None else int(np.searchsorted(self._keys(heads[i]), bound, side='right')[0])
+                    parts.append(heads[i][:take])
+                    heads[i] = heads[i][take:]
+                block = np.concatenate(parts)
+                del parts
+                # stable, so equal keys keep the run order like heapq.merge
+                out.write(block[np.argsort(self._keys(block), kind='stable')].tobytes())
+                del block
+        for f, _ in runs:
+            f.close()
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+        return np.load(out_path, mmap_mode='r')
+
+
+class OutOfCorePreparation:
+    # PreDataPreparation for review windows larger than memory, same columnar output and id maps as the in memory path:
+    # reviews are spilled as fixed size records, grouped by an external sort, k-core runs on the integer edge list and
+    # the text fields are read back by byte offset while the columnar files are streamed out
+
+    def __init__(self, pre_data_preparation):
+        self.pre = pre_data_preparation
+        self.spill_dir = pre_data_preparation.spill_dir
+        # records held in memory at once, for the sort buffer as well as for every scan over the edge list
+        self.block_records = max(int(pre_data_preparation.memory_mb * 2**20) // (2 * RECORD_DTYPE.itemsize), 1)
+
+    def _spill_reviews(self, review_with_features):
+        # same filter and the same feature sentence draws, in the same file order, as PreDataPreparation._iter_review_data
+        sorter = ExternalSorter(os.path.join(self.spill_dir, "runs"), self.block_records)
+        meter = ThroughputMeter("review spill")
+        offset = 0
+        with open(self.pre.review_file_path, "rb") as f:
+            for line in tqdm(f):
+                line_offset = offset
+                offset += len(line)
+                meter.update(len(line))
+                record = review_record(json.loads(line), self.pre.min_date, self.pre.max_date)
+                if record is None:
+                    continue
+                user, item, time = record[:3]
+                sentence = -1
+                pos = review_with_features.find(user, item)
+                if pos >= 0:
+                    select_random_idx = random.randint(0, review_with_features.num_sentences(pos)-1)
+                    sentence = int(review_with_features.pair_offsets[pos]) + select_random_idx
+                sorter.add((id_hash(user), id_hash(item), time, line_offset, sentence))
+                meter.records_out += 1
+        meter.report()
+        self.pre.review_meter = meter
+        return sorter
+
+    def _blocks(self, n):
+        for start in range(0, n, self.block_records):
+            yield start, min(start + self.block_records, n)
+
+    def _edge_list(self, grouped):
+        # dense user / item numbers per edge, users are contiguous because the file is sorted by user
+        n = len(grouped)
+        edge_user = np.lib.format.open_memmap(os.path.join(self.spill_dir, "edge_user.npy"), mode='w+', dtype=np.int32, shape=(n,))
+        edge_item = np.lib.format.open_memmap(os.path.join(self.spill_dir, "edge_item.npy"), mode='w+', dtype=np.int32, shape=(n,))
+        item_hashes = np.zeros(0, dtype=np.uint64)
+        user_starts = []
+        previous_user, num_users = None, 0
+        for start, end in self._blocks(n):
+            users = np.asarray(grouped['user'][start:end])
+            new_group = np.empty(len(users), dtype=bool)
+            new_group[0] = previous_user is None or users[0] != previous_user
+            new_group[1:] = users[1:] != users[:-1]
+            edge_user[start:end] = num_users - 1 + np.cumsum(new_group)
+            user_starts.extend((start + np.flatnonzero(new_group)).tolist())
+            num_users += int(new_group.sum())
+            previous_user = users[-1]
+            item_hashes = np.union1d(item_hashes, np.asarray(grouped['item'][start:end]))
+        for start, end in self._blocks(n):
+            edge_item[start:end] = np.searchsorted(item_hashes, np.asarray(grouped['item'][start:end]))
+        user_starts = np.asarray(user_starts + [n], dtype=np.int64)
+        return edge_user, edge_item, user_starts, len(item_hashes)
+
+    def _kcore(self, edge_user, edge_item, num_users, num_items):
+        # peeling by full rounds over the edge list, the fixpoint is the same maximal k-core as KCoreFilter's
+        alive_user = np.ones(num_users, dtype=bool)
+        alive_item = np.ones(num_items, dtype=bool)
+        rounds = 0
+        while True:
+            user_degree = np.zeros(num_users, dtype=np.int64)
+            item_degree = np.zeros(num_items, dtype=np.int64)
+            for start, end in self._blocks(len(edge_user)):
+                users, items = np.asarray(edge_user[start:end]), np.asarray(edge_item[start:end])
+                alive = alive_user[users] & alive_item[items]
+                user_degree += np.bincount(users[alive], minlength=num_users)
+                item_degree += np.bincount(items[alive], minlength=num_items)
+            next_user = alive_user & (user_degree >= self.pre.user_core)
+            next_item = alive_item & (item_degree >= self.pre.item_core)
+            if np.array_equal(next_user, alive_user) and np.array_equal(next_item, alive_item):
+                break
+            alive_user, alive_item = next_user, next_item
+            rounds += 1
+        num_edges = sum(
+            int((alive_user[np.asarray(edge_user[s:e])] & alive_item[np.asarray(edge_item[s:e])]).sum())
+            for s, e in self._blocks(len(edge_user))
+        )
+        self.pre.kcore_stats = {
+            'rounds': rounds,
+            'removed_users': int((~alive_user).sum()),
+            'removed_items': int((~alive_item).sum()),
+            'removed_edges': len(edge_user) - num_edges,
+            'users': int(alive_user.sum()),
+            'items': int(alive_item.sum()),
+            'edges': num_edges,
+        }
+        print("K-core stats: ", self.pre.kcore_stats)
+        return alive_user, alive_item
+
+    def _user_order(self, grouped, edge_user, alive_user, num_users):
+        # users in order of their first kept review, like the insertion order of the in memory grouping
+        first_offset = np.full(num_users, np.iinfo(np.int64).max, dtype=np.int64)
+        for start, end in self._blocks(len(grouped)):
+            np.minimum.at(first_offset, np.asarray(edge_user[start:end]), np.asarray(grouped['offset'][start:end]))
+        core_users = np.flatnonzero(alive_user)
+        return core_users[np.argsort(first_offset[core_users], kind='stable')]
+
+    def _enrich(self, grouped, edge_item, user_starts, user_order, alive_item, num_items, review_with_features, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        item_rank = np.full(num_items, -1, dtype=np.int64)
+        item_raw = []
+        user_raw = []
+        arrays = {
+            'user_offsets': NpyAppender(os.path.join(dir_path, "user_offsets.npy"), np.int64),
+            'item_index': NpyAppender(os.path.join(dir_path, "item_index.npy"), np.int32),
+            'visit_date': NpyAppender(os.path.join(dir_path, "visit_date.npy"), np.int64),
+            'rating': NpyAppender(os.path.join(dir_path, "rating.npy"), np.float64),
+        }
+        tables = {name: StringTableAppender(dir_path, name) for name in ['review', 'review_feature', 'review_explanation']}
+        arrays['user_offsets'].append([0])
+        num_interactions = 0
+
+        with open(self.pre.review_file_path, "rb") as f:
+            for u in tqdm(user_order, desc="Enriching"):
+                start, end = int(user_starts[u]), int(user_starts[u + 1])
+                items = np.asarray(edge_item[start:end])
+                keep = alive_item[items]
+                records = grouped[start:end][keep]
+                items = items[keep]
+                reviews, ratings = [], []
+                user_id = None
+                for item, offset in zip(items.tolist(), records['offset'].tolist()):
+                    f.seek(offset)
+                    review = json.loads(f.readline())
+                    user_id = review['user_id']
+                    if item_rank[item] < 0:
+                        item_rank[item] = len(item_raw)
+                        item_raw.append(review['business_id'])
+                    reviews.append(review['text'])
+                    ratings.append(review['stars'])
+                user_raw.append(user_id)
+                sentences = records['sentence'].tolist()
+                tables['review'].append(reviews)
+                tables['review_feature'].append([review_with_features.features[s] if s >= 0 else "" for s in sentences])
+                tables['review_explanation'].append([review_with_features.explanations[s] if s >= 0 else "" for s in sentences])
+                arrays['item_index'].append(item_rank[items])
+                arrays['visit_date'].append(records['time'])
+                arrays['rating'].append(ratings)
+                num_interactions += len(items)
+                arrays['user_offsets'].append([num_interactions])
+
+        for appender in list(arrays.values()) + list(tables.values()):
+            appender.close()
+        np.save(os.path.join(dir_path, "user_index.npy"), np.arange(len(user_raw), dtype=np.int32))
+
+        id_maps = IdMaps.build(user_raw, item_raw)
+        id_maps.save(self.pre.id_maps_dir)
+        print("Saved id maps to", self.pre.id_maps_dir)
+
+        # names and titles, only the core ids are kept while scanning the two files
+        user_lookup = {user_id: i for i, user_id in enumerate(user_raw)}
+        user_desc = [""] * len(user_raw)
+        for user_id, desc in iter_records(self.pre.user_file_path, user_record, self.pre.num_workers):
+            if user_id in user_lookup:
+                user_desc[user_lookup[user_id]] = desc
+        item_lookup = {item_id: i for i, item_id in enumerate(item_raw)}
+        item_title = [""] * len(item_raw)
+        for item_id, desc in iter_records(self.pre.item_file_path, item_record, self.pre.num_workers):
+            if item_id in item_lookup:
+                item_title[item_lookup[item_id]] = desc
+        for name, strings in [('user_raw', user_raw), ('user_desc', user_desc), ('item_raw', item_raw), ('item_title', item_title)]:
+            table = StringTableAppender(dir_path, name)
+            table.append(strings)
+            table.close()
+
+        with open(os.path.join(dir_path, "meta.json"), "w") as f:
+            json.dump({
+                'version': COLUMNAR_VERSION,
+                'num_users': len(user_raw),
+                'num_items': len(item_raw),
+                'num_interactions': num_interactions,
+            }, f, indent=4)
+
+    def run(self):
+        stage = self.pre.instrumentation.stage
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        os.makedirs(self.spill_dir)
+        review_with_features = self.pre._get_review_with_features()
+
+        with stage('ingest_spill') as counters:
+            sorter = self._spill_reviews(review_with_features)
+            counters['records_in'] = self.pre.review_meter.records_in
+            counters['records_out'] = sorter.count
+            counters['runs'] = len(sorter.runs) + (1 if sorter.filled else 0)
+        with stage('group') as counters:
+            # the run heads, the merged block, its keys and its sorted copy are alive together in a merge step
+            grouped = sorter.merge(os.path.join(self.spill_dir, "grouped.npy"), max(self.block_records // 4, 1))
+            edge_user, edge_item, user_starts, num_items = self._edge_list(grouped)
+            counters['records_in'] = len(grouped)
+            counters['records_out'] = len(user_starts) - 1
+        print("Total review data count: ", len(grouped))
+        print("Total length of user_item_interaction: ", len(user_starts) - 1)
+
+        with stage('kcore') as counters:
+            alive_user, alive_item = self._kcore(edge_user, edge_item, len(user_starts) - 1, num_items)
+            user_order = self._user_order(grouped, edge_user, alive_user, len(user_starts) - 1)
+            counters['records_in'] = len(user_starts) - 1
+            counters['records_out'] = len(user_order)
+        print("Total items satisfying Kscore: ", len(user_order))
+
+        with stage('enrich') as counters:
+            self._enrich(grouped, edge_item, user_starts, user_order, alive_item, num_items, review_with_features, self.pre.final_pre_data_dir)
+            counters['records_in'] = counters['records_out'] = len(user_order)
+        print("Saved columnar pre data to", self.pre.final_pre_data_dir)
+
+        del grouped, edge_user, edge_item
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,103 @@
+import os
+import gzip
+import json
+import hashlib
+from collections import defaultdict
+
+
+class ShardedPromptWriter:
+    # rows go straight to rotating jsonl shards, nothing but the open file handles and the counters stay in memory
+
+    def __init__(self, dir_path, test_size=0.2, shard_size=500000, compress=False, seed=42):
+        self.dir_path = dir_path
+        self.test_size = test_size
+        self.shard_size = shard_size
+        self.compress = compress
+        self.seed = seed
+        self.files = {}
+        self.shard_idx = defaultdict(int)
+        self.shard_rows = defaultdict(int)
+        self.shards = defaultdict(list)
+        self.counts = defaultdict(lambda: defaultdict(int))
+        os.makedirs(dir_path, exist_ok=True)
+
+    def _split(self, task_desc, inp_text, out_text):
+        # the hash of the row decides its split, so every task_desc keeps the test_size ratio like a stratified split,
+        # reruns are reproducible and duplicated prompts never end up on both sides
+        key = f"{self.seed}|{task_desc}|{inp_text}|{out_text}".encode('utf-8')
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return 'test' if int.from_bytes(digest, 'little') / 2**64 < self.test_size else 'train'
+
+    def _open_shard(self, split):
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        file_name = f"{split}-{self.shard_idx[split]:05d}{suffix}"
+        path = os.path.join(self.dir_path, file_name)
+        self.files[split] = gzip.open(path, "wt", encoding="utf-8") if self.compress else open(path, "w", encoding="utf-8")
+        self.shards[split].append({'file': file_name, 'rows': 0})
+        self.shard_rows[split] = 0
+
+    def write(self, task_desc, inp_text, out_text, metric, split=None, user=None):
+        split = split or self._split(task_desc, inp_text, out_text)
+        if split not in self.files:
+            self._open_shard(split)
+        elif self.shard_rows[split] >= self.shard_size:
+            self.files[split].close()
+            self.shard_idx[split] += 1
+            self._open_shard(split)
+        row = {'task_desc': task_desc, 'inp_text': inp_text, 'out_text': out_text, 'metric': metric}
+        if user is not None:
+            # dense index of the user the row was generated for
+            row['user'] = user
+        self.files[split].write(json.dumps(row) + "\n")
+        self.shard_rows[split] += 1
+        self.shards[split][-1]['rows'] += 1
+        self.counts[split][task_desc] += 1
+        return split
+
+    def write_many(self, data_lst, split=None, users=None):
+        if users is None:
+            for task_desc, inp_text, out_text, metric in data_lst:
+                self.write(task_desc, inp_text, out_text, metric, split)
+            return
+        for (task_desc, inp_text, out_text, metric), user in zip(data_lst, users):
+            self.write(task_desc, inp_text, out_text, metric, split, user)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        manifest = {'test_size': self.test_size, 'seed': self.seed, 'compress': self.compress, 'splits': {}}
+        for split, task_counts in self.counts.items():
+            family_counts = defaultdict(int)
+            for task_desc, cnt in task_counts.items():
+                family_counts[task_desc.rsplit('_', 1)[0]] += cnt
+            manifest['splits'][split] = {
+                'rows': sum(task_counts.values()),
+                'shards': self.shards[split],
+                'task_families': dict(sorted(family_counts.items())),
+                'sub_tasks': dict(sorted(task_counts.items())),
+            }
+        with open(os.path.join(self.dir_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_prompt_shards(dir_path, split, skip_users=None):
+    # reads rows back in the order they were written, rows tagged with a user in skip_users are left out
+    with open(os.path.join(dir_path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    for shard in manifest['splits'].get(split, {}).get('shards', []):
+        path = os.path.join(dir_path, shard['file'])
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if skip_users and row.get('user') in skip_users:
+                    continue
+                yield row
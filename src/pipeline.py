@@ -0,0 +1,178 @@
+import os
+import json
+import random
+import shutil
+import hashlib
+import pickle
+from time import time
+
+from src.utils import *
+from src.pre_data_preparation import PreDataPreparation
+from src.data_preparation import DataPreparation
+from src.id_maps import IdMaps
+from src.out_of_core import OutOfCorePreparation
+from src.template_compiler import TEMPLATE_VERSION
+from src.instrumentation import Instrumentation
+
+
+CACHE_VERSION = 2
+
+
+def file_fingerprint(path):
+    # size + mtime instead of hashing multi GB raw files, touching a file is enough to invalidate its stages
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class StageCache:
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def has(self, stage, key):
+        return os.path.exists(os.path.join(self.path(stage, key), "_SUCCESS"))
+
+    def run(self, stage, key, func):
+        out_dir = self.path(stage, key)
+        if self.has(stage, key):
+            print(f"[{stage}] cache hit {key}")
+            return out_dir
+        # build into a temporary directory and rename it, an interrupted run never leaves a half written entry behind
+        tmp_dir = out_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        t1 = time()
+        func(tmp_dir)
+        with open(os.path.join(tmp_dir, "_SUCCESS"), "w") as f:
+            f.write(str(time() - t1))
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.rename(tmp_dir, out_dir)
+        print(f"[{stage}] computed {key} in {time() - t1:.2f}s")
+        return out_dir
+
+
+def _dump(obj, dir_path, name):
+    with open(os.path.join(dir_path, name), "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class Pipeline:
+    # ingest_group -> kcore -> id_maps -> enrich -> prompt_gen -> split, with pre.out_of_core the first four are one
+    # out_of_core stage; every stage is keyed by its parameters and the keys of its inputs, an unchanged key reuses the
+    # cached output
+
+    STAGES = ['ingest_group', 'kcore', 'id_maps', 'enrich', 'prompt_gen', 'split']
+    OUT_OF_CORE_STAGES = ['out_of_core', 'prompt_gen', 'split']
+
+    def __init__(self, pre_data_preparation=None, data_preparation=None, profile=False, trace_memory=False):
+        self.pre = pre_data_preparation or PreDataPreparation()
+        self.prep = data_preparation or DataPreparation()
+        self.cache = StageCache("./data/cache")
+        self.stage_keys = {}
+        self.stage_dirs = {}
+        # one report for the whole run, both preparation objects record their task families into it
+        self.instrumentation = Instrumentation(profile=profile, trace_memory=trace_memory)
+        self.pre.instrumentation = self.prep.instrumentation = self.instrumentation
+
+    def _stage_key(self, stage, params, inputs):
+        payload = json.dumps({'cache_version': CACHE_VERSION, 'stage': stage, 'params': params, 'inputs': inputs}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]
+
+    def _run_stage(self, stage, params, inputs, func):
+        key = self._stage_key(stage, params, inputs)
+        self.stage_keys[stage] = key
+        with self.instrumentation.stage(stage) as counters:
+            counters['cache_hit'] = int(self.cache.has(stage, key))
+            self.stage_dirs[stage] = self.cache.run(stage, key, func)
+        return self.stage_dirs[stage]
+
+    def _stage_params(self):
+        pre, prep = self.pre, self.prep
+        return {
+            'ingest_group': {'min_date': pre.min_date, 'max_date': pre.max_date, 'seed': pre.seed},
+            'out_of_core': {
+                'min_date': pre.min_date, 'max_date': pre.max_date, 'seed': pre.seed,
+                'user_core': pre.user_core, 'item_core': pre.item_core,
+            },
+            'kcore': {'user_core': pre.user_core, 'item_core': pre.item_core},
+            'id_maps': {},
+            'enrich': {},
+            'prompt_gen': {
+                'seed': prep.seed, 'template_version': TEMPLATE_VERSION, 'chunk_size': prep.chunk_size,
+                'batch_generation': prep.batch_generation,
+                'negative_sampling': prep.negative_sampling, 'negative_sampling_size': prep.negative_sampling_size,
+            },
+            'split': {'seed': prep.seed, 'test_size': prep.test_size, 'shard_size': prep.shard_size, 'compress': prep.compress_output},
+        }
+
+    def _ingest_group(self, out_dir):
+        # in streaming mode the reviews go straight into the per user histories, only the grouped histories are cached
+        random.seed(self.pre.seed)
+        review_data = self.pre._iter_review_data() if self.pre.streaming else self.pre._get_review_data()
+        _dump(self.pre._get_user_item_interactions(review_data), out_dir, "user_item_interaction.pickle")
+
+    def _out_of_core(self, out_dir):
+        # id maps and columnar pre data of the external sort path, written into the stage directory
+        random.seed(self.pre.seed)
+        final_pre_data_dir, id_maps_dir = self.pre.final_pre_data_dir, self.pre.id_maps_dir
+        self.pre.final_pre_data_dir = os.path.join(out_dir, "final_pre_data")
+        self.pre.id_maps_dir = os.path.join(out_dir, "id_maps")
+        try:
+            OutOfCorePreparation(self.pre).run()
+        finally:
+            self.pre.final_pre_data_dir, self.pre.id_maps_dir = final_pre_data_dir, id_maps_dir
+        with open(os.path.join(out_dir, "kcore_stats.json"), "w") as f:
+            json.dump(self.pre.kcore_stats, f, indent=4)
+
+    def _kcore(self, out_dir):
+        user_item_interaction = load_pickle(os.path.join(self.stage_dirs['ingest_group'], "user_item_interaction.pickle"))
+        _dump(self.pre._filter_kcore(user_item_interaction), out_dir, "user_item_interaction.pickle")
+        with open(os.path.join(out_dir, "kcore_stats.json"), "w") as f:
+            json.dump(self.pre.kcore_stats, f, indent=4)
+
+    def _id_maps(self, out_dir):
+        user_item_interaction = load_pickle(os.path.join(self.stage_dirs['kcore'], "user_item_interaction.pickle"))
+        self.pre._get_mappings(user_item_interaction).save(out_dir)
+
+    def _enrich(self, out_dir):
+        user_item_interaction = load_pickle(os.path.join(self.stage_dirs['kcore'], "user_item_interaction.pickle"))
+        self.pre._enrich(user_item_interaction, IdMaps.load(self.stage_dirs['id_maps']), out_dir)
+
+    def _prompt_gen(self, out_dir):
+        self.prep.final_pre_data_dir = self.stage_dirs['enrich']
+        self.prep.id_maps_dir = self.stage_dirs['id_maps']
+        self.prep.generate_prompts(out_dir)
+
+    def _split(self, out_dir):
+        self.prep.split_prompts(self.stage_dirs['prompt_gen'], out_dir)
+
+    def run(self):
+        params = self._stage_params()
+        raw_review_inputs = [file_fingerprint(self.pre.review_file_path), file_fingerprint(self.pre.review_with_features_file)]
+        raw_enrich_inputs = [file_fingerprint(self.pre.user_file_path), file_fingerprint(self.pre.item_file_path)]
+
+        if self.pre.out_of_core:
+            out_dir = self._run_stage('out_of_core', params['out_of_core'], raw_review_inputs + raw_enrich_inputs, self._out_of_core)
+            self.stage_dirs['id_maps'] = os.path.join(out_dir, "id_maps")
+            self.stage_dirs['enrich'] = os.path.join(out_dir, "final_pre_data")
+            pre_data_keys = [self.stage_keys['out_of_core']]
+        else:
+            self._run_stage('ingest_group', params['ingest_group'], raw_review_inputs, self._ingest_group)
+            self._run_stage('kcore', params['kcore'], [self.stage_keys['ingest_group']], self._kcore)
+            self._run_stage('id_maps', params['id_maps'], [self.stage_keys['kcore']], self._id_maps)
+            self._run_stage('enrich', params['enrich'], [self.stage_keys['kcore'], self.stage_keys['id_maps']] + raw_enrich_inputs, self._enrich)
+            pre_data_keys = [self.stage_keys['enrich'], self.stage_keys['id_maps']]
+        self._run_stage('prompt_gen', params['prompt_gen'], pre_data_keys, self._prompt_gen)
+        self._run_stage('split', params['split'], [self.stage_keys['prompt_gen']], self._split)
+
+        # the final prompts are copied out of the cache to the usual output directory
+        shutil.rmtree(self.prep.output_dir, ignore_errors=True)
+        shutil.copytree(self.stage_dirs['split'], self.prep.output_dir, ignore=shutil.ignore_patterns("_SUCCESS"))
+        with open(os.path.join(self.prep.output_dir, "stage_keys.json"), "w") as f:
+            json.dump(self.stage_keys, f, indent=4)
+        self.instrumentation.save(os.path.join(self.prep.output_dir, "run_report.json"))
+        print("Prompts written to", self.prep.output_dir)
+        return self.stage_dirs
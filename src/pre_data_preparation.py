@@ -1,210 +1,173 @@
-import json
 from tqdm import tqdm
 import random
 from collections import defaultdict
-import pandas as pd
+from functools import partial
+from operator import itemgetter
 
 from src.utils import *
+from src.ingestion import iter_records, review_record, item_record, user_record
+from src.kcore import KCoreFilter
+from src.columnar import write_columnar
+from src.id_maps import IdMaps
+from src.feature_store import FeatureStore, convert_reviews_pickle
+from src.instrumentation import Instrumentation
+from src.out_of_core import OutOfCorePreparation
 
 
 class PreDataPreparation:
 
-    def __init__(self):
+    def __init__(self, profile=False, trace_memory=False):
         self.review_file_path = "./data/original_data/review.json"
         self.user_file_path = "./data/original_data/user_filtered.json"
         self.item_file_path = "./data/original_data/business.json"
         self.review_with_features_file = "./data/original_data/reviews_pickle.pickle"
-        self.final_pre_data_file_path = "./data/final_pre_data.json"
-        self.data_maps_file_path = "./data/data_maps.json"
+        self.review_features_dir = "./data/review_features"
+        self.final_pre_data_dir = "./data/final_pre_data"
+        self.id_maps_dir = "./data/id_maps"
         self.max_date = '2019-12-31 00:00:00'
         self.min_date = '2019-01-01 00:00:00'
         self.user_core = 5
         self.item_core = 5
         self.negative_sampling_size = 50
+        # seeds the random choice of feature sentence per review
+        self.seed = 42
+        # stream reviews straight from the file into the interaction builder instead of materialising them first
+        self.streaming = True
+        self.review_meter = None
+        # number of worker processes used to parse the raw json files, 1 keeps everything in this process
+        self.num_workers = 1
+        self.kcore_stats = {}
+        # per stage timings, rss and record counts, written as json after a run, optionally with a cProfile dump and the
+        # tracemalloc peak of every stage
+        self.instrumentation = Instrumentation(profile=profile, trace_memory=trace_memory)
+        self.report_path = "./data/reports/pre_data_preparation.json"
+        # group and k-core through sorted run files on disk, for review windows that do not fit in memory
+        self.out_of_core = False
+        # memory budget of the out of core path for sort buffers and edge list scans, in MB
+        self.memory_mb = 512
+        self.spill_dir = "./data/spill"
 
 
     def _get_review_with_features(self):
-        raw_data = load_pickle(self.review_with_features_file)
-        review_with_features = {}
-        for i in raw_data:
-            review_with_features[(i['user'], i['item'])] = i
-        return review_with_features
+        # the pickle is converted once into a memory mapped index, afterwards only the looked up pairs are touched
+        if not FeatureStore.is_current(self.review_features_dir, self.review_with_features_file):
+            print("Converting", self.review_with_features_file, "to", self.review_features_dir)
+            convert_reviews_pickle(self.review_with_features_file, self.review_features_dir)
+        return FeatureStore.load(self.review_features_dir)
 
 
-    def _get_user_data(self, data_maps):
+    def _get_user_data(self, id_maps):
         data_dct = {}
-        lines = open(self.user_file_path).readlines()
-        for line in tqdm(lines):
-            user = json.loads(line.strip())
-            user_id = user['user_id']
-            user_desc = user['name']
-            if user_id in data_maps['user2id']:
+        for user_id, user_desc in tqdm(iter_records(self.user_file_path, user_record, self.num_workers)):
+            if user_id in id_maps.users:
                 data_dct[user_id] = {'user_desc': user_desc}
         return data_dct
 
 
     def _get_item_data(self):
         data_dct = {}
-        lines = open(self.item_file_path).readlines()
-        for line in tqdm(lines):
-            item = json.loads(line.strip())
-            item_id = item['business_id']
-            item_name = item['name']
-            item_city = item['city']
-            item_state = item['state']
-            item_desc = item_name + "_" + item_city + "_" + item_state
+        for item_id, item_desc in tqdm(iter_records(self.item_file_path, item_record, self.num_workers)):
             data_dct[item_id] = {'item_desc': item_desc}
         return data_dct
 
 
     def _get_user_item_interactions(self, review_data):
-        user_item_interaction = {}
-        for data in review_data:
-            user, item, time, rating, user_review, review_feature, review_explanation = data
-            user_item_interaction[user] = user_item_interaction.get(user, []) + [(item, time, rating, user_review, review_feature, review_explanation)]
-        for user, item_time in user_item_interaction.items():
-            user_item_interaction[user] = sorted(user_item_interaction[user], key=lambda x: x[1])
-        return user_item_interaction
+        # append into per user buffers and sort each history once, linear in the number of reviews
+        user_item_interaction = defaultdict(list)
+        for user, item, time, rating, user_review, review_feature, review_explanation in review_data:
+            user_item_interaction[user].append((item, time, rating, user_review, review_feature, review_explanation))
+        for item_time in user_item_interaction.values():
+            item_time.sort(key=itemgetter(1))
+        return dict(user_item_interaction)
 
 
-    def _get_review_data(self):
-        review_data = []
-        rating_score = 0.0
+    def _iter_review_data(self, records=None):
+        # records can be passed in by callers that read the review file themselves, e.g. the incremental updater
         review_with_features = self._get_review_with_features()
-        lines = open(self.review_file_path).readlines()
-
-        for line in tqdm(lines):
-            review = json.loads(line.strip())
-            user = review['user_id']
-            item = review['business_id']
-            rating = review['stars']
-            date = review['date']
-            user_review = review['text']
-            if date < self.min_date or date > self.max_date or float(rating) <= rating_score:
-                continue
-            time = date.replace('-','').replace(':','').replace(' ','')
+        self.review_meter = ThroughputMeter("review ingestion")
+        if records is None:
+            record_fn = partial(review_record, min_date=self.min_date, max_date=self.max_date)
+            records = iter_records(self.review_file_path, record_fn, self.num_workers, self.review_meter)
 
+        # feature sentences are picked here, in file order, so a fixed seed gives the same choice for any worker count
+        for user, item, time, rating, user_review in tqdm(records):
             review_feature, review_explanation = "", ""
-            rev_exp_data = review_with_features.get((user, item), {})
-            if 'sentence' in rev_exp_data.keys():
-                select_random_idx = random.randint(0, len(rev_exp_data['sentence'])-1)
-                review_feature = rev_exp_data['sentence'][select_random_idx][0]
-                review_explanation = rev_exp_data['sentence'][select_random_idx][2]
-
-            review_data.append((user, item, int(time), rating, user_review, review_feature, review_explanation))
-
-        return review_data
-
-
-    def _check_kcore(self, user_item_interaction):
-        user_count = defaultdict(int)
-        item_count = defaultdict(int)
-        for user, items in user_item_interaction.items():
-            items = [i[0] for i in items]
-            for item in items:
-                user_count[user] += 1
-                item_count[item] += 1
-        for user, cnt in user_count.items():
-            if cnt < self.user_core:
-                return user_count, item_count, False
-        for item, cnt in item_count.items():
-            if cnt < self.item_core:
-                return user_count, item_count, False
-        return user_count, item_count, True
+            pos = review_with_features.find(user, item)
+            if pos >= 0:
+                select_random_idx = random.randint(0, review_with_features.num_sentences(pos)-1)
+                review_feature, review_explanation = review_with_features.sentence(pos, select_random_idx)
+
+            self.review_meter.records_out += 1
+            yield (user, item, time, rating, user_review, review_feature, review_explanation)
+
+        self.review_meter.report()
+
+
+    def _get_review_data(self):
+        return list(self._iter_review_data())
 
 
     def _filter_kcore(self, user_item_interaction):
-        user_count, item_count, iskcore = self._check_kcore(user_item_interaction)
-        while not iskcore:
-            for user, cnt in user_count.items():
-                if user_count[user] < 5:
-                    user_item_interaction.pop(user)
-                else:
-                    updated_item_lst = []
-                    for item in user_item_interaction[user]:
-                        # print(item[0])
-                        if item_count[item[0]]>=5:
-                            updated_item_lst.append(item)
-                    user_item_interaction[user] = updated_item_lst
-            user_count, item_count, iskcore = self._check_kcore(user_item_interaction)
+        kcore_filter = KCoreFilter(self.user_core, self.item_core)
+        user_item_interaction = kcore_filter.filter(user_item_interaction)
+        self.kcore_stats = kcore_filter.stats
+        print("K-core stats: ", self.kcore_stats)
         return user_item_interaction
 
 
     def _get_mappings(self, user_item_interaction):
-        user2id = {}
-        id2user = {}
-        item2id = {}
-        id2item = {}
-        user_cnt = 1
-        item_cnt = 1
-
-        for user, item_lst in user_item_interaction.items():
-            item_lst = [i[0] for i in item_lst]
-            if user not in user2id:
-                user2id[user] = "user_" + str(user_cnt)
-                id2user["user_" + str(user_cnt)] = user
-                user_cnt += 1
-
-            items_ids_lst = []
-            for item in item_lst:
-                if item not in item2id:
-                    item2id[item] = "item_" + str(item_cnt)
-                    id2item["item_" + str(item_cnt)] = item
-                    item_cnt += 1
-                items_ids_lst.append(item2id[item])
-
-        data_maps = {
-            'user2id': user2id,
-            'id2user': id2user,
-            'item2id': item2id,
-            'id2item': id2item
-        }
-        return data_maps
+        # dense ids in order of first appearance, index i is rendered as user_{i+1} / item_{i+1}
+        user_ids = list(user_item_interaction.keys())
+        item_ids = {}
+        for item_lst in user_item_interaction.values():
+            for i in item_lst:
+                item_ids.setdefault(i[0], len(item_ids))
+        return IdMaps.build(user_ids, list(item_ids))
 
 
-    def pre_data_preparation(self):
-        review_data = self._get_review_data()
-        print("Total review data count: ", len(review_data))
+    def _enrich(self, user_item_interaction, id_maps, dir_path):
+        user_data_dct = self._get_user_data(id_maps)
+        item_data_dct = self._get_item_data()
+        write_columnar(dir_path, user_item_interaction, id_maps, user_data_dct, item_data_dct)
 
-        user_item_interaction = self._get_user_item_interactions(review_data)
+
+    def pre_data_preparation(self):
+        random.seed(self.seed)
+        if self.out_of_core:
+            OutOfCorePreparation(self).run()
+            print("Run report written to", self.instrumentation.save(self.report_path))
+            return
+
+        stage = self.instrumentation.stage
+        # in streaming mode reading the reviews and grouping them is one pass, so they are measured together
+        with stage('ingest_group') as counters:
+            if self.streaming:
+                review_data = self._iter_review_data()
+            else:
+                review_data = self._get_review_data()
+
+            user_item_interaction = self._get_user_item_interactions(review_data)
+            counters['records_in'] = self.review_meter.records_in
+            counters['records_out'] = len(user_item_interaction)
+            counters['reviews_kept'] = self.review_meter.records_out
+        print("Total review data count: ", self.review_meter.records_out)
         print("Total length of user_item_interaction: ", len(user_item_interaction))
 
-        user_item_interaction = self._filter_kcore(user_item_interaction)
+        with stage('kcore') as counters:
+            counters['records_in'] = len(user_item_interaction)
+            user_item_interaction = self._filter_kcore(user_item_interaction)
+            counters['records_out'] = len(user_item_interaction)
         print("Total items satisfying Kscore: ", len(user_item_interaction))
 
-        data_maps = self._get_mappings(user_item_interaction)
-        with open(self.data_maps_file_path, "w") as file:
-            json.dump(data_maps, file, indent=4)
-        print("Saved data maps")
-
-        user_data_dct = self._get_user_data(data_maps)
-        item_data_dct = self._get_item_data()
-
-        final_df = pd.DataFrame({
-            'user_id1': list(user_item_interaction.keys()),
-            'item_id_list1': [[j[0] for j in i] for i in user_item_interaction.values()],
-            'visit_date_list': [[j[1] for j in i] for i in user_item_interaction.values()],
-            'rating_list': [[j[2] for j in i] for i in user_item_interaction.values()],
-            'review_list': [[j[3] for j in i] for i in user_item_interaction.values()],
-            'review_feature_list': [[j[4] for j in i] for i in user_item_interaction.values()],
-            'review_explanation_list': [[j[5] for j in i] for i in user_item_interaction.values()],
-        })
-        final_df['user_id'] = final_df['user_id1'].map(data_maps['user2id'])
-        final_df['item_id_list'] = final_df['item_id_list1'].map(lambda x: [data_maps['item2id'][i] for i in x])
-        final_df['user_desc'] = final_df['user_id1'].map(lambda x: user_data_dct[x]['user_desc'])
-        final_df['item_title_list'] = final_df['item_id_list1'].map(lambda x: [item_data_dct[i]['item_desc'] for i in x])
-        # final_df['neg_item_id_list'] = final_df['item_id_list'].map(
-        #     lambda x: random.sample(
-        #         list(set(data_maps['item2id'].values()) - set(x)),
-        #         self.negative_sampling_size
-        #     )
-        # )
-
-        # make sure that all the list columns have same lengths
-        cols = ['item_id_list1', 'visit_date_list', 'rating_list', 'review_list', 'review_feature_list',
-                'review_explanation_list', 'item_id_list', 'item_title_list']
-        for i in range(len(cols) - 1):
-            ser = (final_df[cols[i]].map(len) == final_df[cols[i + 1]].map(len))
-            print(ser[ser == False].shape)
-
-        final_df.to_json(self.final_pre_data_file_path, orient="records", default_handler=str)
\ No newline at end of file
+        with stage('id_maps') as counters:
+            id_maps = self._get_mappings(user_item_interaction)
+            id_maps.save(self.id_maps_dir)
+            counters['records_in'] = len(user_item_interaction)
+            counters['records_out'] = len(id_maps.users) + len(id_maps.items)
+        print("Saved id maps to", self.id_maps_dir)
+
+        with stage('enrich') as counters:
+            self._enrich(user_item_interaction, id_maps, self.final_pre_data_dir)
+            counters['records_in'] = counters['records_out'] = len(user_item_interaction)
+        print("Saved columnar pre data to", self.final_pre_data_dir)
+        print("Run report written to", self.instrumentation.save(self.report_path))
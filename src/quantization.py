@@ -0,0 +1,201 @@
+import io
+import os
+import json
+import numpy as np
+import torch
+from torch import nn
+
+from src.token_cache import calculate_whole_word_ids
+
+
+KV_NAMES = ['self_key', 'self_value', 'cross_key', 'cross_value']
+
+
+def quantize_dynamic_int8(model):
+    # int8 weights for every nn.Linear (attention projections, feed forward, lm_head), activations are quantized per
+    # batch on the fly; the token and whole word embeddings stay fp32, so the encoder inputs do not change.
+    # returns a quantized copy, the fp32 model is left as it is
+    return torch.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def encode_inputs(tokenizer, texts, max_text_length=256, whole_word_embed=True):
+    batch = tokenizer(texts, padding=True, truncation=True, max_length=max_text_length, return_tensors='pt')
+    inputs = {'input_ids': batch['input_ids'], 'attention_mask': batch['attention_mask']}
+    if whole_word_embed:
+        whole_word_ids = torch.full_like(batch['input_ids'], tokenizer.pad_token_id)
+        for i, mask in enumerate(batch['attention_mask']):
+            length = int(mask.sum())
+            tokens = tokenizer.convert_ids_to_tokens(batch['input_ids'][i, :length - 1].tolist())
+            whole_word_ids[i, :length] = torch.tensor(calculate_whole_word_ids(tokens, length))
+        inputs['whole_word_ids'] = whole_word_ids
+    return inputs
+
+
+class QuantizedGenerator:
+    # batched greedy / beam generate on cpu with the int8 copy of the model, same inputs as the fp32 model
+
+    def __init__(self, model, tokenizer, max_text_length=256, whole_word_embed=True, quantize=True, num_threads=None):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = quantize_dynamic_int8(model) if quantize else model.eval()
+        self.tokenizer = tokenizer
+        self.max_text_length = max_text_length
+        self.whole_word_embed = whole_word_embed
+
+    @torch.no_grad()
+    def generate(self, texts, max_length=64, num_beams=1):
+        inputs = encode_inputs(self.tokenizer, texts, self.max_text_length, self.whole_word_embed)
+        output = self.model.generate(**inputs, max_length=max_length, num_beams=num_beams)
+        return self.tokenizer.batch_decode(output, skip_special_tokens=True)
+
+
+class _EncoderExport(nn.Module):
+
+    def __init__(self, encoder, whole_word_embed):
+        super().__init__()
+        self.encoder = encoder
+        self.whole_word_embed = whole_word_embed
+
+    def forward(self, input_ids, attention_mask, whole_word_ids=None):
+        kwargs = {'whole_word_ids': whole_word_ids} if self.whole_word_embed else {}
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True, **kwargs).last_hidden_state
+
+
+class _DecoderExport(nn.Module):
+    # one decoder step, the kv cache goes in and comes out flattened as 4 tensors per layer (self attention key / value
+    # of the tokens so far, cross attention key / value of the encoder states, the latter computed in the first step)
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.decoder
+        self.lm_head = model.lm_head
+        self.num_layers = model.config.num_decoder_layers
+        # T5 rescales the decoder output when the lm head shares the token embeddings
+        self.scale = model.config.d_model ** -0.5 if model.config.tie_word_embeddings else 1.0
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        past_key_values = tuple(tuple(past[4 * i:4 * i + 4]) for i in range(self.num_layers)) if past else None
+        output = self.decoder(
+            input_ids=decoder_input_ids, encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask, past_key_values=past_key_values, use_cache=True, return_dict=True,
+        )
+        present = output.past_key_values
+        if hasattr(present, 'to_legacy_cache'):
+            present = present.to_legacy_cache()
+        logits = self.lm_head(output.last_hidden_state * self.scale)
+        return (logits,) + tuple(tensor for layer in present for tensor in layer)
+
+
+def _kv_names(prefix, num_layers):
+    return [f"{prefix}.{i}.{name}" for i in range(num_layers) for name in KV_NAMES]
+
+
+def _kv_axes(names):
+    return {name: {0: 'batch', 2: 'encoder_length' if 'cross' in name else 'past_length'} for name in names}
+
+
+@torch.no_grad()
+def export_onnx(model, tokenizer, dir_path, whole_word_embed=True, quantize=True, opset=14):
+    # encoder.onnx, decoder_init.onnx (first step, fills the cache) and decoder_with_past.onnx (one token per step
+    # on the cache), with quantize also the dynamically int8 quantized *.int8.onnx of each graph
+    os.makedirs(dir_path, exist_ok=True)
+    model = model.eval()
+    num_layers = model.config.num_decoder_layers
+    inputs = encode_inputs(tokenizer, ["user_1 visited item_1 and item_2"], whole_word_embed=whole_word_embed)
+    encoder_inputs = ['input_ids', 'attention_mask'] + (['whole_word_ids'] if whole_word_embed else [])
+    sequence_axes = {'input_ids': {0: 'batch', 1: 'encoder_length'}, 'attention_mask': {0: 'batch', 1: 'encoder_length'},
+                     'whole_word_ids': {0: 'batch', 1: 'encoder_length'}}
+
+    encoder = _EncoderExport(model.encoder, whole_word_embed)
+    torch.onnx.export(
+        encoder, tuple(inputs[name] for name in encoder_inputs), os.path.join(dir_path, "encoder.onnx"),
+        input_names=encoder_inputs, output_names=['encoder_hidden_states'], opset_version=opset,
+        dynamic_axes={**{name: sequence_axes[name] for name in encoder_inputs}, 'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'}},
+    )
+    encoder_hidden_states = encoder(*(inputs[name] for name in encoder_inputs))
+
+    decoder = _DecoderExport(model)
+    start = torch.full((1, 1), model.config.decoder_start_token_id, dtype=torch.long)
+    step_inputs = ['decoder_input_ids', 'encoder_hidden_states', 'encoder_attention_mask']
+    step_axes = {'decoder_input_ids': {0: 'batch'}, 'encoder_hidden_states': {0: 'batch', 1: 'encoder_length'},
+                 'encoder_attention_mask': {0: 'batch', 1: 'encoder_length'}, 'logits': {0: 'batch'}}
+    present_names = _kv_names("present", num_layers)
+    torch.onnx.export(
+        decoder, (start, encoder_hidden_states, inputs['attention_mask']), os.path.join(dir_path, "decoder_init.onnx"),
+        input_names=step_inputs, output_names=['logits'] + present_names, opset_version=opset,
+        dynamic_axes={**step_axes, **_kv_axes(present_names)},
+    )
+    past = decoder(start, encoder_hidden_states, inputs['attention_mask'])[1:]
+    past_names = _kv_names("past", num_layers)
+    torch.onnx.export(
+        decoder, (start, encoder_hidden_states, inputs['attention_mask'], *past), os.path.join(dir_path, "decoder_with_past.onnx"),
+        input_names=step_inputs + past_names, output_names=['logits'] + present_names, opset_version=opset,
+        dynamic_axes={**step_axes, **_kv_axes(past_names), **_kv_axes(present_names)},
+    )
+
+    graphs = ['encoder', 'decoder_init', 'decoder_with_past']
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        for graph in graphs:
+            quantize_dynamic(os.path.join(dir_path, f"{graph}.onnx"), os.path.join(dir_path, f"{graph}.int8.onnx"), weight_type=QuantType.QInt8)
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump({
+            'graphs': graphs,
+            'quantized': quantize,
+            'whole_word_embed': whole_word_embed,
+            'num_layers': num_layers,
+            'decoder_start_token_id': model.config.decoder_start_token_id,
+            'eos_token_id': model.config.eos_token_id,
+            'pad_token_id': model.config.pad_token_id,
+        }, f, indent=4)
+    return dir_path
+
+
+class OnnxGenerator:
+    # greedy decoding on onnxruntime with the exported graphs, the first step fills the kv cache and every further
+    # step feeds only the last token, so a step costs the same however long the output already is
+
+    def __init__(self, dir_path, tokenizer, quantized=True, max_text_length=256, num_threads=None):
+        import onnxruntime
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        suffix = ".int8.onnx" if quantized else ".onnx"
+        self.sessions = {
+            graph: onnxruntime.InferenceSession(os.path.join(dir_path, graph + suffix), options, providers=['CPUExecutionProvider'])
+            for graph in self.meta['graphs']
+        }
+        self.tokenizer = tokenizer
+        self.max_text_length = max_text_length
+        self.past_names = _kv_names("past", self.meta['num_layers'])
+
+    def generate(self, texts, max_length=64):
+        inputs = {name: tensor.numpy() for name, tensor in
+                  encode_inputs(self.tokenizer, texts, self.max_text_length, self.meta['whole_word_embed']).items()}
+        encoder_hidden_states = self.sessions['encoder'].run(None, inputs)[0]
+        step = {
+            'decoder_input_ids': np.full((len(texts), 1), self.meta['decoder_start_token_id'], dtype=np.int64),
+            'encoder_hidden_states': encoder_hidden_states,
+            'encoder_attention_mask': inputs['attention_mask'],
+        }
+        outputs = self.sessions['decoder_init'].run(None, step)
+        sequences = np.zeros((len(texts), 0), dtype=np.int64)
+        finished = np.zeros(len(texts), dtype=bool)
+        while True:
+            next_tokens = np.where(finished, self.meta['pad_token_id'], outputs[0][:, -1].argmax(-1))
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == self.meta['eos_token_id']
+            if finished.all() or sequences.shape[1] >= max_length - 1:
+                break
+            step['decoder_input_ids'] = next_tokens[:, None]
+            step.update(zip(self.past_names, outputs[1:]))
+            outputs = self.sessions['decoder_with_past'].run(None, step)
+        return self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
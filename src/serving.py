@@ -0,0 +1,266 @@
+import json
+import asyncio
+from time import perf_counter
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from src.template_compiler import compiled_tasks
+
+
+# template used per request kind, the second one when the request lists candidates (or a feature word for explanations)
+DEFAULT_TEMPLATES = {
+    'rating': ('0', '0'),
+    'sequential': ('4', '12'),
+    'traditional': ('4', '16'),
+    'explanation': ('0', '16'),
+}
+MAX_LENGTHS = {'rating': 8, 'sequential': 16, 'traditional': 16, 'explanation': 64}
+# request field that fills each template field, for the error of a template the request has too little for
+REQUEST_FIELDS = {
+    'item_id': 'business_id', 'item_title': 'business_id', 'candidate_item_id': 'business_id',
+    'candidate_item_title': 'business_id', 'target_item_id': 'business_id', 'candiate_item_id_list': 'candidates',
+    'rating': 'rating', 'feature': 'feature',
+}
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class PromptRenderer:
+    # raw yelp ids -> dense ids through the id maps, the history / names / titles come from the columnar pre data
+
+    def __init__(self, id_maps, whole_data):
+        self.id_maps = id_maps
+        self.whole_data = whole_data
+        # row of every dense user index in the columnar files
+        self.user_rows = np.argsort(np.asarray(whole_data.user_index))
+
+    def _user(self, raw_id):
+        idx = self.id_maps.users.to_index(raw_id) if raw_id else None
+        if idx is None:
+            raise RequestError(404, f"Unknown user_id: {raw_id}")
+        return idx
+
+    def _item(self, raw_id):
+        idx = self.id_maps.items.to_index(raw_id) if raw_id else None
+        if idx is None:
+            raise RequestError(404, f"Unknown business_id: {raw_id}")
+        return idx
+
+    def _values(self, user):
+        row = int(self.user_rows[user])
+        start, end = int(self.whole_data.user_offsets[row]), int(self.whole_data.user_offsets[row + 1])
+        history = self.whole_data.item_index[start:end].tolist()
+        return {
+            'user_id': self.id_maps.users.token(user),
+            'user_desc': self.whole_data.user_desc[row],
+            'item_id_list': "{" + "--".join(self.id_maps.items.token(i) for i in history) + "}",
+            'item_title_list': "{" + "--".join(self.whole_data.item_title[i] for i in history) + "}",
+        }
+
+    def _add_item(self, values, item, prefix=""):
+        values[f'{prefix}item_id'] = self.id_maps.items.token(item)
+        values[f'{prefix}item_title'] = self.whole_data.item_title[item]
+
+    def render(self, kind, request):
+        # returns the prompt and the template used, request: {"user_id", "business_id", "candidates", "feature", "rating",
+        # "template"}; for the yes/no templates (rating 11-14, sequential 24-29) business_id is the item asked about and
+        # rating the rating asked about
+        if kind not in DEFAULT_TEMPLATES:
+            raise RequestError(404, f"Unknown request kind: {kind}")
+        values = self._values(self._user(request.get('user_id')))
+        candidates = request.get('candidates')
+        if kind == 'rating':
+            self._add_item(values, self._item(request.get('business_id')))
+            if request.get('rating') is not None:
+                values['rating'] = request['rating']
+        elif kind == 'sequential' and request.get('business_id'):
+            values['target_item_id'] = self.id_maps.items.token(self._item(request['business_id']))
+        elif kind == 'explanation':
+            self._add_item(values, self._item(request.get('business_id')))
+            values['feature'] = request.get('feature', "")
+            values['rating'] = request.get('rating', "")
+        elif kind == 'traditional' and not candidates:
+            self._add_item(values, self._item(request.get('business_id')), "candidate_")
+        if candidates:
+            values['candiate_item_id_list'] = "{" + "--".join(self.id_maps.items.token(self._item(c)) for c in candidates) + "}"
+        default, alternative = DEFAULT_TEMPLATES[kind]
+        key = request.get('template') or (alternative if candidates or request.get('feature') else default)
+        task = compiled_tasks[kind].get(str(key))
+        if task is None:
+            raise RequestError(400, f"Unknown template {key} for {kind}")
+        missing = task.source.required_fields - set(values)
+        if missing:
+            needed = sorted({REQUEST_FIELDS.get(field, field) for field in missing})
+            raise RequestError(400, f"Template {task.task_desc} needs {needed} in the request")
+        return task.source.render(values), task.task_desc
+
+
+class ServiceMetrics:
+    # request latency percentiles over the last window requests, batch size histogram and counters per kind
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.flush_reasons = Counter()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.started = perf_counter()
+
+    def report(self):
+        latencies = np.asarray(self.latencies) * 1000
+        batches = sum(self.batch_sizes.values())
+        return {
+            'uptime_s': perf_counter() - self.started,
+            'requests': dict(self.requests),
+            'errors': dict(self.errors),
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                'mean': float(latencies.mean()) if len(latencies) else 0.0,
+            },
+            'batches': batches,
+            'mean_batch_size': sum(size * cnt for size, cnt in self.batch_sizes.items()) / max(batches, 1),
+            'batch_sizes': {str(size): cnt for size, cnt in sorted(self.batch_sizes.items())},
+            'flush_reasons': dict(self.flush_reasons),
+        }
+
+
+class MicroBatcher:
+    # pending prompts of one request kind are flushed to the model as one batch once max_batch_size are waiting or the
+    # oldest one has waited max_delay_ms, the model runs on the executor so the event loop keeps accepting requests
+
+    def __init__(self, generate, executor, metrics, max_batch_size=16, max_delay_ms=10, max_length=64):
+        self.generate = generate
+        self.executor = executor
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.max_length = max_length
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, prompt):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                return batch, 'deadline'
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                return batch, 'deadline'
+        return batch, 'size'
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, reason = await self._collect()
+            self.metrics.batch_sizes[len(batch)] += 1
+            self.metrics.flush_reasons[reason] += 1
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.generate, [prompt for prompt, _ in batch], self.max_length)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+
+class RecommendationService:
+    # POST /{rating,sequential,traditional,explanation} with a json body of raw yelp ids, GET /metrics, GET /health.
+    # generate(prompts, max_length) -> outputs is the model, e.g. QuantizedGenerator.generate; one executor thread
+    # so only one batch is on the model at a time
+
+    def __init__(self, renderer, generate, max_batch_size=16, max_delay_ms=10, max_lengths=None):
+        self.renderer = renderer
+        self.metrics = ServiceMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        max_lengths = {**MAX_LENGTHS, **(max_lengths or {})}
+        self.batchers = {
+            kind: MicroBatcher(generate, self.executor, self.metrics, max_batch_size, max_delay_ms, max_lengths[kind])
+            for kind in DEFAULT_TEMPLATES
+        }
+
+    async def handle(self, method, path, body):
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.report()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        if method != 'POST':
+            raise RequestError(405, f"Method not allowed: {method}")
+        t = perf_counter()
+        kind = path.strip('/')
+        try:
+            request = json.loads(body or b"{}")
+        except json.JSONDecodeError as e:
+            raise RequestError(400, f"Invalid json: {e}")
+        prompt, task_desc = self.renderer.render(kind, request)
+        output = await self.batchers[kind].submit(prompt)
+        self.metrics.latencies.append(perf_counter() - t)
+        self.metrics.requests[kind] += 1
+        return 200, {'task_desc': task_desc, 'prompt': prompt, 'output': output}
+
+    async def _handle_connection(self, reader, writer):
+        # minimal http/1.1 with keep alive, enough for local clients and the load generator
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, response = await self.handle(method, path, body)
+                except RequestError as e:
+                    self.metrics.errors[e.status] += 1
+                    status, response = e.status, {'error': str(e)}
+                except Exception as e:
+                    self.metrics.errors[500] += 1
+                    status, response = 500, {'error': f"{type(e).__name__}: {e}"}
+                payload = json.dumps(response).encode('utf-8')
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        for batcher in self.batchers.values():
+            batcher.start()
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
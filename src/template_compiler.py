@@ -0,0 +1,94 @@
+import json
+import hashlib
+from string import Formatter
+from operator import itemgetter
+
+from src.data_templates import tasks
+
+
+# how the answer of a sub task is produced, decided once from the template instead of int(sub_task_key) ranges
+DIRECT = 'direct'
+YES_NO = 'yes_no'
+LIKE_DISLIKE = 'like_dislike'
+CANDIDATES = 'candidates'
+
+
+class CompiledTemplate:
+
+    def __init__(self, template):
+        self.template = template
+        self.literals = []
+        self.fields = []
+        literal_buffer = ""
+        for literal, field, format_spec, conversion in Formatter().parse(template):
+            literal_buffer += literal
+            if field is None:
+                continue
+            if format_spec or conversion:
+                raise ValueError(f"Unsupported format spec in template: {template}")
+            self.literals.append(literal_buffer)
+            self.fields.append(field)
+            literal_buffer = ""
+        self.literals.append(literal_buffer)
+        self.required_fields = frozenset(self.fields)
+        # the literal pieces are pre-joined around %s slots and the field values are pulled out with one itemgetter
+        self.pattern = "%s".join(literal.replace("%", "%%") for literal in self.literals)
+        if len(self.fields) == 0:
+            self.getter = None
+        elif len(self.fields) == 1:
+            field = self.fields[0]
+            self.getter = lambda values: (values[field],)
+        else:
+            self.getter = itemgetter(*self.fields)
+
+    def render(self, values):
+        # same result as template.format(**values) for plain {field} slots
+        if self.getter is None:
+            return self.pattern
+        return self.pattern % self.getter(values)
+
+
+class CompiledTask:
+
+    def __init__(self, family, key, source, target, metric):
+        self.family = family
+        self.key = key
+        self.task_desc = family + "_" + key
+        self.source = CompiledTemplate(source)
+        self.target = CompiledTemplate(target)
+        self.metric = metric
+        self.required_fields = self.source.required_fields | self.target.required_fields
+        if target == 'NA':
+            self.category = LIKE_DISLIKE if 'like means' in source else YES_NO
+        elif 'candiate_item_id_list' in self.source.required_fields:
+            self.category = CANDIDATES
+        else:
+            self.category = DIRECT
+
+
+def compile_tasks(raw_tasks):
+    return {
+        family: {key: CompiledTask(family, key, *template) for key, template in family_tasks.items()}
+        for family, family_tasks in raw_tasks.items()
+    }
+
+
+compiled_tasks = compile_tasks(tasks)
+# changes whenever any template text changes, used to key cached prompt generation runs
+TEMPLATE_VERSION = hashlib.sha256(json.dumps(tasks, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+task_keys = {family: list(family_tasks.keys()) for family, family_tasks in compiled_tasks.items()}
+
+
+class JoinedPrefixes:
+    # "{a--b--c}" style history strings for every prefix length, built from a single join per user
+
+    def __init__(self, items, sep="--"):
+        self.joined = sep.join(items)
+        self.ends = [0]
+        position = -len(sep)
+        for item in items:
+            position += len(sep) + len(item)
+            self.ends.append(position)
+
+    def braced(self, size):
+        return "{" + self.joined[:self.ends[size]] + "}"
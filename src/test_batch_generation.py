@@ -0,0 +1,28 @@
+from benchmarks.check_batch_generation import synthetic_pre_data, per_user_rows, batch_rows, compare_counts
+from src.data_preparation import DataPreparation
+from src.template_compiler import compiled_tasks, DIRECT
+from src.utils import flatten_dict
+
+
+def test_batch_rows_match_per_user_generation(tmp_path):
+    whole_data = synthetic_pre_data(str(tmp_path), num_users=500, num_items=200)
+    rating_rows, review_rows = batch_rows(whole_data, seed=42, chunk_size=64)
+    assert (rating_rows, review_rows) == batch_rows(whole_data, seed=42, chunk_size=64)
+    assert (rating_rows, review_rows) != batch_rows(whole_data, seed=43, chunk_size=64)
+
+    legacy_rating, legacy_review = per_user_rows(DataPreparation(), whole_data, seed=42)
+    compare_counts("rating", legacy_rating, rating_rows)
+    compare_counts("review", legacy_review, review_rows)
+
+    # two rating rows per interaction, the direct ones render exactly what the per user code renders
+    interactions = [
+        sub_dct for data_dct in map(whole_data.record, range(len(whole_data)))
+        for sub_dct in flatten_dict({'user_id': data_dct['user_id'], 'user_desc': data_dct['user_desc'], 'item_id': data_dct['item_id_list'],
+                                     'item_title': data_dct['item_title_list'], 'rating': data_dct['rating_list']})
+    ]
+    assert len(rating_rows) == 2 * len(interactions)
+    for i, row in enumerate(rating_rows):
+        task = compiled_tasks['rating'][row[0].rsplit('_', 1)[1]]
+        if task.category == DIRECT:
+            assert row[1] == task.source.render(interactions[i // 2])
+            assert row[2] in {task.target.render(interactions[i // 2])} | {str(r) for r in range(5)}
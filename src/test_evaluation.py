@@ -0,0 +1,69 @@
+import math
+
+import pytest
+
+from src.evaluation import Evaluator, text_stats, bleu_rouge, RANKING, TEXT
+from src.metrics import target_ranks, ranking_metrics
+
+
+def test_target_ranks():
+    ranked = [["item_1", "item_2"], ["item_3", "item_1"], ["item_4"], []]
+    assert target_ranks(ranked, ["item_1", "item_1", "item_1", "item_1"]).tolist() == [0, 1, -1, -1]
+
+
+def test_ranking_metrics_by_hand():
+    metrics = ranking_metrics([0, 2, -1, 9], ks=(1, 5, 10))
+    assert metrics["HR@1"] == pytest.approx(1 / 4)
+    assert metrics["HR@5"] == pytest.approx(2 / 4)
+    assert metrics["HR@10"] == pytest.approx(3 / 4)
+    assert metrics["NDCG@1"] == pytest.approx(1 / 4)
+    assert metrics["NDCG@5"] == pytest.approx((1 + 1 / 2) / 4)
+    assert metrics["NDCG@10"] == pytest.approx((1 + 1 / 2 + 1 / math.log2(11)) / 4)
+    assert metrics["MRR"] == pytest.approx((1 + 1 / 3 + 0 + 1 / 10) / 4)
+
+
+def test_text_metrics_by_hand():
+    # 3 of 4 unigrams, 2 of 3 bigrams, 1 of 2 trigrams and no 4-gram match, the lcs is 3 words
+    report = bleu_rouge(text_stats([("the food was great", "the food was bad")]), 1)
+    assert report['BLEU-4'] == 0.0
+    assert report['ROUGE-1'] == pytest.approx(75.0)
+    assert report['ROUGE-2'] == pytest.approx(100 * 2 / 3)
+    assert report['ROUGE-L'] == pytest.approx(75.0)
+    # every n-gram of the hypothesis matches, only the brevity penalty of 4 against 5 words is left
+    report = bleu_rouge(text_stats([("the food was great", "the food was great today")]), 1)
+    assert report['BLEU-4'] == pytest.approx(100 * math.exp(1 - 5 / 4))
+    assert report['ROUGE-1'] == pytest.approx(100 * 2 * 0.8 / 1.8)
+
+
+@pytest.mark.parametrize("num_workers, batch_size", [(1, 2), (2, 3)])
+def test_evaluator_by_hand(num_workers, batch_size):
+    rows = [
+        {'task_desc': 'rating_0', 'out_text': '4.0', 'metric': 'accuracy'},
+        {'task_desc': 'rating_0', 'out_text': '2.0', 'metric': 'accuracy'},
+        {'task_desc': 'rating_0', 'out_text': '5.0', 'metric': 'accuracy'},
+        {'task_desc': 'sequential_4', 'out_text': 'item_7', 'metric': RANKING},
+        {'task_desc': 'sequential_4', 'out_text': 'item_8', 'metric': RANKING},
+        {'task_desc': 'sequential_24', 'out_text': 'yes', 'metric': 'accuracy'},
+        {'task_desc': 'explanation_11', 'out_text': '4.0, the food was great', 'metric': TEXT},
+    ]
+    predictions = ["4", "3.0", "five", ["item_1", "item_7"], ["item_8"], " Yes", "4.0, the food was great"]
+    report = Evaluator(batch_size=batch_size, num_workers=num_workers, ks=(1, 5)).evaluate(rows, predictions)
+    rating = report['sub_tasks']['rating_0']
+    # "4" == "4.0" counts, "five" is wrong and left out of RMSE / MAE
+    assert rating['count'] == 3 and rating['accuracy'] == pytest.approx(1 / 3) and rating['invalid'] == 1
+    assert rating['RMSE'] == pytest.approx(math.sqrt(1 / 2)) and rating['MAE'] == pytest.approx(1 / 2)
+    sequential = report['sub_tasks']['sequential_4']
+    assert sequential['HR@1'] == pytest.approx(1 / 2) and sequential['HR@5'] == pytest.approx(1.0)
+    assert sequential['NDCG@5'] == pytest.approx((1 / math.log2(3) + 1) / 2)
+    assert sequential['MRR'] == pytest.approx((1 / 2 + 1) / 2)
+    assert report['sub_tasks']['sequential_24']['accuracy'] == 1.0
+    explanation = report['sub_tasks']['explanation_11']
+    assert explanation['accuracy'] == 1.0 and explanation['BLEU-4'] == pytest.approx(100.0) and explanation['ROUGE-L'] == pytest.approx(100.0)
+    # sequential holds ranking and yes / no sub tasks, they are reported as separate families
+    assert set(report['families']) == {'rating (accuracy)', f'sequential ({RANKING})', 'sequential (accuracy)', f'explanation ({TEXT})'}
+
+
+def test_evaluator_rejects_misaligned_predictions():
+    rows = [{'task_desc': 'rating_0', 'out_text': '4.0', 'metric': 'accuracy'}] * 2
+    with pytest.raises(ValueError):
+        Evaluator(num_workers=1).evaluate(rows, ["4.0"])
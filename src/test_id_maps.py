@@ -0,0 +1,73 @@
+import os
+import json
+
+from src.id_maps import IdMaps, convert_data_maps_json
+
+
+USERS = [f"u{i:03d}-yelp" for i in range(50)][::-1]
+ITEMS = [f"b{i:03d}" for i in range(30)]
+
+
+def assert_maps(id_maps, users, items):
+    assert len(id_maps.users) == len(users) and len(id_maps.items) == len(items)
+    for id_map, raw_ids in [(id_maps.users, users), (id_maps.items, items)]:
+        for i, raw_id in enumerate(raw_ids):
+            assert id_map.to_index(raw_id) == i
+            assert id_map.to_raw(i) == raw_id
+            assert id_map.token_to_index(id_map.token(i)) == i
+        assert id_map.to_index_batch(raw_ids).tolist() == list(range(len(raw_ids)))
+
+
+def test_save_load_round_trip(tmp_path):
+    IdMaps.build(USERS, ITEMS).save(tmp_path)
+    id_maps = IdMaps.load(tmp_path)
+    assert_maps(id_maps, USERS, ITEMS)
+    assert id_maps.users.token(0) == "user_1" and id_maps.items.token(29) == "item_30"
+    assert id_maps.items.to_index("missing") is None
+    # an unknown id that only starts with a known one must not match it
+    assert id_maps.items.to_index_batch(["b001", "b001x", "b00", "zz"]).tolist() == [1, -1, -1, -1]
+
+
+def test_append_keeps_indices_and_compacts(tmp_path):
+    IdMaps.build(USERS[:5], ITEMS[:3]).save(tmp_path)
+    users, items = USERS[:5], ITEMS[:3]
+    for step in range(1, 10):
+        new_users, new_items = USERS[5 * step:5 * step + 5], ITEMS[3 * step:3 * step + 3]
+        id_maps = IdMaps.append(tmp_path, new_users, new_items)
+        users, items = users + new_users, items + new_items
+        assert_maps(IdMaps.load(tmp_path), users, items)
+    # runs are merged while the one before is at most MERGE_RATIO times larger, a handful instead of one per append
+    assert len(id_maps.users.runs) <= 3
+    with open(os.path.join(tmp_path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    listed = {f"{run}{suffix}" for run in meta['user_runs'] + meta['item_runs']
+              for suffix in ["_raw.blob.npy", "_raw.offsets.npy", "_sorted_keys.npy", "_sorted_index.npy"]}
+    assert set(os.listdir(tmp_path)) == listed | {"meta.json"}
+
+
+def test_append_without_prune_can_be_rolled_back(tmp_path):
+    IdMaps.build(USERS[:10], ITEMS[:10]).save(tmp_path)
+    with open(os.path.join(tmp_path, "meta.json"), "rb") as f:
+        old_meta = f.read()
+    IdMaps.append(tmp_path, USERS[10:20], ITEMS[10:20], prune=False)
+    assert_maps(IdMaps.load(tmp_path), USERS[:20], ITEMS[:20])
+    with open(os.path.join(tmp_path, "meta.json"), "wb") as f:
+        f.write(old_meta)
+    IdMaps.prune(tmp_path)
+    assert_maps(IdMaps.load(tmp_path), USERS[:10], ITEMS[:10])
+
+
+def test_convert_data_maps_json(tmp_path):
+    data_maps = {
+        'user2id': {u: f"user_{i + 1}" for i, u in enumerate(USERS)},
+        'id2user': {f"user_{i + 1}": u for i, u in enumerate(USERS)},
+        'item2id': {b: f"item_{i + 1}" for i, b in enumerate(ITEMS)},
+        'id2item': {f"item_{i + 1}": b for i, b in enumerate(ITEMS)},
+    }
+    with open(tmp_path / "data_maps.json", "w") as f:
+        json.dump(data_maps, f)
+    convert_data_maps_json(tmp_path / "data_maps.json", tmp_path / "id_maps")
+    id_maps = IdMaps.load(tmp_path / "id_maps")
+    assert_maps(id_maps, USERS, ITEMS)
+    for raw_id, token in data_maps['item2id'].items():
+        assert id_maps.items.token(id_maps.items.to_index(raw_id)) == token
@@ -0,0 +1,62 @@
+import os
+import shutil
+
+from src.columnar import ColumnarPreData
+from src.incremental import IncrementalUpdater
+from src.output_writer import iter_prompt_shards
+
+
+def histories(dir_path):
+    # raw user id -> (desc, [(raw item id, date, title)]), independent of the dense numbering
+    data = ColumnarPreData(dir_path)
+    return {
+        row['user_id1']: (row['user_desc'], list(zip(row['item_id_list1'], row['visit_date_list'], row['item_title_list'])))
+        for row in data
+    }
+
+
+def test_updates_match_a_full_rebuild(tmp_path, yelp_dir, preparations):
+    raw_dir = str(tmp_path / "raw")
+    os.makedirs(raw_dir)
+    for file_name in ["business.json", "user_filtered.json", "reviews_pickle.pickle"]:
+        shutil.copy(os.path.join(yelp_dir, file_name), raw_dir)
+    with open(os.path.join(yelp_dir, "review.json"), "r") as f:
+        lines = f.readlines()
+    cuts = [0, len(lines) * 6 // 10, len(lines) * 8 // 10, len(lines)]
+
+    pre, prep = preparations(raw_dir, "incremental")
+    pre.max_date = '2019-06-30 23:59:59'
+    updater = IncrementalUpdater(pre, prep)
+    updater.state_dir = str(tmp_path / "state")
+    with open(pre.review_file_path, "w") as f:
+        f.writelines(lines[cuts[0]:cuts[1]])
+    updater.initialize()
+    # the file is in random date order, so every appended part also has reviews from before the watermark
+    for start, end, max_date in [(cuts[1], cuts[2], '2019-09-30 23:59:59'), (cuts[2], cuts[3], '2019-12-31 12:00:00')]:
+        with open(pre.review_file_path, "a") as f:
+            f.writelines(lines[start:end])
+        updater.update(max_date)
+    updater.update('2019-12-31 23:59:59')
+    updater.export(str(tmp_path / "export"))
+
+    full, _ = preparations(yelp_dir, "full")
+    full.pre_data_preparation()
+    expected = histories(full.final_pre_data_dir)
+    assert len(expected) > 50
+    assert histories(str(tmp_path / "export")) == expected
+
+    # segment names are unique, and every user's prompt rows come from the last segment that generated the user
+    segments = updater._load_state()['segments']
+    assert len(set(segments)) == len(segments) == len(os.listdir(os.path.join(updater.state_dir, "segments")))
+    for split in ['train', 'test']:
+        last = {}
+        for name in segments:
+            for row in iter_prompt_shards(updater._prompts_dir(name), split):
+                last[row['user']] = name
+        expected_rows = sum(
+            1 for name in segments for row in iter_prompt_shards(updater._prompts_dir(name), split) if last[row['user']] == name
+        )
+        rows = list(updater.iter_prompts(split))
+        assert len(rows) == expected_rows
+        assert {row['user'] for row in rows} == set(last)
+    assert len(last) == len(expected)
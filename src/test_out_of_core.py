@@ -0,0 +1,37 @@
+import numpy as np
+
+from src.columnar import ColumnarPreData
+from src.id_maps import IdMaps
+from src.out_of_core import ExternalSorter, RECORD_DTYPE, SORT_ORDER
+
+
+def test_external_sort_merges_runs_in_order(tmp_path):
+    records = np.zeros(5000, dtype=RECORD_DTYPE)
+    rng = np.random.default_rng(1)
+    records['user'] = rng.integers(0, 40, len(records))
+    records['item'] = rng.integers(0, 1000, len(records))
+    records['time'] = rng.integers(0, 20, len(records))
+    records['offset'] = rng.permutation(len(records))
+    sorter = ExternalSorter(str(tmp_path / "runs"), 333)
+    for record in records.tolist():
+        sorter.add(record)
+    assert len(sorter.runs) == len(records) // 333
+    merged = sorter.merge(str(tmp_path / "grouped.npy"), 100)
+    assert np.array_equal(np.asarray(merged), np.sort(records, order=SORT_ORDER))
+
+
+def test_out_of_core_matches_in_memory(yelp_dir, preparations):
+    in_memory, _ = preparations(yelp_dir, "in_memory")
+    in_memory.pre_data_preparation()
+    out_of_core, _ = preparations(yelp_dir, "out_of_core")
+    out_of_core.out_of_core = True
+    # a budget of a few hundred records, so the reviews are spilled in many runs and every scan goes block by block
+    out_of_core.memory_mb = 0.02
+    out_of_core.pre_data_preparation()
+
+    assert out_of_core.kcore_stats['users'] == in_memory.kcore_stats['users'] > 50
+    assert out_of_core.kcore_stats['items'] == in_memory.kcore_stats['items']
+    assert list(ColumnarPreData(out_of_core.final_pre_data_dir)) == list(ColumnarPreData(in_memory.final_pre_data_dir))
+    expected, actual = IdMaps.load(in_memory.id_maps_dir), IdMaps.load(out_of_core.id_maps_dir)
+    assert [actual.users.to_raw(i) for i in range(len(actual.users))] == [expected.users.to_raw(i) for i in range(len(expected.users))]
+    assert [actual.items.to_raw(i) for i in range(len(actual.items))] == [expected.items.to_raw(i) for i in range(len(expected.items))]
@@ -0,0 +1,43 @@
+import pytest
+
+from src.data_templates import tasks
+from src.template_compiler import CompiledTemplate, JoinedPrefixes, compiled_tasks
+
+
+VALUES = {
+    'user_id': 'user_12', 'user_desc': 'Jane', 'item_id': 'item_42', 'item_title': 'Pizza Place_Phoenix_AZ',
+    'rating': 4.0, 'review_body': 'Great food, 100% friendly staff.', 'explanation': 'the pizza was great',
+    'feature': 'pizza', 'candidate_item_id': 'item_7', 'candidate_item_title': 'Cafe_Tampa_FL',
+    'target_item_id': 'item_99', 'target_item_title': 'Sushi Bar_Reno_NV', 'item_id_list': '{item_1--item_2}',
+    'item_title_list': '{A--B}', 'candiate_item_id_list': '{item_3--item_4--item_5}',
+}
+
+
+@pytest.mark.parametrize("family", list(tasks))
+def test_compiled_tasks_render_like_str_format(family):
+    for key, (source, target, _) in tasks[family].items():
+        task = compiled_tasks[family][key]
+        assert task.source.render(VALUES) == source.format(**VALUES)
+        assert task.target.render(VALUES) == target.format(**VALUES)
+
+
+@pytest.mark.parametrize("template", ["no fields at all", "50% off {item_id}", "{user_id}", "{a}{b} and {a} % {c}%"])
+def test_compiled_template_edge_cases(template):
+    values = {'item_id': 'item_1', 'user_id': 'user_%s', 'a': 'x', 'b': 2, 'c': '%d'}
+    compiled = CompiledTemplate(template)
+    assert compiled.render(values) == template.format(**values)
+    assert compiled.required_fields == {field for field in values if "{" + field + "}" in template}
+
+
+def test_format_specs_are_rejected():
+    with pytest.raises(ValueError):
+        CompiledTemplate("{rating:.1f}")
+    with pytest.raises(ValueError):
+        CompiledTemplate("{user_id!r}")
+
+
+def test_joined_prefixes():
+    items = ["item_1", "item_22", "item_333"]
+    prefixes = JoinedPrefixes(items)
+    for size in range(len(items) + 1):
+        assert prefixes.braced(size) == "{" + "--".join(items[:size]) + "}"
@@ -0,0 +1,198 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from tqdm import tqdm
+
+from src.output_writer import iter_prompt_shards
+
+
+TOKEN_CACHE_VERSION = 1
+# token ids, whole word ids and target ids are appended to flat int32 files, one offsets array per sequence kind
+ARRAYS = ['input_ids', 'whole_word_ids', 'target_ids']
+
+
+def calculate_whole_word_ids(tokens, num_input_ids):
+    # same as P5YelpDataset.calculate_whole_word_ids: a new word starts at every '▁' piece, 0 for the closing </s>
+    whole_word_ids = []
+    curr = 0
+    for token in tokens:
+        if token.startswith('▁'):
+            curr += 1
+        whole_word_ids.append(curr)
+    return whole_word_ids[:num_input_ids - 1] + [0]
+
+
+def build_token_cache(prompt_dir, dir_path, tokenizer, split='train', max_text_length=256, gen_max_length=64, batch_size=1024):
+    # tokenizes the jsonl shards written by DataPreparation once, training only memory maps the result
+    os.makedirs(dir_path, exist_ok=True)
+    files = {name: open(os.path.join(dir_path, f"{name}.bin"), "wb") for name in ARRAYS}
+    input_offsets, target_offsets = [0], [0]
+    families, family_index = [], {}
+    task_family, task_descs = [], []
+
+    def flush(rows):
+        sources = [row['inp_text'] for row in rows]
+        targets = [row['out_text'] for row in rows]
+        source_ids = tokenizer(sources, truncation=True, max_length=max_text_length)['input_ids']
+        target_ids = tokenizer(targets, truncation=True, max_length=gen_max_length)['input_ids']
+        for row, input_ids, output_ids in zip(rows, source_ids, target_ids):
+            # the pieces of the kept ids give the same word boundaries as tokenizing the text again
+            tokens = tokenizer.convert_ids_to_tokens(input_ids[:-1])
+            whole_word_ids = calculate_whole_word_ids(tokens, len(input_ids))
+            files['input_ids'].write(np.asarray(input_ids, dtype=np.int32).tobytes())
+            files['whole_word_ids'].write(np.asarray(whole_word_ids, dtype=np.int32).tobytes())
+            files['target_ids'].write(np.asarray(output_ids, dtype=np.int32).tobytes())
+            input_offsets.append(input_offsets[-1] + len(input_ids))
+            target_offsets.append(target_offsets[-1] + len(output_ids))
+            family = row['task_desc'].rsplit('_', 1)[0]
+            if family not in family_index:
+                family_index[family] = len(families)
+                families.append(family)
+            task_family.append(family_index[family])
+            task_descs.append(row['task_desc'])
+
+    rows = []
+    for row in tqdm(iter_prompt_shards(prompt_dir, split), desc="Tokenizing prompts"):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            flush(rows)
+            rows = []
+    if rows:
+        flush(rows)
+    for f in files.values():
+        f.close()
+
+    np.save(os.path.join(dir_path, "input_offsets.npy"), np.asarray(input_offsets, dtype=np.int64))
+    np.save(os.path.join(dir_path, "target_offsets.npy"), np.asarray(target_offsets, dtype=np.int64))
+    np.save(os.path.join(dir_path, "task_family.npy"), np.asarray(task_family, dtype=np.int8))
+    sub_tasks = sorted(set(task_descs))
+    sub_task_index = {task_desc: i for i, task_desc in enumerate(sub_tasks)}
+    np.save(os.path.join(dir_path, "task_desc.npy"), np.asarray([sub_task_index[t] for t in task_descs], dtype=np.int16))
+    meta = {
+        'version': TOKEN_CACHE_VERSION, 'split': split, 'num_examples': len(task_family),
+        'num_input_tokens': input_offsets[-1], 'num_target_tokens': target_offsets[-1],
+        'max_text_length': max_text_length, 'gen_max_length': gen_max_length,
+        'pad_token_id': tokenizer.pad_token_id, 'families': families, 'sub_tasks': sub_tasks,
+    }
+    with open(os.path.join(dir_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+    return meta
+
+
+def padding_waste(lengths, batches, pad_to=None):
+    # share of padded positions when every batch is padded to its longest example (or to a fixed pad_to)
+    lengths = np.asarray(lengths)
+    real, padded = 0, 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += int(batch_lengths.sum())
+        padded += len(batch) * (pad_to or int(batch_lengths.max()))
+    return 1.0 - real / max(padded, 1)
+
+
+class TokenCacheDataset(Dataset):
+    # drop in for P5YelpDataset on a pre tokenized cache, __getitem__ and collate_fn return the same keys
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.pad_token_id = self.meta['pad_token_id']
+        self.input_offsets = np.load(os.path.join(dir_path, "input_offsets.npy"), mmap_mode='r')
+        self.target_offsets = np.load(os.path.join(dir_path, "target_offsets.npy"), mmap_mode='r')
+        self.task_family = np.load(os.path.join(dir_path, "task_family.npy"), mmap_mode='r')
+        self.task_desc = np.load(os.path.join(dir_path, "task_desc.npy"), mmap_mode='r')
+        self.arrays = {
+            name: np.memmap(os.path.join(dir_path, f"{name}.bin"), dtype=np.int32, mode='r')
+            for name in ARRAYS
+        }
+        self.lengths = np.diff(self.input_offsets)
+        self.target_lengths = np.diff(self.target_offsets)
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def __getitem__(self, idx):
+        start, end = int(self.input_offsets[idx]), int(self.input_offsets[idx + 1])
+        target_start, target_end = int(self.target_offsets[idx]), int(self.target_offsets[idx + 1])
+        return {
+            'idx': idx,
+            'input_ids': torch.from_numpy(self.arrays['input_ids'][start:end].astype(np.int64)),
+            'input_length': end - start,
+            'whole_word_ids': torch.from_numpy(self.arrays['whole_word_ids'][start:end].astype(np.int64)),
+            'target_ids': torch.from_numpy(self.arrays['target_ids'][target_start:target_end].astype(np.int64)),
+            'target_length': target_end - target_start,
+            'task': self.meta['families'][self.task_family[idx]],
+            'task_desc': self.meta['sub_tasks'][self.task_desc[idx]],
+            'loss_weight': 1.0,
+        }
+
+    def collate_fn(self, batch):
+        B = len(batch)
+        S_W_L = max(entry['input_length'] for entry in batch)
+        T_W_L = max(entry['target_length'] for entry in batch)
+
+        input_ids = torch.full((B, S_W_L), self.pad_token_id, dtype=torch.long)
+        whole_word_ids = torch.full((B, S_W_L), self.pad_token_id, dtype=torch.long)
+        target_ids = torch.full((B, T_W_L), self.pad_token_id, dtype=torch.long)
+        loss_weights = torch.ones(B, dtype=torch.float)
+        for i, entry in enumerate(batch):
+            input_ids[i, :entry['input_length']] = entry['input_ids']
+            whole_word_ids[i, :entry['input_length']] = entry['whole_word_ids']
+            target_ids[i, :entry['target_length']] = entry['target_ids']
+            loss_weights[i] = entry['loss_weight']
+
+        target_ids[target_ids == self.pad_token_id] = -100
+        return {
+            'task': [entry['task'] for entry in batch],
+            'task_desc': [entry['task_desc'] for entry in batch],
+            'input_ids': input_ids,
+            'whole_word_ids': whole_word_ids,
+            'target_ids': target_ids,
+            'loss_weights': loss_weights,
+        }
+
+
+class LengthBucketSampler(Sampler):
+    # batch sampler: examples are shuffled, cut into buckets of bucket_size batches, sorted by length inside a bucket
+    # and sliced into batches, so a batch holds similar lengths while the batch order stays random
+
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, drop_last=False, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        bucket_examples = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(order), bucket_examples):
+            bucket = order[start:start + bucket_examples]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            random.Random(f"{self.seed}-{self.epoch}").shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        yield from self.batches()
+        self.epoch += 1
+
+    def __len__(self):
+        full_buckets, rest = divmod(len(self.lengths), self.batch_size * self.bucket_size)
+        rest_batches = rest // self.batch_size if self.drop_last else -(-rest // self.batch_size)
+        return full_buckets * self.bucket_size + rest_batches
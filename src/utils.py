@@ -1,6 +1,10 @@
 import pickle
 import gzip
+import os
 import json
+import numpy as np
+from time import time
+from bisect import bisect_right
 
 
 def load_pickle(filename):
@@ -19,4 +23,83 @@ def flatten_dict(dct):
         {**non_list_items, **{k: v[i] for k, v in list_items.items()}}
         for i in range(len(next(iter(list_items.values()))))
     ]
-    return result
\ No newline at end of file
+    return result
+
+def iter_json_lines(filename, meter=None):
+    # reads the file one line at a time (buffered binary reads), so memory never holds more than the current line
+    with open(filename, "rb") as f:
+        for line in f:
+            if meter is not None:
+                meter.update(len(line))
+            yield json.loads(line)
+
+
+class ThroughputMeter:
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes_read = 0
+        self.records_in = 0
+        self.records_out = 0
+        self.start_time = time()
+
+    def update(self, num_bytes, num_records=1):
+        self.bytes_read += num_bytes
+        self.records_in += num_records
+
+    def elapsed(self):
+        return max(time() - self.start_time, 1e-9)
+
+    def report(self):
+        elapsed = self.elapsed()
+        print(f"{self.name}: {self.bytes_read / elapsed / 2**20:.2f} MB/s, {self.records_in / elapsed:.0f} records/s, "
+              f"records in: {self.records_in}, records kept: {self.records_out}, time: {elapsed:.2f}s")
+
+
+class StringTable:
+    # utf-8 strings packed into one byte blob, string i lives at blob[offsets[i]:offsets[i + 1]]
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def slice(self, start, end):
+        offsets = self.offsets[start:end + 1].tolist()
+        data = self.blob[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        return [data[a - base:b - base].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class ChainedStringTable:
+    # string tables read one after the other as a single table
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.starts = np.cumsum([0] + [len(table) for table in tables]).tolist()
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, idx):
+        table = bisect_right(self.starts, idx) - 1
+        return self.tables[table][idx - self.starts[table]]
+
+
+def save_string_table(dir_path, name, strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    np.save(os.path.join(dir_path, f"{name}.blob.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(dir_path, f"{name}.offsets.npy"), offsets)
+
+
+def load_string_table(dir_path, name, mmap_mode='r'):
+    blob = np.load(os.path.join(dir_path, f"{name}.blob.npy"), mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(dir_path, f"{name}.offsets.npy"), mmap_mode=mmap_mode)
+    return StringTable(blob, offsets)
@@ -1,7 +1,14 @@
+import argparse
+
 from src.pre_data_preparation import PreDataPreparation
 from src.data_preparation import DataPreparation
+from src.pipeline import Pipeline
 
 
 if __name__ == "__main__":
-    # PreDataPreparation().pre_data_preparation()
-    DataPreparation().data_preparation()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepare the P5 prompt corpus through the cached pipeline")
+    parser.add_argument("--profile", action="store_true", help="dump a cProfile per stage next to the run report")
+    parser.add_argument("--trace-memory", action="store_true", help="record the tracemalloc peak per stage")
+    args = parser.parse_args()
+    # both stages run through the cached pipeline, only stages whose inputs or parameters changed are recomputed
+    Pipeline(PreDataPreparation(), DataPreparation(), profile=args.profile, trace_memory=args.trace_memory).run()